@@ -1,7 +1,9 @@
 """ Seismic Crop Batch. """
+import os
 import string
 import random
 from copy import copy
+from functools import wraps
 from warnings import warn
 
 import numpy as np
@@ -12,6 +14,7 @@ from scipy.signal import butter, lfilter, hilbert
 
 from ..batchflow import FilesIndex, Batch, action, inbatch_parallel, SkipBatchException, apply_parallel
 
+from .geometry import SeismicGeometry
 from .horizon import Horizon
 from .plotters import plot_image
 from .utils import compute_attribute, to_list
@@ -24,18 +27,89 @@ SIZE_SALT = len(AFFIX) + SIZE_POSTFIX
 CHARS = string.ascii_uppercase + string.digits
 
 
+def configurable_parallel(init, post=None, **dec_kwargs):
+    """ Same as `inbatch_parallel`, but the parallelization engine and the number of workers are taken from the batch
+    class: see :attr:`.SeismicCropBatch.parallel_targets` and :meth:`.SeismicCropBatch.get_n_workers`.
+    Values, passed to the action directly, take precedence.
+
+    Pipeline of the batch is stored in a thread-local storage, so it is not visible from the worker threads.
+    Dataset of the pipeline is stored in the batch once, before the items are dispatched, and is used by workers
+    instead: see :attr:`.SeismicCropBatch.dataset`.
+    """
+    def decorator(method):
+        name = method.__name__
+        parallel_method = inbatch_parallel(init=init, post=post, target='for', **dec_kwargs)(method)
+
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            #pylint: disable=protected-access
+            pipeline = getattr(self._local, 'pipeline', None)
+            if self._dataset is None and pipeline is not None:
+                self._dataset = pipeline.dataset
+            kwargs.setdefault('target', self.get_parallel_target(name))
+            kwargs.setdefault('n_workers', self.get_n_workers())
+            return parallel_method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
 class SeismicCropBatch(Batch):
     """ Batch with ability to generate 3d-crops of various shapes.
 
     The first action in any pipeline with this class should be `make_locations` to transform batch index from
     individual cubes into crop-based indices. The transformation uses randomly generated postfix (see `:meth:.salt`)
     to obtain unique elements.
+
+    Items of the batch are processed either sequentially (`for` target) or by a pool of threads (`threads` target).
+    Loading, normalization and masks creation spend most of the time in decompression, NumPy and numba code,
+    that releases the GIL, so they use threads by default. Actions, that are either cheap or update shared objects,
+    like `update_accumulator`, are processed sequentially. Augmentations draw from the global `np.random`:
+    they are sequential by default, so that results are reproducible for a fixed seed. Defaults can be changed for all
+    batches with :attr:`.parallel_targets` and :attr:`.n_workers` class attributes, or for one call of an action
+    by passing `target` and `n_workers` to it, for example, `.normalize(src='images', target='for')`.
     """
     components = None
-    apply_defaults = {
-        'target': 'for',
-        'post': '_assemble'
+
+    # Parallelization engine for actions: `augmentations` key is used for all of the `apply_parallel` methods
+    parallel_targets = {
+        'load_cubes': 'threads',
+        'normalize': 'threads',
+        'create_masks': 'threads',
     }
+    default_target = 'for'
+    # Number of threads: if not set, the number of available cores, but no more than the batch size
+    n_workers = None
+
+    @property
+    def dataset(self):
+        """ Dataset of the pipeline, if it is set in the current thread, or the one stored in the batch otherwise. """
+        pipeline = getattr(self._local, 'pipeline', None)
+        if pipeline is not None:
+            return pipeline.dataset
+        return self._dataset
+
+    @property
+    def apply_defaults(self):
+        """ Defaults for :meth:`~.Batch.apply_parallel`, that are used by all of the augmentations. """
+        return {
+            'target': self.get_parallel_target('augmentations'),
+            'post': '_assemble',
+            'n_workers': self.get_n_workers(),
+        }
+
+    def get_parallel_target(self, name):
+        """ Parallelization engine of an action: either `threads` or `for`. """
+        return self.parallel_targets.get(name, self.default_target)
+
+    def get_n_workers(self):
+        """ Number of threads to process batch items with. """
+        if self.n_workers is not None:
+            return self.n_workers
+        try:
+            cpu_count = len(os.sched_getaffinity(0))
+        except AttributeError:
+            cpu_count = os.cpu_count()
+        return max(1, min(cpu_count, len(self)))
 
 
     def _init_component(self, *args, **kwargs):
@@ -233,37 +307,90 @@ class SeismicCropBatch(Batch):
 
     # Loading of cube data and its derivatives
     @action
-    @inbatch_parallel(init='indices', post='_assemble', target='for')
-    def load_cubes(self, ix, dst, slicing='custom', src_geometry='geometries', **kwargs):
+    def load_cubes(self, dst, slicing='custom', src_geometry='geometries', normalize=None, dtype=None, **kwargs):
         """ Load data from cube for stored `locations`.
+        With `custom` slicing, crops of each geometry are loaded at once by :meth:`~.SeismicGeometry.load_crops`:
+        slides, shared by multiple crops of the batch, are read and decompressed only once.
 
         Parameters
         ----------
         dst : str
             Component of batch to put loaded crops in.
         slicing : str
-            If 'custom', use `load_crop` method to make crops.
+            If 'custom', use `load_crops` method to make crops.
             if 'native', crop will be looaded as a slice of geometry. Prefered for 3D crops to speed up loading.
         src_geometry : str
             Dataset attribute with geometries dict.
+        normalize : None, bool or str
+            If provided, then crops are normalized with geometry-wide stats while being loaded:
+            that is faster than a separate :meth:`.normalize` action, as no intermediate arrays are created.
+            See :meth:`~.SeismicGeometry.normalize` for available modes. Used only with `custom` slicing.
+        dtype : np.dtype, optional
+            Dtype of loaded crops, for example, `np.float16`. Default is `float32`. Used only with `custom` slicing.
+        target : str, optional
+            If 'threads', then crops are loaded by `n_workers` threads: with `custom` slicing, they are passed to
+            `load_crops` as `num_threads`. Default is taken from :attr:`.parallel_targets`.
+            With `native` slicing, crops of SEG-Y geometries are always loaded sequentially.
+        n_workers : int, optional
+            Number of threads to use. Default is :meth:`.get_n_workers`.
         """
+        target = kwargs.pop('target', self.get_parallel_target('load_cubes'))
+        n_workers = kwargs.pop('n_workers', self.get_n_workers())
+
+        if slicing == 'native':
+            #pylint: disable=unexpected-keyword-arg
+            # Handlers of SEG-Y files are not safe to use from multiple threads at once
+            if any(self._get_geometry(ix, src_geometry).format in SeismicGeometry.SEGY_ALIASES for ix in self.indices):
+                target = 'for'
+            return self._load_cubes_native(dst=dst, src_geometry=src_geometry, target=target, n_workers=n_workers)
+        if slicing != 'custom':
+            raise ValueError(f"slicing must be 'native' or 'custom' but {slicing} were given.")
+
+        # Preallocate crops: one array for crops of the same shape, or an array of separate arrays otherwise
+        dtype = dtype or np.float32
+        locations = [self.get(ix, 'locations') for ix in self.indices]
+        shapes = [tuple(slc.stop - slc.start for slc in location) for location in locations]
+        if len(set(shapes)) == 1:
+            crops = np.empty((len(locations), *shapes[0]), dtype=dtype)
+        else:
+            crops = np.empty(len(locations), dtype=object)
+            for i, shape in enumerate(shapes):
+                crops[i] = np.empty(shape, dtype=dtype)
+
+        # Group items of the batch by geometries
+        groups = {}
+        for i, ix in enumerate(self.indices):
+            geometry = self._get_geometry(ix, src_geometry)
+            groups.setdefault(id(geometry), (geometry, []))[1].append(i)
+
+        if target in ['threads', 't']:
+            kwargs.setdefault('num_threads', n_workers)
+
+        for geometry, positions in groups.values():
+            geometry.load_crops([locations[i] for i in positions], out=[crops[i] for i in positions],
+                                normalize=normalize, **kwargs)
+
+        setattr(self, dst, crops)
+        return self
+
+    @configurable_parallel(init='indices', post='_assemble')
+    def _load_cubes_native(self, ix, dst, src_geometry='geometries'):
+        """ Load crop for one item as a slice of geometry. """
+        _ = dst
+        geometry = self._get_geometry(ix, src_geometry)
+        location = self.get(ix, 'locations')
+        return geometry[tuple(location)]
+
+    def _get_geometry(self, ix, src_geometry='geometries'):
+        """ Geometry of an item. """
         geometry = self.get(ix, src_geometry)
         # target geometry is created by `create_labels` and wrapped into a list
         if isinstance(geometry, (list, tuple)) and len(geometry) > 0:
             geometry = geometry[0]
-
-        location = self.get(ix, 'locations')
-
-        if slicing == 'native':
-            crop = geometry[tuple(location)]
-        elif slicing == 'custom':
-            crop = geometry.load_crop(location, **kwargs)
-        else:
-            raise ValueError(f"slicing must be 'native' or 'custom' but {slicing} were given.")
-        return crop
+        return geometry
 
     @action
-    @inbatch_parallel(init='indices', post='_assemble', target='for')
+    @configurable_parallel(init='indices', post='_assemble')
     def normalize(self, ix, mode=None, itemwise=False, src=None, dst=None, q=(0.01, 0.99)):
         """ Normalize values in crop.
 
@@ -309,7 +436,7 @@ class SeismicCropBatch(Batch):
 
 
     @action
-    @inbatch_parallel(init='indices', post='_assemble', target='for')
+    @configurable_parallel(init='indices', post='_assemble')
     def compute_attribute(self, ix, dst, src='images', attribute='semblance', window=10, stride=1, device='cpu'):
         """ Compute geological attribute.
 
@@ -338,7 +465,7 @@ class SeismicCropBatch(Batch):
         return result
 
     @action
-    @inbatch_parallel(init='indices', post='_assemble', target='for')
+    @configurable_parallel(init='indices', post='_assemble')
     def load_attribute(self, ix, dst, src_attribute=None, final_ndim=3, src_labels='labels', **kwargs):
         """ Load attribute for depth-nearest label and crop in given locations.
 
@@ -373,7 +500,7 @@ class SeismicCropBatch(Batch):
 
     # Loading of labels
     @action
-    @inbatch_parallel(init='indices', post='_assemble', target='for')
+    @configurable_parallel(init='indices', post='_assemble')
     def create_masks(self, ix, dst, use_labels='all', width=3, src_labels='labels'):
         """ Create masks from labels in stored `locations`.
 
@@ -419,8 +546,8 @@ class SeismicCropBatch(Batch):
 
     # More methods to work with labels
     @action
-    @inbatch_parallel(init='indices', post='_post_mask_rebatch', target='for',
-                      src='masks', threshold=0.8, passdown=None, axis=-1)
+    @configurable_parallel(init='indices', post='_post_mask_rebatch',
+                           src='masks', threshold=0.8, passdown=None, axis=-1)
     def mask_rebatch(self, ix, src='masks', threshold=0.8, passdown=None, axis=-1):
         """ Remove elements with masks area lesser than a threshold.
 
@@ -460,7 +587,7 @@ class SeismicCropBatch(Batch):
 
 
     @action
-    @inbatch_parallel(init='_init_component', post='_assemble', target='for')
+    @configurable_parallel(init='_init_component', post='_assemble')
     def filter_out(self, ix, src=None, dst=None, mode=None, expr=None, low=None, high=None, length=None, p=1.0):
         """ Zero out mask for horizon extension task.
         TODO: rethink
@@ -659,7 +786,7 @@ class SeismicCropBatch(Batch):
 
     # Predictions
     @action
-    @inbatch_parallel(init='indices', post=None, target='for')
+    @configurable_parallel(init='indices', post=None)
     def update_accumulator(self, ix, src, accumulator):
         """ Update accumulator with data from crops.
         Allows to gradually accumulate predicitons in a single instance, instead of
@@ -680,7 +807,7 @@ class SeismicCropBatch(Batch):
         return self
 
     @action
-    @inbatch_parallel(init='indices', target='for', post='_masks_to_horizons_post')
+    @configurable_parallel(init='indices', post='_masks_to_horizons_post')
     def masks_to_horizons(self, ix, src_masks='masks', dst='predicted_labels',
                           threshold=0.5, mode='mean', minsize=0, mean_threshold=2.0,
                           adjacency=1, skip_merge=False, prefix='predict'):
@@ -1102,9 +1229,12 @@ class SeismicCropBatch(Batch):
         slices = tuple(slice(start, start+length) for start, length in zip(corner, shape))
         return crop[slices]
 
-    @apply_parallel
+    @apply_parallel(target='for')
     def translate(self, crop, shift=5, scale=0.0):
-        """ Add and multiply values by uniformly sampled values. """
+        """ Add and multiply values by uniformly sampled values.
+        Values are sampled from the batch random generator, which is not available in worker threads:
+        so, crops are processed sequentially.
+        """
         shift = self.random.uniform(-shift, shift)
         scale = self.random.uniform(1-scale, 1+scale)
         return (crop + shift)*scale
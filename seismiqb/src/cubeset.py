@@ -13,7 +13,7 @@ from .geometry import SeismicGeometry
 from .horizon import Horizon
 from .plotters import plot_image, show_3d
 from .crop_batch import SeismicCropBatch
-from .utility_classes import IndexedDict
+from .utility_classes import IndexedDict, SharedMemoryCache, SHARED_MEMORY_AVAILABLE
 from .utils import fill_defaults
 
 
@@ -208,6 +208,24 @@ class SeismicCubeset(Dataset):
                 cached_attr = cached_attr if isinstance(cached_attr, list) else [cached_attr]
                 _ = [item.reset_cache() for item in cached_attr]
 
+    def create_shared_cache(self, nbytes):
+        """ Create a :class:`.SharedMemoryCache` of `nbytes` size and use it for slides of all geometries.
+        Slides, decoded by one of the processes (for example, pipeline prefetch workers), are reused by others.
+        The cache should be removed with its `unlink` method after the work is done.
+        If shared memory is not available on the system, geometries keep their own caches and None is returned.
+        """
+        if not SHARED_MEMORY_AVAILABLE:
+            warn('Shared memory cache requires Python 3.8+ and a POSIX system: slides are cached in each process.')
+            return None
+
+        slot_nbytes = max(geometry.max_slide_nbytes for geometry in self.geometries.values())
+        shared_cache = SharedMemoryCache(nbytes=nbytes, slot_nbytes=slot_nbytes)
+
+        for geometry in self.geometries.values():
+            geometry.reset_cache()
+            geometry.shared_cache = shared_cache
+        return shared_cache
+
 
     # Default pipeline and batch for fast testing / introspection
     def data_pipeline(self, sampler, batch_size=4):
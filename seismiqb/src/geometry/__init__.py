@@ -1,3 +1,5 @@
 """ Geometry with automated choice of used format. """
 from .base import SeismicGeometry
 from .blosc import BloscFile
+from .bricked import BrickFile
+from .memmap import MemmapFile
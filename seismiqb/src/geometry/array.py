@@ -58,5 +58,39 @@ class SeismicGeometryArray(SeismicGeometryHDF5):
             traces = self.array[nonzero_indices[0][::step_traces], nonzero_indices[1][::step_traces]]
 
             self.v_q01, self.v_q99 = np.quantile(traces, [0.01, 0.99])
+            self.v_min, self.v_max = np.min(traces), np.max(traces)
+            self.v_mean, self.v_std = np.mean(traces), np.std(traces)
 
             self.has_stats = True
+        self.quantized = False
+
+    # Data is already in memory: slice it directly, without the slide cache
+    load_crops = SeismicGeometry.load_crops
+
+    def load_crop(self, locations, out=None, normalize=None, **kwargs):
+        """ Load 3D crop from the array.
+
+        Parameters
+        ----------
+        locations : sequence of slices
+            Location to load: slices along the first index, the second, and depth.
+        out : ndarray, optional
+            Preallocated array to write the crop into. Its dtype is used for the output: for example, `float16`.
+        normalize : None, bool or str
+            If provided, then crop is normalized in the same pass over data as the cast to the output dtype:
+            see :meth:`~.SeismicGeometry.normalize` for available modes.
+        """
+        _ = kwargs
+        locations, _, _ = self.process_key(locations)
+        crop = self.array[tuple(locations)]
+
+        if out is not None or normalize:
+            return self.postprocess_crop(crop, out=out, normalize=normalize, locations=locations)
+        # Slices of the array are views: copy, so that the data in memory can't be changed through the crop
+        return np.array(crop)
+
+    def load_slide(self, loc, axis='iline', **kwargs):
+        """ Load desired slide along desired axis. """
+        _ = kwargs
+        locations = self.make_slide_locations(loc, axis)
+        return self.load_crop(locations).squeeze(axis=self.parse_axis(axis))
@@ -10,8 +10,8 @@ import h5py
 
 from .export import ExportMixin
 
-from ..utils import file_print, get_environ_flag
-from ..utility_classes import lru_cache
+from ..utils import file_print, get_environ_flag, fused_normalize
+from ..utility_classes import lru_cache, QuantileSketch
 from ..plotters import plot_image
 
 
@@ -91,7 +91,9 @@ class SeismicGeometry(ExportMixin):
         - `segy`
         - `hdf5` and its quantized version `qhdf5`
         - `blosc` and its quantized version `qblosc`
-    The last two are created by converting the original SEG-Y cube.
+        - `brick` and its quantized version `qbrick`: single copy of the cube, split into compressed 3D bricks
+        - `memmap` and its quantized version `qmemmap`: directory with raw `.npy` projections, opened as memory maps
+    The last four are created by converting the original SEG-Y cube.
     During the conversion, an extra step of `int8` quantization can be performed to reduce the disk usage.
 
     Independent of the exact format, `SeismicGeometry` provides the following:
@@ -99,7 +101,8 @@ class SeismicGeometry(ExportMixin):
         as well as exact values of file-wide headers, for example, `delay` and `sample_rate`.
 
         - Ability to infer information about the cube amplitudes:
-          `trace_container` attribute contains examples of amplitudes inside the cube and allows to compute statistics.
+          `v_sketch` attribute contains a mergeable sketch of the distribution of all amplitudes inside the cube,
+          which is used to estimate quantiles; `trace_container` attribute optionally contains examples of amplitudes.
 
         - If needed, spatial stats can also be inferred: attributes `min_matrix`, `mean_matrix`, etc
           allow creating a complete spatial map (that is a view from above) of the desired statistic for the whole cube.
@@ -108,7 +111,10 @@ class SeismicGeometry(ExportMixin):
 
         - `load_slide` (2D entity) or `load_crop` (3D entity) methods to load data from the cube.
           Load slides takes a number of slide and axis to cut along; makes use of `lru_cache` to work
-          faster for subsequent loads. Cache is bound for each instance.
+          faster for subsequent loads. Cache is bound for each instance, unless the global byte budget is set with
+          the `SEISMIQB_CACHE_BYTES` env variable: then the total size of cached slides of all geometries is limited.
+          If `shared_cache` is set to a :class:`~.SharedMemoryCache`, then slides are cached in shared memory instead,
+          so that processes (for example, pipeline prefetch workers) don't decode the same slides again.
           Load crops works off of complete location specification (3D slice).
 
         - `quality_map` attribute is a spatial matrix that estimates cube hardness;
@@ -123,7 +129,8 @@ class SeismicGeometry(ExportMixin):
     Parameters
     ----------
     path : str
-        Path to seismic cube. Supported formats are `segy`, `hdf5`, `qhdf5`, `blosc` `qblosc`.
+        Path to seismic cube. Supported formats are `segy`, `hdf5`, `qhdf5`, `blosc` `qblosc`, `brick`, `qbrick`,
+        `memmap`, `qmemmap`.
     path_meta : str, optional
         Path to pre-computed statistics. If not provided, use the same as `path` with `.meta` extension.
     process : bool
@@ -137,6 +144,8 @@ class SeismicGeometry(ExportMixin):
     SEGY_ALIASES = ['sgy', 'segy', 'seg']
     HDF5_ALIASES = ['hdf5', 'qhdf5']
     BLOSC_ALIASES = ['blosc', 'qblosc']
+    BRICK_ALIASES = ['brick', 'qbrick']
+    MEMMAP_ALIASES = ['memmap', 'qmemmap']
     NPZ_ALIASES = ['npz']
     ARRAY_ALIASES = ['dummyarray']
 
@@ -159,12 +168,13 @@ class SeismicGeometry(ExportMixin):
 
         # Parameters of quantization and quantized stats
         'qnt_ranges', 'qnt_bins', 'qnt_clip', 'qnt_center', 'qnt_error',
+        'qnt_mode', 'qnt_scales', 'qnt_step', 'qnt_rmse', 'qnt_max_error',
         'qnt_min', 'qnt_max', 'qnt_mean', 'qnt_std',
         'qnt_q001', 'qnt_q01', 'qnt_q05', 'qnt_q95', 'qnt_q99', 'qnt_q999',
     ]
 
     PRESERVED_LAZY = [ # loaded at the time of the first access
-        'trace_container', 'hist_matrix',
+        'trace_container', 'v_sketch', 'hist_matrix',
         'min_matrix', 'max_matrix', 'mean_matrix', 'std_matrix',
     ]
 
@@ -195,6 +205,12 @@ class SeismicGeometry(ExportMixin):
         elif fmt in cls.BLOSC_ALIASES:
             from .blosc import SeismicGeometryBLOSC
             new_cls = SeismicGeometryBLOSC
+        elif fmt in cls.BRICK_ALIASES:
+            from .bricked import SeismicGeometryBricked
+            new_cls = SeismicGeometryBricked
+        elif fmt in cls.MEMMAP_ALIASES:
+            from .memmap import SeismicGeometryMemmap
+            new_cls = SeismicGeometryMemmap
         elif fmt in cls.NPZ_ALIASES:
             from .npz import SeismicGeometryNPZ
             new_cls = SeismicGeometryNPZ
@@ -207,9 +223,10 @@ class SeismicGeometry(ExportMixin):
         instance = super().__new__(new_cls)
         return instance
 
-    def __init__(self, path, *args, process=True, path_meta=None, **kwargs):
+    def __init__(self, path, *args, process=True, path_meta=None, shared_cache=None, **kwargs):
         _ = args
         self.path = path
+        self.shared_cache = shared_cache
         self.anonymize = get_environ_flag('SEISMIQB_ANONYMIZE')
 
         # Names of different lengths and format: helpful for outside usage
@@ -269,9 +286,13 @@ class SeismicGeometry(ExportMixin):
 
 
     # Meta information: storing / retrieving attributes
-    def store_meta(self, path=None):
-        """ Store collected stats on disk. Uses either provided `path` or `path_meta` attribute. """
+    def store_meta(self, path=None, **kwargs):
+        """ Store collected stats on disk. Uses either provided `path` or `path_meta` attribute.
+        Values of `kwargs` are stored instead of the same attributes of the instance; None values are not stored.
+        """
         path_meta = path or self.path_meta
+        attributes = {attr: getattr(self, attr, None) for attr in self.PRESERVED + self.PRESERVED_LAZY}
+        attributes.update((key, value) for key, value in kwargs.items() if key in attributes)
 
         # Remove file, if exists: h5py can't do that
         if os.path.exists(path_meta):
@@ -280,10 +301,10 @@ class SeismicGeometry(ExportMixin):
         # Create file and datasets inside
         with h5py.File(path_meta, "a") as file_meta:
             # Save all the necessary attributes to the `info` group
-            for attr in self.PRESERVED + self.PRESERVED_LAZY:
+            for attr, value in attributes.items():
                 try:
-                    if hasattr(self, attr) and getattr(self, attr) is not None:
-                        file_meta['/info/' + attr] = getattr(self, attr)
+                    if value is not None:
+                        file_meta['/info/' + attr] = value
                 except ValueError:
                     # Raised when you try to store post-stack descriptors for pre-stack cube
                     pass
@@ -347,7 +368,50 @@ class SeismicGeometry(ExportMixin):
             crop = np.squeeze(crop, axis=tuple(squeeze))
         return crop
 
-    def normalize(self, array, mode=None):
+    def load_crops(self, locations, out=None, normalize=None, dtype=np.float32, num_threads=None, **kwargs):
+        """ Load multiple crops at once. Child classes may re-implement it to read the data, shared by crops, once.
+
+        Parameters
+        ----------
+        locations : sequence
+            Locations of crops: each of them is a sequence of slices along the first index, the second, and depth.
+        out : ndarray or sequence of ndarrays, optional
+            Preallocated array of `(len(locations), *crop_shape)` shape, or a sequence of arrays for each crop.
+            If not provided, then crops must be of the same shape.
+        normalize : None, bool or str
+            If provided, then crops are normalized while being loaded: see :meth:`.normalize` for available modes.
+        dtype : np.dtype
+            Dtype of the created `out` array.
+        num_threads : int, optional
+            Not used: crops are loaded one by one, as not every storage can be read from multiple threads.
+            Child classes with thread-safe reads use it to load crops in parallel.
+        kwargs : dict
+            Passed directly to :meth:`.load_crop`.
+        """
+        _ = num_threads
+        locations = [self.process_key(location)[0] for location in locations]
+        out = self.make_crops_buffer(locations, out=out, dtype=dtype)
+
+        for location, crop_out in zip(locations, out):
+            crop = self.load_crop(location, out=crop_out, normalize=normalize, **kwargs)
+            if crop is not crop_out:
+                crop_out[...] = crop
+        return out
+
+    @staticmethod
+    def make_crops_buffer(locations, out=None, dtype=np.float32):
+        """ Create an array for crops of the same shape, if `out` is not provided, or check the given one. """
+        if out is not None:
+            if len(out) != len(locations):
+                raise ValueError(f'Expected {len(locations)} arrays in `out`, got {len(out)} instead!')
+            return out
+
+        shapes = {tuple(slc.stop - slc.start for slc in location) for location in locations}
+        if len(shapes) != 1:
+            raise ValueError(f'Crops must be of the same shape to be loaded into one array, got {shapes} instead!')
+        return np.empty((len(locations), *shapes.pop()), dtype=dtype)
+
+    def normalize(self, array, mode=None, out=None):
         """ Normalize array of values cut from the cube.
         Constants are computed from the entire volume.
         Constants for normalization are automatically chosen depending on the quantization of the cube.
@@ -364,28 +428,147 @@ class SeismicGeometry(ExportMixin):
             maximum of absolute values of the 0.01 and 0.99 quantiles.
             If `q_clip`, then data is clipped to 0.01 and 0.99 quantiles and then divided
             by the maximum of absolute values of the two.
+        out : ndarray, optional
+            If provided, then normalized values are written into it, and the cast to its dtype,
+            clipping, shifting and scaling are done in a single pass without intermediate arrays.
+        """
+        shift, divisor, clip = self.normalization_parameters(mode)
+
+        if out is not None:
+            return self.fused_normalize(array, out, shift, divisor, clip)
+
+        if clip is not None:
+            array = np.clip(array, *clip)
+        if shift:
+            array = array - shift
+        return array / divisor
+
+    def normalization_parameters(self, mode=None):
+        """ Constants of normalization in a given mode: shift, divisor and optional clipping range.
+        Normalized array is `(clip(array) - shift) / divisor`. See :meth:`.normalize` for the description of modes.
         """
         if mode is None or mode == 'auto':
             mode = 'std' if self.quantized else 'q'
 
         if mode == 'std':
-            return array / (self.qnt_std if self.quantized else self.v_std)
+            return 0, (self.qnt_std if self.quantized else self.v_std), None
         if mode == 'meanstd':
-            array -= self.qnt_mean if self.quantized else self.v_mean
-            return array / (self.qnt_std if self.quantized else self.v_std)
+            mean = self.qnt_mean if self.quantized else self.v_mean
+            return mean, (self.qnt_std if self.quantized else self.v_std), None
 
-        if mode == 'q':
-            return array / max(abs(self.v_q01), abs(self.v_q99))
+        if mode in ['q', 'normalize']:
+            return 0, max(abs(self.v_q01), abs(self.v_q99)), None
         if mode == 'q_clip':
-            array = np.clip(array, self.v_q01, self.v_q99)
-            return array / max(abs(self.v_q01), abs(self.v_q99))
+            return 0, max(abs(self.v_q01), abs(self.v_q99)), (self.v_q01, self.v_q99)
 
         if mode == 'minmax':
             min_ = self.qnt_min if self.quantized else self.v_min
             max_ = self.qnt_max if self.quantized else self.v_max
-            return (array - min_) / (max_ - min_)
+            return min_, float(max_) - float(min_), None
         raise ValueError('Wrong mode', mode)
 
+    @staticmethod
+    def fused_normalize(array, out, shift=0, divisor=1, clip=None):
+        """ Write `(clip(array) - shift) / divisor` into `out` without intermediate arrays. """
+        clip_min, clip_max = clip if clip is not None else (0, 0)
+
+        if out.dtype == np.float32 and array.dtype != np.float16 and array.ndim == 3:
+            return fused_normalize(array, out, np.float32(shift), np.float32(divisor),
+                                   np.float32(clip_min), np.float32(clip_max), clip is not None)
+
+        # Other dtypes (for example, `float16`) are not supported by `numba`: compute in `float32`, cast on write
+        if clip is not None:
+            np.clip(array, clip_min, clip_max, out=out, dtype=np.float32, casting='unsafe')
+            np.subtract(out, np.float32(shift), out=out, dtype=np.float32, casting='unsafe')
+        else:
+            np.subtract(array, np.float32(shift), out=out, dtype=np.float32, casting='unsafe')
+        np.divide(out, np.float32(divisor), out=out, dtype=np.float32, casting='unsafe')
+        return out
+
+    def dequantize(self, array, ilines=slice(None), out=None):
+        """ Convert values, loaded from the storage, to `float32`.
+        Data, stored with `int16` (with per-iline scales) or `bounded` quantization, is restored to amplitudes;
+        `int8` data is kept in the units of bins, as the normalization constants are computed for them.
+
+        Parameters
+        ----------
+        array : ndarray
+            Loaded data, with ilines along the first axis, or a single iline slide.
+        ilines : slice or int
+            Ilines of the `array`.
+        out : ndarray, optional
+            Array to write the result into.
+        """
+        if array.dtype == np.int16:
+            # Strings are loaded from the meta as bytes
+            qnt_mode = self.qnt_mode.decode('ascii') if isinstance(self.qnt_mode, bytes) else self.qnt_mode
+            if qnt_mode == 'int16':
+                scale = np.asarray(self.qnt_scales[ilines], dtype=np.float32)
+                scale = scale.reshape(-1, *[1] * (array.ndim - 1)) if scale.ndim else scale
+            else:
+                scale = np.float32(self.qnt_step)
+            return np.multiply(array, scale, out=out, dtype=np.float32, casting='unsafe')
+
+        if array.dtype in [np.int8, np.float16]:
+            if out is None:
+                return array.astype(np.float32)
+            np.copyto(out, array, casting='unsafe')
+            return out
+        return array
+
+    def postprocess_crop(self, crop, out=None, normalize=None, locations=None):
+        """ Convert crop, loaded from the storage, to the output one.
+        By default, quantized values are cast to `float32`.
+
+        Parameters
+        ----------
+        crop : ndarray
+            Loaded data, possibly, a transposed view of a buffer.
+        out : ndarray, optional
+            Preallocated array to write the result into: its dtype is used for the output, for example, `float16`.
+        normalize : None, bool or str
+            If provided, then crop is also normalized in the same pass: see :meth:`.normalize` for available modes.
+            If True, then the `auto` mode is used.
+        locations : sequence of slices, optional
+            Location of the crop: used to get per-iline scales of `int16` quantization.
+        """
+        ilines = locations[0] if locations is not None else slice(None)
+        if out is None and not normalize:
+            return self.dequantize(crop, ilines=ilines)
+
+        if out is None:
+            out = np.empty(crop.shape, dtype=np.float32)
+
+        # Per-iline scales can't be fused with normalization: restore amplitudes first, then normalize in-place
+        if crop.dtype == np.int16:
+            crop = self.dequantize(crop, ilines=ilines, out=out)
+        if normalize:
+            return self.normalize(crop, mode=None if normalize is True else normalize, out=out)
+        return self.fused_normalize(crop, out)
+
+    def restore_amplitudes(self, array):
+        """ Convert data, loaded from the cube, to the original amplitudes.
+        Only `int8` quantized data needs that, as other modes are restored by :meth:`.dequantize` on load.
+        Values in the units of bins are replaced with the edges of these bins, so the result is approximate.
+        """
+        if not self.quantized:
+            return array
+
+        restored = self.qnt_bins[np.asarray(array).astype(np.int16) + 127].astype(np.float32)
+        if self.qnt_center:
+            restored += np.float32(self.v_mean)
+        return restored
+
+
+    @property
+    def value_sample(self):
+        """ Sample of amplitudes, representing their distribution in the whole cube.
+        Values at uniformly spaced quantiles of `v_sketch`, if it is available, or `trace_container` otherwise.
+        """
+        if self.v_sketch is not None:
+            return QuantileSketch.from_array(self.v_sketch).sample()
+        return self.trace_container
+
 
     # Spatial matrices
     @property
@@ -484,9 +667,15 @@ class SeismicGeometry(ExportMixin):
             method = self._cached_load
         method.reset(instance=self)
 
+        if self.shared_cache is not None:
+            self.shared_cache.clear(namespace=self.path)
+
     @property
     def cache_length(self):
         """ Total amount of cached slides. """
+        if self.shared_cache is not None:
+            return self.shared_cache.stats(namespace=self.path)['length']
+
         if self.structured is False:
             method = self.load_slide
         else:
@@ -497,6 +686,9 @@ class SeismicGeometry(ExportMixin):
     @property
     def cache_size(self):
         """ Total size of cached slides. """
+        if self.shared_cache is not None:
+            return self.shared_cache.stats(namespace=self.path)['bytes'] / (1024 ** 3)
+
         if self.structured is False:
             method = self.load_slide
         else:
@@ -504,6 +696,28 @@ class SeismicGeometry(ExportMixin):
 
         return sum(item.nbytes / (1024 ** 3) for item in method.cache()[self].values())
 
+    @property
+    def cache_stats(self):
+        """ Cache counters of the instance: hits, misses, evictions and total size of cached slides in bytes.
+        If the global byte budget is active (see `SEISMIQB_CACHE_BYTES`), evictions may be caused by other geometries.
+        """
+        if self.structured is False:
+            method = self.load_slide
+        else:
+            method = self._cached_load
+
+        stats = dict(method.stats()[self])
+        if self.shared_cache is not None:
+            shared_stats = self.shared_cache.stats(namespace=self.path)
+            stats['bytes'] = shared_stats['bytes']
+            stats['shared'] = shared_stats
+        return stats
+
+    @property
+    def max_slide_nbytes(self):
+        """ Size of the biggest slide of the cube, decoded to `float32`: used as a slot size for shared caches. """
+        return int(np.prod(sorted(self.cube_shape)[1:])) * max(np.dtype(getattr(self, 'dtype', np.float32)).itemsize, 4)
+
 
     # Properties
     @property
@@ -538,8 +752,8 @@ class SeismicGeometry(ExportMixin):
         """ Total amount of traces in a cube. """
         if hasattr(self, 'zero_traces'):
             return np.prod(self.zero_traces.shape)
-        if hasattr(self, 'dataframe'):
-            return len(self.dataframe)
+        if getattr(self, 'header_columns', None) is not None:
+            return len(next(iter(self.header_columns.values())))
         return self.cube_shape[0] * self.cube_shape[1]
 
     def __len__(self):
@@ -558,7 +772,7 @@ class SeismicGeometry(ExportMixin):
         """ Size of instance in bytes. """
         names = set()
         if self.structured is False:
-            names.add('dataframe')
+            names.update({'_dataframe', 'index_matrix'})
             if self.has_stats:
                 names.add('trace_container')
                 names.add('zero_traces')
@@ -664,8 +878,8 @@ class SeismicGeometry(ExportMixin):
         return plot_image(matrix, **kwargs)
 
     def show_histogram(self, normalize=None, bins=50, **kwargs):
-        """ Show distribution of amplitudes in `trace_container`. Optionally applies chosen normalization. """
-        data = np.copy(self.trace_container)
+        """ Show distribution of amplitudes in `value_sample`. Optionally applies chosen normalization. """
+        data = np.copy(self.value_sample)
         if normalize:
             data = self.normalize(data, mode=normalize)
 
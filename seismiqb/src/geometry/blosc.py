@@ -1,6 +1,7 @@
 """ Blosc sliced geometry. """
 #pylint: disable=unpacking-non-sequence
 import os
+import json
 from zipfile import ZipFile, BadZipFile
 
 import dill
@@ -8,12 +9,372 @@ import blosc
 import numpy as np
 
 from .converted import SeismicGeometryConverted
+from ..utility_classes import PositionalReader
 
 
 
 class BloscFile:
-    """ Blosc file with slices.
-    To make it a single file, `ZipFile` is used.
+    """ Blosc file with slices, stored as a single indexed file.
+    The inner structure is as follows:
+        - fixed-size binary header with magic bytes, version of the layout and the position of the index
+        - raw `blosc`-compressed chunks, in the order of writing
+        - index: `JSON` with names, shapes, dtypes and block shapes of datasets, followed by the table of
+          `(dataset, slide, block, offset, length)` records for each of the written chunks
+
+    Each slide can be stored as a grid of independently compressed sub-blocks of `block_shape`:
+    that allows to decompress only the overlapping blocks, when a small window of a slide is requested.
+    By default, the whole slide is stored as one block.
+    Files of previous version of the layout (`2`, without blocks) are read as well.
+
+    The index is stored on `close`. In the `a` mode, new datasets and slides are appended to an existing file.
+    Slides can be written multiple times (for example, by `AccumulatorBlosc`):
+    the last written version is used for reading, and :meth:`.repack` can be used to aggregate all of them.
+
+    Reads are done with :class:`~.PositionalReader` at known offsets: no per-slide headers are needed,
+    so the same instance can be safely used from multiple threads and forked processes.
+
+    Semantics and namings are the same, as in `h5py` to provide identical API:
+    this way, we can make storage-agnostic code.
+    """
+    MAGIC = b'SQBLOSC\x00'
+    VERSION = 3
+    HEADER_DTYPE = np.dtype([('magic', 'S8'), ('version', '<u4'), ('reserved', '<u4'),
+                             ('index_offset', '<i8'), ('meta_length', '<i8'), ('n_records', '<i8')])
+
+    def __init__(self, path, mode='r', clevel=6, cname='lz4hc', shuffle=0, block_shape=None):
+        self.path = path
+        self.mode = mode
+        self.file, self.reader = None, None
+
+        self.clevel = clevel
+        self.cname = cname
+        self.shuffle = shuffle
+        self.block_shape = block_shape
+
+        self.key_to_dataset = {}
+        self.records = []
+        self.version = self.VERSION
+
+        if mode == 'w':
+            #pylint: disable=consider-using-with
+            self.file = open(path, 'wb')
+            self.file.write(np.zeros(1, dtype=self.HEADER_DTYPE).tobytes())
+
+        elif mode in ['r', 'a']:
+            if not self.is_indexed(path):
+                raise ValueError(f'{path} is not an indexed blosc file: use `ZipBloscFile(path).to_indexed()` first!')
+            self.open_handler()
+            header = np.frombuffer(self.reader.read(self.HEADER_DTYPE.itemsize, 0), dtype=self.HEADER_DTYPE)[0]
+            self.version = int(header['version'])
+            if self.version > self.VERSION:
+                raise ValueError(f'Version {self.version} of {path} is not supported: update the library!')
+
+            # Version 2 has no blocks: each slide is one chunk
+            n_columns = 4 if self.version == 2 else 5
+            index_offset, meta_length, n_records = header['index_offset'], header['meta_length'], header['n_records']
+            meta = json.loads(self.reader.read(meta_length, index_offset).decode('utf-8'))
+            records = self.reader.read(8 * n_columns * n_records, index_offset + meta_length)
+            records = np.frombuffer(records, dtype=np.int64).reshape(n_records, n_columns)
+            if self.version == 2:
+                records = np.insert(records, 2, 0, axis=1)
+            self.records = records
+
+            self.clevel, self.cname, self.shuffle = meta['clevel'], meta['cname'], meta['shuffle']
+            for i, (key, (shape, dtype, *extra)) in enumerate(meta['datasets'].items()):
+                dataset_records = self.records[self.records[:, 0] == i]
+                self.key_to_dataset[key] = BloscDataset(key, parent=self, shape=shape, dtype=dtype,
+                                                        block_shape=extra[0] if extra else None,
+                                                        records=dataset_records)
+
+            if mode == 'a':
+                # New chunks and index are appended after the old index, so the file stays valid until `close`
+                self.records = [tuple(record) for record in self.records]
+                #pylint: disable=consider-using-with
+                self.file = open(path, 'r+b')
+                self.file.seek(0, os.SEEK_END)
+
+    @classmethod
+    def is_indexed(cls, path):
+        """ Check whether the file at `path` has the indexed layout. """
+        with open(path, 'rb') as file:
+            return file.read(len(cls.MAGIC)) == cls.MAGIC
+
+    def open_handler(self):
+        """ Open positional reader of the file. """
+        self.reader = PositionalReader(self.path)
+
+    def repack(self, aggregation=None):
+        """ Aggregate multiple versions of the same slides. """
+        if aggregation not in [None, 'max', 'maximum', 'mean', 'average']:
+            raise ValueError(f'Unknown aggregation {aggregation}!')
+        self.close()
+        reader = BloscFile(self.path, mode='r')
+
+        path_out = self.path + '_temporal'
+        with BloscFile(path_out, mode='w', **reader.compression_parameters) as out:
+            for key, dataset in reader.key_to_dataset.items():
+                out_dataset = out.create_dataset(key, shape=dataset.shape, dtype=dataset.dtype,
+                                                 block_shape=dataset.block_shape)
+
+                for idx in np.unique(dataset.records[:, 1]):
+                    # Get all versions of duplicates
+                    slides = dataset.load_versions(idx)
+
+                    # Aggregate
+                    if aggregation is None:
+                        slide = slides[0]
+                    elif aggregation in ['max', 'maximum']:
+                        slide = np.maximum.reduce(slides)
+                    else:
+                        slide = np.mean(slides, axis=0)
+
+                    out_dataset[int(idx)] = slide
+        reader.close()
+
+        os.replace(path_out, self.path)
+        return BloscFile(self.path, mode='r')
+
+    # Utilities
+    def namelist(self):
+        """ Contents of the file. """
+        keys = list(self.key_to_dataset)
+        return [f'{keys[dataset]}/{idx}' for dataset, idx, block, _, _ in self.records if block == 0]
+
+    def __len__(self):
+        return len(self.namelist())
+
+
+    def __contains__(self, key):
+        """ Check if projections is available. """
+        return key in self.key_to_dataset
+
+    def __repr__(self):
+        return f'BloscFile for {self.path}'
+
+    @property
+    def compression_parameters(self):
+        """ Keyword arguments for `compress_array`, matching the parameters of this file. """
+        return {'clevel': self.clevel, 'cname': self.cname, 'shuffle': self.shuffle}
+
+
+    # Inner dataset creating/indexing
+    def create_dataset(self, key, shape, dtype, block_shape=None):
+        """ Create a dataset of a given name. Shape, dtype and shape of blocks are stored in the index.
+        If `block_shape` is not provided, the default one of the file is used.
+        """
+        dataset = BloscDataset(key, parent=self, shape=shape, dtype=dtype, block_shape=block_shape or self.block_shape)
+        self.key_to_dataset[key] = dataset
+        return dataset
+
+    def __getitem__(self, key):
+        """ Get existing `BloscDataset` instance by key. """
+        dataset = self.key_to_dataset.get(key)
+        if dataset:
+            return dataset
+        raise KeyError(f'Dataset {key} does not exist!')
+
+    def write(self, key, idx, chunks):
+        """ Append compressed `chunks` (one for each block) of slide `idx` of dataset `key` to the file. """
+        dataset = list(self.key_to_dataset).index(key)
+        for block, data in enumerate(chunks):
+            offset = self.file.tell()
+            self.file.write(data)
+            self.records.append((dataset, idx, block, offset, len(data)))
+
+
+    # Instance manager
+    def close(self):
+        """ Store the index, if the file is written, and close it.
+        Unlike most other file formats in Python, actually needed: without that, file becomes corrupted.
+        """
+        if self.file is not None:
+            meta = {'datasets': {key: (list(map(int, dataset.shape)), np.dtype(dataset.dtype).str,
+                                       list(map(int, dataset.block_shape)))
+                                 for key, dataset in self.key_to_dataset.items()},
+                    **self.compression_parameters}
+            meta = json.dumps(meta).encode('utf-8')
+            records = np.array(self.records, dtype=np.int64).reshape(-1, 5)
+
+            header = np.zeros(1, dtype=self.HEADER_DTYPE)
+            header['magic'], header['version'] = self.MAGIC, self.VERSION
+            header['index_offset'] = self.file.tell()
+            header['meta_length'], header['n_records'] = len(meta), len(records)
+
+            self.file.write(meta)
+            self.file.write(records.tobytes())
+            self.file.seek(0)
+            self.file.write(header.tobytes())
+            self.file.close()
+            self.file = None
+
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _, __, ___):
+        self.close()
+
+    def __del__(self):
+        """ An extra safety measure for actually closing the file. """
+        self.close()
+
+    def __getstate__(self):
+        """ File handlers are not transferable between processes: re-open the file instead. """
+        state = self.__dict__.copy()
+        state['reader'], state['file'] = None, None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__ = state
+        if self.mode == 'r':
+            self.open_handler()
+
+
+class BloscDataset:
+    """ A dataset inside `BloscFile`: table of offsets and lengths of blocks of its slides.
+    Contains a reference to the original `BloscFile`.
+
+    Indexing with an integer returns the whole slide; indexing with `(loc, slice, slice)` key returns
+    a window of a slide, decompressing only the blocks, that overlap with it.
+    """
+    def __init__(self, key, parent, shape, dtype, block_shape=None, records=None):
+        self.key = key
+        self.parent = parent
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+
+        # Grid of blocks in each slide
+        slide_shape = np.array(self.shape[1:])
+        self.block_shape = tuple(np.minimum(block_shape, slide_shape) if block_shape is not None else slide_shape)
+        self.grid_shape = tuple(-(-slide_shape // self.block_shape))
+        self.n_blocks = int(np.prod(self.grid_shape))
+
+        # Offset and length of the last written version of each block; -1 for missing ones
+        self.records = records if records is not None else np.empty((0, 5), dtype=np.int64)
+        self.table = np.full((self.shape[0], self.n_blocks, 2), -1, dtype=np.int64)
+        self.table[self.records[:, 1], self.records[:, 2]] = self.records[:, 3:]
+
+    def namelist(self):
+        """ Contents of the dataset. """
+        return [f'{self.key}/{idx}' for idx in np.nonzero(self.table[:, 0, 0] >= 0)[0]]
+
+    def __repr__(self):
+        return f'<BLOSC dataset "{self.key}": shape {tuple(self.shape)}, type {self.dtype}>'
+
+    # Item management
+    def __setitem__(self, key, slide):
+        """ Compress and save slide. """
+        key = key if isinstance(key, (int, np.integer)) else key[0]
+        chunks = compress_blocks(slide, self.block_shape, **self.parent.compression_parameters)
+        self.parent.write(self.key, int(key), chunks)
+
+    def write_compressed(self, key, chunks):
+        """ Save slide, already compressed with `compress_blocks`. """
+        self.parent.write(self.key, int(key), chunks)
+
+    def __getitem__(self, key):
+        """ Read and decompress either one slide or its `(loc, slice, slice)` window. """
+        if isinstance(key, (int, np.integer)):
+            key = (key,)
+        loc, *slices = key
+        slices = [slice(*slc.indices(size)) for slc, size in zip(slices + [slice(None)] * 2, self.shape[1:])]
+        return self.read_window(loc, *slices)
+
+    def read_window(self, loc, slice_0, slice_1, load_block=None):
+        """ Assemble a window of slide `loc` from overlapping blocks.
+
+        Parameters
+        ----------
+        slice_0, slice_1 : slices
+            Window of the slide to load.
+        load_block : callable, optional
+            Function to get one block by its index; for example, a cached one. Default is :meth:`.load_block`.
+        """
+        load_block = load_block or (lambda block: self.load_block(loc, block))
+        if self.n_blocks == 1:
+            return load_block(0)[slice_0, slice_1]
+
+        window = np.empty((len(range(slice_0.start, slice_0.stop)), len(range(slice_1.start, slice_1.stop))),
+                          dtype=self.dtype)
+        for block, (block_0, block_1) in self.overlapping_blocks(slice_0, slice_1):
+            start_0, stop_0 = max(slice_0.start, block_0.start), min(slice_0.stop, block_0.stop)
+            start_1, stop_1 = max(slice_1.start, block_1.start), min(slice_1.stop, block_1.stop)
+
+            window[start_0 - slice_0.start : stop_0 - slice_0.start,
+                   start_1 - slice_1.start : stop_1 - slice_1.start] = \
+                load_block(block)[start_0 - block_0.start : stop_0 - block_0.start,
+                                  start_1 - block_1.start : stop_1 - block_1.start]
+        return window
+
+    def overlapping_blocks(self, slice_0, slice_1):
+        """ Indices and locations of blocks, that overlap with a window of a slide. """
+        size_0, size_1 = self.block_shape
+        for i in range(slice_0.start // size_0, (slice_0.stop - 1) // size_0 + 1):
+            for j in range(slice_1.start // size_1, (slice_1.stop - 1) // size_1 + 1):
+                yield i * self.grid_shape[1] + j, self.block_location(i * self.grid_shape[1] + j)
+
+    def block_location(self, block):
+        """ Slices of a slide, covered by a block. """
+        i, j = divmod(block, self.grid_shape[1])
+        return (slice(i * self.block_shape[0], min((i + 1) * self.block_shape[0], self.shape[1])),
+                slice(j * self.block_shape[1], min((j + 1) * self.block_shape[1], self.shape[2])))
+
+    def load_block(self, loc, block):
+        """ Read and decompress one block of a slide. """
+        offset, length = self.table[loc, block]
+        if offset < 0:
+            raise KeyError(f'Slide {loc} is not stored in dataset {self.key}!')
+        return self.decompress(offset, length, block)
+
+    def decompress(self, offset, length, block):
+        """ Read and decompress a chunk of data into an array of block shape. """
+        location = self.block_location(block)
+        array = np.empty([slc.stop - slc.start for slc in location], dtype=self.dtype)
+        blosc.decompress_ptr(self.parent.reader.read(int(length), int(offset)), array.__array_interface__['data'][0])
+        return array
+
+    def load_versions(self, loc):
+        """ Load all of the written versions of slide `loc`. """
+        records = self.records[self.records[:, 1] == loc]
+        n_versions = np.sum(records[:, 2] == 0)
+
+        slides = []
+        for version in range(n_versions):
+            slide = np.empty(self.shape[1:], dtype=self.dtype)
+            for block in range(self.n_blocks):
+                _, _, _, offset, length = records[records[:, 2] == block][version]
+                slide[self.block_location(block)] = self.decompress(offset, length, block)
+            slides.append(slide)
+        return slides
+
+
+
+def compress_array(array, clevel=6, cname='lz4hc', shuffle=0):
+    """ Compress `NumPy` array into bytes. Module-level function, so that it can be sent to other processes. """
+    if not array.data.c_contiguous:
+        array = np.ascontiguousarray(array)
+
+    return blosc.compress_ptr(array.__array_interface__['data'][0],
+                              array.size, array.dtype.itemsize,
+                              clevel=clevel, cname=cname, shuffle=shuffle)
+
+def compress_blocks(array, block_shape=None, clevel=6, cname='lz4hc', shuffle=0):
+    """ Split 2D array into blocks of `block_shape` in C-order and compress each of them, as stored in `BloscFile`.
+    Module-level function, so that it can be sent to other processes.
+    """
+    block_shape = block_shape or array.shape
+    return [compress_array(array[i : i + block_shape[0], j : j + block_shape[1]],
+                           clevel=clevel, cname=cname, shuffle=shuffle)
+            for i in range(0, array.shape[0], block_shape[0])
+            for j in range(0, array.shape[1], block_shape[1])]
+
+
+class ZipBloscFile:
+    """ Legacy blosc file with slices, where `ZipFile` is used to make it a single file.
+    Superseded by `BloscFile`; kept to read existing files and to convert them with :meth:`.to_indexed`.
     The inner structure is as follows:
     file.blosc/
         dataset_name_0/
@@ -51,7 +412,7 @@ class BloscFile:
 
             self.key_to_dataset = {}
             for key in available_keys:
-                self.key_to_dataset[key] = BloscDataset(key, parent=self)
+                self.key_to_dataset[key] = ZipBloscDataset(key, parent=self)
 
     def open_handler(self):
         """ Open the ZipFile handler. Can be re-used when the same file is accessed from multiple processes. """
@@ -64,7 +425,7 @@ class BloscFile:
         infolist = self.zipfile.infolist()
 
         path_out = self.path + '_temporal'
-        with BloscFile(path_out, mode='w') as out:
+        with ZipBloscFile(path_out, mode='w') as out:
             for key, dataset in self.key_to_dataset.items():
                 out.create_dataset(key, shape=dataset.shape, dtype=dataset.dtype)
 
@@ -95,7 +456,31 @@ class BloscFile:
 
         os.remove(self.path)
         os.rename(out.path, self.path)
-        return BloscFile(self.path, mode='r')
+        return ZipBloscFile(self.path, mode='r')
+
+    def to_indexed(self, path=None):
+        """ Convert the file to the indexed `BloscFile` layout. Compressed data is copied as is, without re-compression.
+        If `path` is not provided, the file is replaced.
+        """
+        path_out = path or self.path + '_temporal'
+        with BloscFile(path_out, mode='w', clevel=self.clevel, cname=self.cname, shuffle=self.shuffle) as out:
+            for key, dataset in self.key_to_dataset.items():
+                out_dataset = out.create_dataset(key, shape=dataset.shape, dtype=dataset.dtype)
+
+                # Names of re-written slides are repeated in the archive: open each entry, not the name,
+                # so that all of the versions are copied in the order of writing
+                infos = [info for info in self.zipfile.infolist()
+                         if info.filename.startswith(key + '/') and '_meta' not in info.filename]
+                for info in sorted(infos, key=lambda info: int(info.filename.split('/')[1])):
+                    with self.zipfile.open(info, mode='r') as file:
+                        _ = dill.load(file)
+                        out_dataset.write_compressed(int(info.filename.split('/')[1]), [file.read()])
+
+        if path is None:
+            self.close()
+            os.replace(path_out, self.path)
+            path_out = self.path
+        return BloscFile(path_out, mode='r')
 
     # Utilities
     def namelist(self):
@@ -112,7 +497,7 @@ class BloscFile:
         return key in self.key_to_dataset
 
     def __repr__(self):
-        return f'BloscFile for {self.path}'
+        return f'ZipBloscFile for {self.path}'
 
 
     # Inner dataset creating/indexing
@@ -123,13 +508,13 @@ class BloscFile:
         with self.zipfile.open(f'{key}/_meta', mode='w') as file:
             dill.dump((shape, dtype), file)
 
-        dataset = BloscDataset(key, parent=self)
+        dataset = ZipBloscDataset(key, parent=self)
 
         self.key_to_dataset[key] = dataset
         return dataset
 
     def __getitem__(self, key):
-        """ Get existing `BloscDataset` instance by key. """
+        """ Get existing `ZipBloscDataset` instance by key. """
         dataset = self.key_to_dataset.get(key)
         if dataset:
             return dataset
@@ -155,20 +540,17 @@ class BloscFile:
 
 
     # Blosc utilities
+    @property
+    def compression_parameters(self):
+        """ Keyword arguments for `compress_array`, matching the parameters of this file. """
+        return {'clevel': self.clevel, 'cname': self.cname, 'shuffle': self.shuffle}
+
     def dump(self, array, file):
         """ Store compressed `NumPy` array to an opened file handler. Makes the data C-contigious, if it is not.
         Also stores shape and dtype of an array.
         """
-        if not array.data.c_contiguous:
-            array = np.ascontiguousarray(array)
-
-        compressed = blosc.compress_ptr(array.__array_interface__['data'][0],
-                                        array.size, array.dtype.itemsize,
-                                        clevel=self.clevel, cname=self.cname,
-                                        shuffle=self.shuffle)
-
         dill.dump((array.shape, array.dtype), file)
-        file.write(compressed)
+        file.write(compress_array(array, **self.compression_parameters))
 
     def load(self, file):
         """ Read the shape and dtype from a file, create a buffer, decompress data into it. """
@@ -189,9 +571,10 @@ class BloscFile:
 
 
 
-class BloscDataset:
-    """ A dataset inside `BloscFile`. Essentially, a subdirectory.
-    Contains a reference to the original `BloscFile`.
+
+class ZipBloscDataset:
+    """ A dataset inside `ZipBloscFile`. Essentially, a subdirectory.
+    Contains a reference to the original `ZipBloscFile`.
     """
     RETRIES = 5
     def __init__(self, key, parent):
@@ -204,7 +587,7 @@ class BloscDataset:
     def namelist(self):
         """ Contents of the dataset. """
         namelist = self.parent.namelist()
-        return [item for item in namelist if item.startswith(self.key)]
+        return [item for item in namelist if item.startswith(self.key + '/')]
 
     # Utility
     def __getattr__(self, name):
@@ -243,7 +626,8 @@ class SeismicGeometryBLOSC(SeismicGeometryConverted):
     #pylint: disable=attribute-defined-outside-init
     def process(self, **kwargs):
         """ Detect available projections in the cube and store handlers to them in attributes. """
-        self.file = BloscFile(self.path, mode='r')
+        constructor = BloscFile if BloscFile.is_indexed(self.path) else ZipBloscFile
+        self.file = constructor(self.path, mode='r')
 
         # Check available projections
         self.available_axis = [axis for axis, name in self.AXIS_TO_NAME.items()
@@ -261,3 +645,11 @@ class SeismicGeometryBLOSC(SeismicGeometryConverted):
 
         # Parse attributes from meta / set defaults
         self.add_attributes(**kwargs)
+
+    def open_file(self, mode='r'):
+        """ Re-open the underlying file in a given mode. Only indexed files can be appended to. """
+        if mode != 'r' and not isinstance(self.file, BloscFile):
+            raise ValueError(f'Legacy {self.file} can be only read: use `ZipBloscFile(path).to_indexed()` first!')
+        self.file.close()
+        self.file = BloscFile(self.path, mode=mode)
+        return self.file
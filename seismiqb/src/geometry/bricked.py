@@ -0,0 +1,284 @@
+""" Bricked (3D-tiled) geometry. """
+import os
+from itertools import product
+from collections import defaultdict
+
+import blosc
+import numpy as np
+
+from ..utility_classes import lru_cache, PositionalReader
+from .converted import SeismicGeometryConverted, run_parallel
+
+
+
+class BrickFile:
+    """ Single file with a cube, split into 3D bricks, each of them compressed with `blosc` independently.
+    The inner structure is as follows:
+        - fixed-size binary header with magic bytes, version, dtype, shape of the cube and shape of bricks
+        - table of `(offset, length)` pairs for every brick in C-order of the grid of bricks
+        - raw compressed bricks
+
+    Bricks on the far edges of the cube are not padded, so their shape is smaller.
+    Reads are done with :class:`~.PositionalReader`, so the same instance can be used from multiple threads.
+
+    File is written by slabs of ilines, aligned to bricks, with `write_slab` method;
+    table of offsets is stored on `close`.
+    """
+    MAGIC = b'SQBRICKS'
+    VERSION = 1
+    HEADER_DTYPE = np.dtype([('magic', 'S8'), ('version', '<u4'), ('dtype', 'S8'),
+                             ('shape', '<i8', (3,)), ('brick_shape', '<i8', (3,))])
+
+    def __init__(self, path, mode='r', shape=None, dtype=None, brick_shape=(64, 64, 64),
+                 clevel=6, cname='lz4hc', shuffle=0):
+        self.path = path
+        self.mode = mode
+        self.clevel = clevel
+        self.cname = cname
+        self.shuffle = shuffle
+        self.file, self.reader = None, None
+
+        if mode == 'w':
+            self.shape = np.array(shape)
+            self.dtype = np.dtype(dtype)
+            self.brick_shape = np.array(brick_shape)
+            self.grid_shape = -(-self.shape // self.brick_shape)
+            self.table = np.zeros((np.prod(self.grid_shape), 2), dtype=np.int64)
+
+            header = np.zeros(1, dtype=self.HEADER_DTYPE)
+            header['magic'], header['version'] = self.MAGIC, self.VERSION
+            header['dtype'] = self.dtype.str
+            header['shape'], header['brick_shape'] = self.shape, self.brick_shape
+
+            #pylint: disable=consider-using-with
+            self.file = open(path, 'wb')
+            self.file.write(header.tobytes())
+            self.file.write(self.table.tobytes())
+
+        elif mode == 'r':
+            self.open_handler()
+            header = np.frombuffer(self.reader.read(self.HEADER_DTYPE.itemsize, 0), dtype=self.HEADER_DTYPE)[0]
+            if header['magic'] != self.MAGIC:
+                raise ValueError(f'{path} is not a bricked file!')
+
+            self.shape = header['shape'].copy()
+            self.dtype = np.dtype(header['dtype'].decode('ascii'))
+            self.brick_shape = header['brick_shape'].copy()
+            self.grid_shape = -(-self.shape // self.brick_shape)
+
+            n_bricks = np.prod(self.grid_shape)
+            table = self.reader.read(n_bricks * 16, self.HEADER_DTYPE.itemsize)
+            self.table = np.frombuffer(table, dtype=np.int64).reshape(n_bricks, 2)
+
+    def open_handler(self):
+        """ Open file for reading. """
+        self.reader = PositionalReader(self.path)
+
+    @property
+    def nbricks(self):
+        """ Total number of bricks. """
+        return len(self.table)
+
+    def __repr__(self):
+        return f'BrickFile for {self.path}: shape {tuple(self.shape)}, bricks {tuple(self.brick_shape)}'
+
+
+    # Bricks
+    def brick_location(self, brick_index):
+        """ Slices of the cube, covered by a brick with `brick_index` position in the grid. """
+        starts = np.array(brick_index) * self.brick_shape
+        stops = np.minimum(starts + self.brick_shape, self.shape)
+        return tuple(slice(start, stop) for start, stop in zip(starts, stops))
+
+    def load_brick(self, brick_index):
+        """ Read and decompress one brick, defined by its position in the grid. """
+        location = self.brick_location(brick_index)
+        offset, length = self.table[np.ravel_multi_index(brick_index, self.grid_shape)]
+
+        brick = np.empty([slc.stop - slc.start for slc in location], dtype=self.dtype)
+        blosc.decompress_ptr(self.reader.read(length, offset), brick.__array_interface__['data'][0])
+        return brick
+
+    def write_slab(self, slab, start):
+        """ Compress and write all bricks of a slab of ilines. `start` must be aligned to the bricks. """
+        if start % self.brick_shape[0]:
+            raise ValueError(f'Start of the slab must be divisible by {self.brick_shape[0]}, got {start} instead!')
+        slab = slab.astype(self.dtype, copy=False)
+
+        brick_i = start // self.brick_shape[0]
+        for brick_x, brick_h in product(range(self.grid_shape[1]), range(self.grid_shape[2])):
+            location = self.brick_location((brick_i, brick_x, brick_h))
+            brick = np.ascontiguousarray(slab[:, location[1], location[2]])
+
+            compressed = blosc.compress_ptr(brick.__array_interface__['data'][0],
+                                            brick.size, brick.dtype.itemsize,
+                                            clevel=self.clevel, cname=self.cname, shuffle=self.shuffle)
+
+            idx = np.ravel_multi_index((brick_i, brick_x, brick_h), self.grid_shape)
+            self.table[idx] = self.file.tell(), len(compressed)
+            self.file.write(compressed)
+
+
+    # Instance manager
+    def close(self):
+        """ Store table of offsets, if the file is written, and close it. """
+        if self.file is not None:
+            self.file.seek(self.HEADER_DTYPE.itemsize)
+            self.file.write(self.table.tobytes())
+            self.file.close()
+            self.file = None
+
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _, __, ___):
+        self.close()
+
+    def __getstate__(self):
+        """ File handlers are not transferable between processes: re-open the file instead. """
+        state = self.__dict__.copy()
+        state['reader'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__ = state
+        if self.mode == 'r':
+            self.open_handler()
+
+
+
+class SeismicGeometryBricked(SeismicGeometryConverted):
+    """ Infer `BrickFile` with the cube, split into 3D bricks.
+    Unlike other converted formats, only one copy of data is stored, and crops of any orientation are loaded from
+    intersecting bricks only. Bricks are cached, so that subsequent loads of neighbouring crops are faster.
+    """
+    #pylint: disable=attribute-defined-outside-init
+    def process(self, **kwargs):
+        """ Open the file and infer attributes. """
+        self.file = BrickFile(self.path, mode='r')
+        self.available_axis, self.available_names = [], []
+        self.axis_to_cube = {}
+
+        # Parse attributes from meta / set defaults
+        self.add_attributes(**kwargs)
+
+    def add_attributes(self, **kwargs):
+        """ If meta is available, retrieves values from it. Otherwise, uses defaults.
+        Infers shape and dtype from the header of the file.
+        """
+        self.structured = True
+        self.index_headers = self.INDEX_POST
+
+        if os.path.exists(self.path_meta):
+            self.load_meta()
+            self.has_stats = True
+        else:
+            self.set_default_attributes(**kwargs)
+            self.has_stats = False
+
+        self.cube_shape = self.file.shape
+        self.lens = self.cube_shape[:2]
+        self.depth = self.cube_shape[-1]
+        self.dtype = self.file.dtype
+        self.quantized = self.dtype == np.int8
+        self.brick_shape = self.file.brick_shape
+
+
+    # Methods to load actual data from underlying storage
+    def load_crop(self, locations, num_threads=None, out=None, normalize=None, **kwargs):
+        """ Load 3D crop from the cube: decompress intersecting bricks and copy relevant parts of them.
+
+        Parameters
+        ----------
+        locations : sequence of slices
+            Location to load: slices along the first index, the second, and depth.
+        num_threads : int, optional
+            Number of threads to load bricks with. Default is the `num_threads` attribute of the instance.
+        out : ndarray, optional
+            Preallocated array to write the crop into. Its dtype is used for the output: for example, `float16`.
+        normalize : None, bool or str
+            If provided, then crop is normalized in the same pass over data as the cast to the output dtype and the
+            transposition: see :meth:`~.SeismicGeometry.normalize` for available modes.
+        """
+        locations, shape, _ = self.process_key(locations)
+        crop = np.empty(shape, dtype=self.dtype)
+
+        brick_ranges = [range(slc.start // size, (slc.stop - 1) // size + 1)
+                        for slc, size in zip(locations, self.brick_shape)]
+
+        def load(_, brick_index):
+            brick = self._cached_load(*brick_index, **kwargs)
+            src, dst = self.overlap(locations, self.file.brick_location(brick_index))
+            crop[dst] = brick[src]
+        run_parallel(load, list(product(*brick_ranges)), num_threads=num_threads or self.num_threads)
+        return self.postprocess_crop(crop, out=out, normalize=normalize, locations=locations)
+
+    def load_crops(self, locations, out=None, normalize=None, dtype=np.float32, num_threads=None, **kwargs):
+        """ Load multiple crops at once. Requests are grouped by bricks: each of the intersecting bricks is
+        decompressed only once, and then its parts are scattered into all of the overlapping crops.
+
+        Parameters
+        ----------
+        locations : sequence
+            Locations of crops: each of them is a sequence of slices along the first index, the second, and depth.
+        out : ndarray or sequence of ndarrays, optional
+            Preallocated array of `(len(locations), *crop_shape)` shape, or a sequence of arrays for each crop.
+            If not provided, then crops must be of the same shape.
+        normalize : None, bool or str
+            If provided, then crops are normalized while being loaded: see :meth:`.normalize` for available modes.
+        dtype : np.dtype
+            Dtype of the created `out` array.
+        num_threads : int, optional
+            Number of threads to load bricks with. Default is the `num_threads` attribute of the instance.
+        """
+        locations = [self.process_key(location)[0] for location in locations]
+        out = self.make_crops_buffer(locations, out=out, dtype=dtype)
+
+        buffers = []
+        requests = defaultdict(list)
+        for i, location in enumerate(locations):
+            buffers.append(np.empty([slc.stop - slc.start for slc in location], dtype=self.dtype))
+            brick_ranges = [range(slc.start // size, (slc.stop - 1) // size + 1)
+                            for slc, size in zip(location, self.brick_shape)]
+            for brick_index in product(*brick_ranges):
+                requests[brick_index].append(i)
+
+        def load(_, brick_index):
+            brick = self._cached_load(*brick_index, **kwargs)
+            brick_location = self.file.brick_location(brick_index)
+            for i in requests[brick_index]:
+                src, dst = self.overlap(locations[i], brick_location)
+                buffers[i][dst] = brick[src]
+        run_parallel(load, sorted(requests), num_threads=num_threads or self.num_threads)
+
+        for buffer, location, crop_out in zip(buffers, locations, out):
+            self.postprocess_crop(buffer, out=crop_out, normalize=normalize, locations=location)
+        return out
+
+    @staticmethod
+    def overlap(locations, brick_location):
+        """ Slices of the brick and of the crop, that correspond to their intersection. """
+        src, dst = [], []
+        for slc, brick_slc in zip(locations, brick_location):
+            start, stop = max(slc.start, brick_slc.start), min(slc.stop, brick_slc.stop)
+            src.append(slice(start - brick_slc.start, stop - brick_slc.start))
+            dst.append(slice(start - slc.start, stop - slc.start))
+        return tuple(src), tuple(dst)
+
+    @lru_cache(256, budget=True, shared=True)
+    def _cached_load(self, brick_i, brick_x, brick_h, **kwargs):
+        """ Load one brick of data. Caches the result in a thread-safe manner. """
+        _ = kwargs
+        return self.file.load_brick((brick_i, brick_x, brick_h))
+
+    def load_slide(self, loc, axis='iline', **kwargs):
+        """ Load desired slide along desired axis from intersecting bricks. """
+        axis = self.parse_axis(axis)
+
+        locations = [slice(None) for _ in range(3)]
+        locations[axis] = slice(loc, loc + 1)
+        return self.load_crop(locations, **kwargs).squeeze(axis=axis)
@@ -1,8 +1,16 @@
 """ HDF5 geometry. """
 import os
+import atexit
+import tempfile
+from threading import Lock
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
+from tqdm.auto import tqdm
 
 from ..utility_classes import lru_cache
+from ..utils import prefetch
 from .base import SeismicGeometry
 
 
@@ -19,8 +27,12 @@ class SeismicGeometryConverted(SeismicGeometry):
     The storage itself contains only data; attributes, stats and relevant geological info are stored in the `.meta`.
 
     This class provides API for loading data: `load_slide`, `load_crop` and `__getitem__` methods.
+    Slides of one crop can be loaded by multiple threads, controlled by the `num_threads` attribute.
     """
     #pylint: disable=attribute-defined-outside-init
+    # Default number of threads to load slides of one crop with; can be changed for an instance
+    num_threads = 1
+
     AXIS_TO_NAME = {0: 'cube_i', 1: 'cube_x', 2: 'cube_h'}
     AXIS_TO_ORDER = {0: [0, 1, 2], 1: [1, 2, 0], 2: [2, 0, 1]}
     AXIS_TO_TRANSPOSE = {0: [0, 1, 2], 1: [2, 0, 1], 2: [1, 2, 0]}
@@ -28,6 +40,10 @@ class SeismicGeometryConverted(SeismicGeometry):
     def process(self):
         """ Create and process file handler. Must be implemented in the child classes. """
 
+    def open_file(self, mode='r'):
+        """ Re-open file handler in a given mode and return it. Must be implemented in the child classes. """
+        raise NotImplementedError
+
 
     def add_attributes(self, **kwargs):
         """ If meta is available, retrieves values from it. Otherwise, uses defaults.
@@ -62,6 +78,130 @@ class SeismicGeometryConverted(SeismicGeometry):
             setattr(self, key, value)
 
 
+    # Create missing projections
+    def add_projection(self, projections='h', source=None, ram_budget=1.0, tmp_dir=None, pbar=True, workers=1,
+                       **kwargs):
+        """ Create missing projections from an existing one, without the original SEG-Y.
+        The source projection is transposed by slabs of slides into temporary memory-mapped buffers,
+        which are then written slide by slide into the new datasets of the same file.
+        Available axes and cube handlers of the instance are updated in place.
+
+        Parameters
+        ----------
+        projections : str
+            Which projections to add: `i` for iline one, `x` for the crossline, `h` for depth.
+            Already available ones are skipped.
+        source : str or int, optional
+            Projection to create new ones from. Default is the first available one.
+        ram_budget : number
+            Amount of memory (in GB) to use for one slab of source slides.
+        tmp_dir : str, optional
+            Directory for temporary buffers. Default is the directory of the file.
+        pbar : bool
+            Whether to show progress bar.
+        workers : int
+            Number of threads to read source slides with. If bigger than 1, then reading and transposing are also
+            done in a separate thread while the new slides are written (and compressed).
+        kwargs : dict
+            Other parameters, passed directly to `create_dataset` of the file:
+            for example, `block_shape` for `BLOSC` or `chunks` for `HDF5`.
+        """
+        #pylint: disable=access-member-before-definition
+        source = self.available_axis[0] if source is None else self.parse_axis(source)
+        axes = sorted({self.parse_axis(p) for p in projections} - set(self.available_axis))
+        if not axes:
+            return self
+
+        file = self.open_file(mode='a')
+        try:
+            source_cube = file[self.AXIS_TO_NAME[source]]
+            cubes = {}
+            for axis in axes:
+                shape = tuple(self.cube_shape[self.AXIS_TO_ORDER[axis]])
+                cubes[axis] = file.create_dataset(self.AXIS_TO_NAME[axis], shape=shape, dtype=self.dtype, **kwargs)
+
+            total = self.cube_shape[source] + sum(self.cube_shape[axis] for axis in axes)
+            progress_bar = tqdm(total=total, ncols=800, disable=not pbar)
+            progress_bar.set_description(f'Adding {[self.AXIS_TO_NAME[axis] for axis in axes]} to {self.name}')
+
+            slides = self.iterate_transposed(source_cube, source=source, axes=axes, ram_budget=ram_budget,
+                                             tmp_dir=tmp_dir or os.path.dirname(os.path.abspath(self.path)),
+                                             num_threads=workers, progress_bar=progress_bar)
+            if workers > 1:
+                slides = prefetch(slides, size=2 * workers)
+
+            for axis, idx, slide in slides:
+                cubes[axis][idx, :, :] = slide
+                progress_bar.update()
+            progress_bar.close()
+        finally:
+            file.close()
+
+        # Update bookkeeping of available projections
+        self.open_file(mode='r')
+        self.available_axis = [axis for axis, name in self.AXIS_TO_NAME.items()
+                               if name in self.file]
+        self.available_names = [self.AXIS_TO_NAME[axis] for axis in self.available_axis]
+
+        self.axis_to_cube = {}
+        for axis in self.available_axis:
+            name = self.AXIS_TO_NAME[axis]
+            cube = self.file[name]
+
+            self.axis_to_cube[axis] = cube
+            setattr(self, name, cube)
+        self.reset_cache()
+        return self
+
+    def iterate_transposed(self, source_cube, source, axes, ram_budget=1.0, tmp_dir=None, num_threads=1,
+                           progress_bar=None):
+        """ Transpose `source_cube` projection into `axes` ones and yield their slides as `(axis, index, slide)`.
+        Source is read by slabs of slides, each of them taking no more than `ram_budget` GB;
+        slabs are transposed into temporary uncompressed memory-mapped buffers of target projections.
+        That requires (on-disk) space of the new projections.
+        """
+        n_slides, *slide_shape = source_cube.shape
+        slab_nbytes = np.prod(slide_shape) * np.dtype(self.dtype).itemsize
+        slab_size = int(np.clip(ram_budget * 1024**3 // slab_nbytes, 1, n_slides))
+
+        with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+            buffers = {}
+            for axis in axes:
+                shape = tuple(self.cube_shape[self.AXIS_TO_ORDER[axis]])
+                buffers[axis] = np.memmap(os.path.join(tmp, f'projection_{axis}'), dtype=self.dtype,
+                                          mode='w+', shape=shape)
+
+            for start in range(0, n_slides, slab_size):
+                stop = min(start + slab_size, n_slides)
+                slab = np.empty((stop - start, *slide_shape), dtype=self.dtype)
+
+                def load(i, idx, slab=slab):
+                    slab[i] = source_cube[idx, :, :]
+                run_parallel(load, range(start, stop), num_threads=num_threads)
+
+                # Slab in the cube ordering, and its location in the cube
+                slab = slab.transpose(self.AXIS_TO_TRANSPOSE[source])
+                locations = [slice(None) for _ in range(3)]
+                locations[source] = slice(start, stop)
+
+                for axis, buffer in buffers.items():
+                    order = self.AXIS_TO_ORDER[axis]
+                    buffer[tuple(locations[i] for i in order)] = slab.transpose(order)
+
+                if progress_bar is not None:
+                    progress_bar.update(stop - start)
+
+            for axis, buffer in buffers.items():
+                buffer.flush()
+                for idx, slide in enumerate(buffer):
+                    yield axis, idx, np.array(slide)
+
+            # Release memory maps before the directory is removed
+            for buffer in buffers.values():
+                buffer._mmap.close() #pylint: disable=protected-access
+            buffers.clear()
+
+
     # Methods to load actual data from underlying storage
     def get_optimal_axis(self, shape):
         """ Choose the fastest axis from available projections, based on shape. """
@@ -70,7 +210,7 @@ class SeismicGeometryConverted(SeismicGeometry):
                 return axis
         return None
 
-    def load_crop(self, locations, axis=None, **kwargs):
+    def load_crop(self, locations, axis=None, num_threads=None, out=None, normalize=None, **kwargs):
         """ Load 3D crop from the cube.
         Automatically chooses the fastest projection to use.
 
@@ -81,6 +221,14 @@ class SeismicGeometryConverted(SeismicGeometry):
         axis : str or int
             Identificator of the axis to use to load data.
             Can be `iline`, `xline`, `height`, `depth`, `i`, `x`, `h`, 0, 1, 2.
+        num_threads : int, optional
+            Number of threads to load slides with. Default is the `num_threads` attribute of the instance.
+            Decompression and reading release GIL, so deep crops are loaded almost linearly faster.
+        out : ndarray, optional
+            Preallocated array to write the crop into. Its dtype is used for the output: for example, `float16`.
+        normalize : None, bool or str
+            If provided, then crop is normalized in the same pass over data as the cast to the output dtype and the
+            transposition: see :meth:`~.SeismicGeometry.normalize` for available modes.
         """
         locations, shape, _ = self.process_key(locations)
 
@@ -100,38 +248,114 @@ class SeismicGeometryConverted(SeismicGeometry):
         # Create memory buffer and load data into it
         buffer = np.empty(buffer_shape, dtype=self.dtype)
         method = getattr(self, f'_load_{axis}')
-        crop = method(buffer, cube, *locations, **kwargs)
+        crop = method(buffer, cube, *locations, num_threads=num_threads or self.num_threads, **kwargs)
 
         # Set correct dtype and axis ordering
-        if self.dtype == np.int8:
-            crop = crop.astype(np.float32)
-        return crop.transpose(transpose)
+        return self.postprocess_crop(crop.transpose(transpose), out=out, normalize=normalize, locations=locations)
+
+    def load_crops(self, locations, out=None, normalize=None, dtype=np.float32, num_threads=None, **kwargs):
+        """ Load multiple crops at once. Each crop uses the same projection, as in :meth:`.load_crop`.
+        Requests are grouped by slides: each of the required slides is read (and decompressed) only once,
+        and then its windows are scattered into all of the overlapping crops.
+        If slides are stored as multiple blocks, then each of the blocks, overlapping with any of the windows,
+        is decompressed once.
 
-    def _load_0(self, buffer, cube, ilines, xlines, heights, **kwargs):
+        Parameters
+        ----------
+        locations : sequence
+            Locations of crops: each of them is a sequence of slices along the first index, the second, and depth.
+        out : ndarray or sequence of ndarrays, optional
+            Preallocated array of `(len(locations), *crop_shape)` shape, or a sequence of arrays for each crop.
+            If not provided, then crops must be of the same shape.
+        normalize : None, bool or str
+            If provided, then crops are normalized while being loaded: see :meth:`.normalize` for available modes.
+        dtype : np.dtype
+            Dtype of the created `out` array.
+        num_threads : int, optional
+            Number of threads to load slides with. Default is the `num_threads` attribute of the instance.
+        """
+        locations = [self.process_key(location)[0] for location in locations]
+        out = self.make_crops_buffer(locations, out=out, dtype=dtype)
+
+        # Buffers in the projection ordering and requests to each of the slides
+        axes, buffers = [], []
+        requests = defaultdict(list)
+        for i, location in enumerate(locations):
+            shape = np.array([slc.stop - slc.start for slc in location])
+            axis = self.get_optimal_axis(shape)
+            order = self.AXIS_TO_ORDER[axis]
+            axes.append(axis)
+            buffers.append(np.empty(shape[order], dtype=self.dtype))
+
+            slc, slice_0, slice_1 = [location[j] for j in order]
+            for loc in range(slc.start, slc.stop):
+                requests[axis, loc].append((i, loc - slc.start, slice_0, slice_1))
+
+        def load(_, request):
+            axis, loc = request
+            cube = self.axis_to_cube[axis]
+
+            if getattr(cube, 'n_blocks', 1) == 1:
+                slide = self._cached_load(cube, loc, **kwargs)
+                for i, position, slice_0, slice_1 in requests[request]:
+                    buffers[i][position] = slide[slice_0, slice_1]
+            else:
+                blocks = {}
+                def load_block(block):
+                    if block not in blocks:
+                        blocks[block] = self._cached_load(cube, loc, block=block, **kwargs)
+                    return blocks[block]
+
+                for i, position, slice_0, slice_1 in requests[request]:
+                    buffers[i][position] = cube.read_window(loc, slice_0, slice_1, load_block=load_block)
+        run_parallel(load, sorted(requests), num_threads=num_threads or self.num_threads)
+
+        for buffer, axis, location, crop_out in zip(buffers, axes, locations, out):
+            self.postprocess_crop(buffer.transpose(self.AXIS_TO_TRANSPOSE[axis]), out=crop_out,
+                                  normalize=normalize, locations=location)
+        return out
+
+    def _load_0(self, buffer, cube, ilines, xlines, heights, num_threads=1, **kwargs):
         """ Load data from iline projection. """
-        for i, iline in enumerate(range(ilines.start, ilines.stop)):
-            buffer[i] = self._cached_load(cube, iline, **kwargs)[xlines, :][:, heights]
+        def load(i, iline):
+            buffer[i] = self._load_window(cube, iline, xlines, heights, **kwargs)
+        run_parallel(load, range(ilines.start, ilines.stop), num_threads=num_threads)
         return buffer
 
-    def _load_1(self, buffer, cube, ilines, xlines, heights, **kwargs):
+    def _load_1(self, buffer, cube, ilines, xlines, heights, num_threads=1, **kwargs):
         """ Load data from xline projection. """
-        for i, xline in enumerate(range(xlines.start, xlines.stop)):
-            buffer[i] = self._cached_load(cube, xline, **kwargs)[heights, :][:, ilines]
+        def load(i, xline):
+            buffer[i] = self._load_window(cube, xline, heights, ilines, **kwargs)
+        run_parallel(load, range(xlines.start, xlines.stop), num_threads=num_threads)
         return buffer
 
-    def _load_2(self, buffer, cube, ilines, xlines, heights, **kwargs):
+    def _load_2(self, buffer, cube, ilines, xlines, heights, num_threads=1, **kwargs):
         """ Load data from depth projection. """
-        for i, height in enumerate(range(heights.start, heights.stop)):
-            buffer[i] = self._cached_load(cube, height, **kwargs)[ilines, :][:, xlines]
+        def load(i, height):
+            buffer[i] = self._load_window(cube, height, ilines, xlines, **kwargs)
+        run_parallel(load, range(heights.start, heights.stop), num_threads=num_threads)
         return buffer
 
-    @lru_cache(128)
-    def _cached_load(self, cube, loc, **kwargs):
-        """ Load one slide of data from a supplied cube projection. Caches the result in a thread-safe manner. """
+    def _load_window(self, cube, loc, slice_0, slice_1, **kwargs):
+        """ Load a window of one slide. If slides of the projection are stored as multiple blocks,
+        only the overlapping ones are decompressed (and cached).
+        """
+        if getattr(cube, 'n_blocks', 1) == 1:
+            return self._cached_load(cube, loc, **kwargs)[slice_0, :][:, slice_1]
+        return cube.read_window(loc, slice_0, slice_1,
+                                load_block=lambda block: self._cached_load(cube, loc, block=block, **kwargs))
+
+    @lru_cache(128, budget=True, shared=True)
+    def _cached_load(self, cube, loc, block=None, **kwargs):
+        """ Load one slide of data (or one of its blocks) from a supplied cube projection.
+        Caches the result in a thread-safe manner.
+        """
         _ = kwargs
-        return cube[loc, :, :]
+        if block is None:
+            return cube[loc, :, :]
+        return cube.load_block(loc, block)
 
-    @lru_cache(128)
+    @lru_cache(128, budget=True, shared=True)
     def _cached_construct(self, loc, axis,**kwargs):
         """ Create one slide of data from other projections. """
         _ = kwargs
@@ -156,6 +380,49 @@ class SeismicGeometryConverted(SeismicGeometry):
         if axis == 1 and axis in self.available_axis:
             slide = slide.T
 
-        if self.dtype == np.int8:
-            slide = slide.astype(np.float32)
-        return slide
+        return self.dequantize(slide, ilines=loc if axis == 0 else slice(None))
+
+
+
+EXECUTOR = {'pool': None, 'size': 0, 'pid': None, 'lock': Lock()}
+
+def run_parallel(function, locations, num_threads=1):
+    """ Call `function(i, location)` for each of `locations`, using at most `num_threads` threads at once.
+    All calls share one pool of threads per process: it is grown on demand, re-created in forked processes
+    (threads are not copied by fork) and shut down at interpreter exit.
+    """
+    if num_threads <= 1 or len(locations) <= 1:
+        for i, location in enumerate(locations):
+            function(i, location)
+        return
+
+    num_threads = min(num_threads, len(locations))
+    def work(start):
+        for i in range(start, len(locations), num_threads):
+            function(i, locations[i])
+
+    # Submit under the lock: the pool can be replaced by a bigger one in another thread
+    with EXECUTOR['lock']:
+        if EXECUTOR['pid'] != os.getpid() or EXECUTOR['size'] < num_threads:
+            if EXECUTOR['pool'] is not None and EXECUTOR['pid'] == os.getpid():
+                EXECUTOR['pool'].shutdown(wait=False)
+            EXECUTOR.update(pool=ThreadPoolExecutor(max_workers=num_threads), size=num_threads, pid=os.getpid())
+        futures = [EXECUTOR['pool'].submit(work, start) for start in range(num_threads)]
+
+    for future in futures:
+        future.result()
+
+def shutdown_executor():
+    """ Stop threads of the shared pool. """
+    with EXECUTOR['lock']:
+        if EXECUTOR['pool'] is not None and EXECUTOR['pid'] == os.getpid():
+            EXECUTOR['pool'].shutdown(wait=True)
+        EXECUTOR.update(pool=None, size=0, pid=None)
+
+def _reset_executor_after_fork():
+    """ The pool and, possibly, acquired lock of the parent process are not usable in a child. """
+    EXECUTOR.update(pool=None, size=0, pid=None, lock=Lock())
+
+atexit.register(shutdown_executor)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_executor_after_fork)
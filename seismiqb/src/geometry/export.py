@@ -1,6 +1,7 @@
 """ Methods to save data as seismic cubes in different formats. """
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from tqdm.auto import tqdm
 
 import numpy as np
@@ -89,20 +90,36 @@ class ExportMixin:
 
 
     def make_sgy(self, path_hdf5=None, path_spec=None, postfix='',
-                 remove_hdf5=False, zip_result=True, path_segy=None, pbar=False):
-        """ Convert POST-STACK HDF5 cube to SEG-Y format with supplied spec.
+                 remove_hdf5=False, zip_result=True, path_segy=None, slab_size=None, workers=1, pbar=False):
+        """ Convert POST-STACK cube to SEG-Y format with supplied spec.
+        Trace headers, textual and binary headers are copied from the spec, and data is written in its sample format.
+
+        The cube is processed in slabs of ilines: each slab is read at once, encoded and written to the
+        traces of the file, mapped as `np.memmap`, by contiguous runs, along with headers of the same traces.
+        If the spec can't be memory-mapped (for example, it has traces of varying lengths),
+        traces are written one by one.
 
         Parameters
         ----------
         path_hdf5 : str
-            Path to load hdf5 file from.
+            Path to load cube from: either HDF5 file with `cube` dataset, or any cube, supported by `SeismicGeometry`.
         path_spec : str
             Path to load segy file from with geometry spec.
         path_segy : str
             Path to store converted cube. By default, new cube is stored right next to original.
         postfix : str
             Postfix to add to the name of resulting cube.
+        slab_size : int, optional
+            Number of ilines to process at once. Default is the number of ilines, taking about 256MB.
+        workers : int
+            Number of threads to read and encode slabs in parallel.
+        pbar : bool
+            Whether to show progress bar with throughput of writing.
         """
+        # By default, if path_hdf5 is not provided, `temp.hdf5` next to self.path will be used
+        if path_hdf5 is None:
+            path_hdf5 = os.path.join(os.path.dirname(self.path), 'temp.hdf5')
+
         path_segy = path_segy or (os.path.splitext(path_hdf5)[0] + postfix + '.sgy')
         if not path_spec:
             if hasattr(self, 'segy_path'):
@@ -110,43 +127,22 @@ class ExportMixin:
             else:
                 path_spec = os.path.splitext(self.path)[0] + '.sgy'
 
-        # By default, if path_hdf5 is not provided, `temp.hdf5` next to self.path will be used
-        if path_hdf5 is None:
-            path_hdf5 = os.path.join(os.path.dirname(self.path), 'temp.hdf5')
-
-        with h5py.File(path_hdf5, 'r') as src:
-            cube_hdf5 = src['cube']
+        #pylint: disable=import-outside-toplevel
+        from .base import SeismicGeometry
+        geometry = SeismicGeometry(path_spec)
 
-            from .base import SeismicGeometry #pylint: disable=import-outside-toplevel
-            geometry = SeismicGeometry(path_spec)
-            segy = geometry.segyfile
+        # Spatial location of each trace in the spec, -1 for traces outside of the cube
+        ilines, xlines = self.load_meta_item('ilines'), self.load_meta_item('xlines')
+        iline_positions = encode_positions(geometry.header_columns[geometry.index_headers[0]], ilines)
+        xline_positions = encode_positions(geometry.header_columns[geometry.index_headers[1]], xlines)
+        iline_positions[xline_positions < 0] = -1
 
-            spec = segyio.spec()
-            spec.sorting = None if segy.sorting is None else int(segy.sorting)
-            spec.format = None if segy.format is None else int(segy.format)
-            spec.samples = range(self.depth)
-
-            idx = np.stack(geometry.dataframe.index)
-            ilines, xlines = self.load_meta_item('ilines'), self.load_meta_item('xlines')
-
-            i_enc = {num: k for k, num in enumerate(ilines)}
-            x_enc = {num: k for k, num in enumerate(xlines)}
-
-            spec.ilines = ilines
-            spec.xlines = xlines
-
-            with segyio.create(path_segy, spec) as dst_file:
-                # Copy all textual headers, including possible extended
-                for i in range(1 + segy.ext_headers):
-                    dst_file.text[i] = segy.text[i]
-                dst_file.bin = segy.bin
-
-                for c, (i, x) in enumerate(tqdm(idx, disable=(not pbar))):
-                    locs = tuple([i_enc[i], x_enc[x], slice(None)])
-                    dst_file.header[c] = segy.header[c]
-                    dst_file.trace[c] = cube_hdf5[locs]
-                dst_file.bin = segy.bin
-                dst_file.bin[segyio.BinField.Traces] = len(idx)
+        with open_export_source(path_hdf5) as src:
+            if geometry.memmap is None:
+                self._make_sgy_tracewise(src, path_segy, geometry, iline_positions, xline_positions, pbar=pbar)
+            else:
+                self._make_sgy_memmap(src, path_spec, path_segy, geometry, iline_positions, xline_positions,
+                                      slab_size=slab_size, workers=workers, pbar=pbar)
 
         if remove_hdf5:
             os.remove(path_hdf5)
@@ -156,6 +152,144 @@ class ExportMixin:
             file_name = os.path.basename(path_segy)
             shutil.make_archive(os.path.splitext(path_segy)[0], 'zip', dir_name, file_name)
 
+    def _make_sgy_memmap(self, src, path_spec, path_segy, geometry, iline_positions, xline_positions,
+                         slab_size=None, workers=1, pbar=False):
+        """ Write SEG-Y by slabs of ilines into the traces of the file, mapped as `np.memmap`. """
+        from .segy import encode_traces #pylint: disable=import-outside-toplevel
+        segy = geometry.segyfile
+        n_ilines = len(self.load_meta_item('ilines'))
+
+        # Copy textual, binary and extended headers; allocate traces
+        _, spec_dtype, trace0, tracecount = geometry.memmap_spec
+        depth = int(self.depth)
+        data_dtype = np.dtype((spec_dtype['data'].base, (depth,)))
+        trace_dtype = np.dtype([('header', np.void, 240), ('data', data_dtype)])
+        byteorder = 'big' if segy.endian == 'big' else 'little'
+
+        with open(path_spec, 'rb') as spec_file, open(path_segy, 'wb') as dst_file:
+            prefix = bytearray(spec_file.read(trace0))
+            prefix[3220:3222] = depth.to_bytes(2, byteorder)
+            dst_file.write(prefix)
+            dst_file.truncate(trace0 + tracecount * trace_dtype.itemsize)
+
+        src_headers = np.memmap(path_spec, dtype=spec_dtype, mode='r', offset=trace0, shape=(tracecount,))
+        dst_traces = np.memmap(path_segy, dtype=trace_dtype, mode='r+', offset=trace0, shape=(tracecount,))
+
+        slab_size = slab_size or max(1, 256 * 1024**2 // (4 * self.cube_shape[1] * depth))
+        order, bounds = make_slabs(iline_positions, n_ilines, slab_size)
+
+        def write_slab(start):
+            """ Read, encode and write traces of ilines from the slab, starting at `start`. """
+            k = start // slab_size
+            trace_indices = order[bounds[k] : bounds[k + 1]]
+            if len(trace_indices) == 0:
+                return 0
+
+            slab = src(start, min(start + slab_size, n_ilines))
+            traces = slab[iline_positions[trace_indices] - start, xline_positions[trace_indices]]
+            write_traces(dst_traces, src_headers, trace_indices, encode_traces(traces, geometry.sample_format))
+            return len(trace_indices)
+
+        # Traces outside of the cube: headers are copied, data is left zero
+        outside = np.nonzero(iline_positions < 0)[0]
+        dst_traces['header'][outside] = src_headers['header'][outside]
+
+        with tqdm(total=tracecount * trace_dtype.itemsize, unit='B', unit_scale=True, unit_divisor=1024,
+                  desc=f'Writing {os.path.basename(path_segy)}', disable=not pbar) as progress_bar:
+            progress_bar.update(len(outside) * trace_dtype.itemsize)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for n_traces in executor.map(write_slab, range(0, n_ilines, slab_size)):
+                    progress_bar.update(n_traces * trace_dtype.itemsize)
+
+        # Update number of samples in trace headers, if it differs from the spec
+        if depth != geometry.depth:
+            headers = dst_traces['header'].view(np.uint8).reshape(tracecount, 240)
+            headers[:, 114:116] = np.frombuffer(depth.to_bytes(2, byteorder), dtype=np.uint8)
+        dst_traces.flush()
+        del dst_traces, src_headers
+
+    def _make_sgy_tracewise(self, src, path_segy, geometry, iline_positions, xline_positions, pbar=False):
+        """ Write SEG-Y trace by trace with `segyio`. Used, if the spec can't be memory-mapped. """
+        segy = geometry.segyfile
+
+        spec = segyio.spec()
+        spec.sorting = None if segy.sorting is None else int(segy.sorting)
+        spec.format = None if segy.format is None else int(segy.format)
+        spec.samples = range(self.depth)
+        spec.tracecount = segy.tracecount
+
+        with segyio.create(path_segy, spec) as dst_file:
+            # Copy all textual headers, including possible extended
+            for i in range(1 + segy.ext_headers):
+                dst_file.text[i] = segy.text[i]
+            dst_file.bin = segy.bin
+
+            zero_trace = np.zeros(self.depth, dtype=np.float32)
+            for c in tqdm(range(segy.tracecount), disable=not pbar):
+                i, x = iline_positions[c], xline_positions[c]
+                dst_file.header[c] = segy.header[c]
+                dst_file.trace[c] = src(i, i + 1)[0, x] if i >= 0 else zero_trace
+            dst_file.bin = segy.bin
+            dst_file.bin[segyio.BinField.Traces] = segy.tracecount
+
+
+class open_export_source:
+    """ Context manager with a callable, that loads slabs of ilines `[start, stop)` from a cube to export.
+    HDF5 files with `cube` dataset are read directly; other cubes are opened with `SeismicGeometry`, and
+    values of quantized ones are restored to amplitudes.
+    """
+    #pylint: disable=invalid-name
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        if os.path.splitext(self.path)[1][1:] in ['hdf5', 'h5']:
+            self.file = h5py.File(self.path, 'r')
+            if 'cube' in self.file:
+                cube = self.file['cube']
+                return lambda start, stop: cube[start:stop]
+            self.file.close()
+
+        # Quantized values are converted back to amplitudes
+        from .base import SeismicGeometry #pylint: disable=import-outside-toplevel
+        geometry = SeismicGeometry(self.path)
+        return lambda start, stop: geometry.restore_amplitudes(geometry[start:stop, :, :])
+
+    def __exit__(self, _, __, ___):
+        if self.file is not None:
+            self.file.close()
+
+
+def encode_positions(values, uniques):
+    """ Position of each of `values` in sorted `uniques`, -1 for missing ones. """
+    positions = np.searchsorted(uniques, values)
+    positions = np.clip(positions, 0, len(uniques) - 1)
+    positions[uniques[positions] != values] = -1
+    return positions
+
+def contiguous_runs(indices):
+    """ Split sequence of indices into runs of consecutive ones. Yields `(start, stop)` positions of runs. """
+    breaks = np.nonzero(np.diff(indices) != 1)[0] + 1
+    starts = np.concatenate([[0], breaks])
+    stops = np.concatenate([breaks, [len(indices)]])
+    yield from zip(starts, stops)
+
+def make_slabs(iline_positions, n_ilines, slab_size):
+    """ Group traces by slabs of `slab_size` ilines.
+    Returns indices of traces, sorted by ilines, and bounds of each slab in them: traces outside of the cube are first.
+    """
+    order = np.argsort(iline_positions, kind='stable')
+    bounds = np.searchsorted(iline_positions[order], np.arange(0, n_ilines + slab_size, slab_size))
+    return order, bounds
+
+def write_traces(dst_traces, src_headers, trace_indices, traces):
+    """ Write encoded `traces` and headers of the spec to `trace_indices` of the file by contiguous runs. """
+    for run_start, run_stop in contiguous_runs(trace_indices):
+        run = slice(trace_indices[run_start], trace_indices[run_stop - 1] + 1)
+        dst_traces['header'][run] = src_headers['header'][run]
+        dst_traces['data'][run] = traces[run_start:run_stop]
+
 
 def make_segy_from_array(array, path_segy, zip_segy=True, remove_segy=None, **kwargs):
     """ Make a segy-cube from an array. Zip it if needed. Segy-headers are filled by defaults/arguments from kwargs.
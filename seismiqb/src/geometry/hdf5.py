@@ -3,21 +3,31 @@ import os
 
 import numpy as np
 import h5pickle as h5py
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
 
 from .converted import SeismicGeometryConverted
 
 
 class SeismicGeometryHDF5(SeismicGeometryConverted):
-    """ Infer or create an `HDF5` file with multiple projections of the same data inside. """
+    """ Infer or create an `HDF5` file with multiple projections of the same data inside.
+    Parameters of the chunk cache of the file (`rdcc_nbytes`, `rdcc_nslots`, `rdcc_w0`) can be passed at initialization.
+    """
     #pylint: disable=attribute-defined-outside-init
-    def process(self, mode='r', projections='ixh', shape=None, **kwargs):
+    def process(self, mode='r', projections='ixh', shape=None, rdcc_nbytes=None, rdcc_nslots=None, rdcc_w0=None,
+                **kwargs):
         """ Detect available projections in the cube and store handlers to them in attributes. """
         if mode == 'a':
             mode = 'r+' if os.path.exists(self.path) else 'w-'
         self.mode = mode
 
+        cache_parameters = {'rdcc_nbytes': rdcc_nbytes, 'rdcc_nslots': rdcc_nslots, 'rdcc_w0': rdcc_w0}
+        self.cache_parameters = {key: value for key, value in cache_parameters.items() if value is not None}
+
         if self.mode in ['r', 'r+']:
-            self.file = h5py.File(self.path, mode=mode)
+            self.file = h5py.File(self.path, mode=mode, **self.cache_parameters)
 
         elif self.mode=='w-':
             # TODO Create new HDF5 file with required projections
@@ -41,9 +51,14 @@ class SeismicGeometryHDF5(SeismicGeometryConverted):
         self.add_attributes(**kwargs)
 
 
-    def add_projection(self):
-        """ TODO. """
-        raise NotImplementedError
+    def open_file(self, mode='r'):
+        """ Re-open the underlying file in a given mode: `a` is for adding new projections. """
+        self.file.close()
+        # `h5pickle` memoizes opened files: closed handler must not be re-used
+        h5py.cache.pop(getattr(self.file, 'hsh', None), None)
+        self.file = h5py.File(self.path, mode='r+' if mode == 'a' else mode, skip_cache=mode != 'r',
+                              **self.cache_parameters)
+        return self.file
 
     def __getitem__(self, key):
         """ Select the fastest axis and use native `HDF5` slicing to retrieve data. """
@@ -57,8 +72,7 @@ class SeismicGeometryHDF5(SeismicGeometryConverted):
         slc = np.array(key)[order]
         crop = cube[tuple(slc)].transpose(transpose)
 
-        if self.dtype == np.int8:
-            crop = crop.astype(np.float32)
+        crop = self.dequantize(crop, ilines=key[0])
         if squeeze:
             crop = np.squeeze(crop, axis=tuple(squeeze))
         return crop
@@ -66,3 +80,72 @@ class SeismicGeometryHDF5(SeismicGeometryConverted):
     def __setitem__(self, key, value):
         """ TODO. """
         raise NotImplementedError
+
+
+
+def make_chunks(shape, crop_shape, dtype=np.float32, max_bytes=2**20):
+    """ Chunk shape for a dataset of `shape`, aligned to crops of `crop_shape` in the same axis ordering.
+    Each dimension is clipped to the dataset shape, then the largest of them is halved,
+    until the chunk fits into `max_bytes`: too big chunks make reads of small crops slower.
+    """
+    chunks = np.minimum(np.array(crop_shape), np.array(shape))
+    while np.prod(chunks) * np.dtype(dtype).itemsize > max_bytes and chunks.max() > 1:
+        i = np.argmax(chunks)
+        chunks[i] = -(-chunks[i] // 2)
+    return tuple(int(item) for item in chunks)
+
+def make_dataset_parameters(shape, dtype=np.float32, order=(0, 1, 2), chunks=None, crop_shape=None,
+                            compression=None, compression_opts=None, shuffle=False):
+    """ Keyword arguments for `create_dataset` of `h5py` for one projection of the cube.
+
+    Parameters
+    ----------
+    shape : sequence of ints
+        Shape of the dataset: the cube shape in the ordering of the projection.
+    order : sequence of ints
+        Ordering of the cube axes in the projection.
+    chunks : None, True, 'auto' or sequence of ints
+        If None, then the dataset is contiguous.
+        If True, then chunk shape is chosen by `h5py`.
+        If 'auto', then chunks are aligned to `crop_shape`, if it is provided, and chosen by `h5py` otherwise.
+        If sequence, then used as the chunk shape in the cube ordering (iline, crossline, depth).
+    crop_shape : sequence of ints, optional
+        Typical shape of crops to load from the cube, in the cube ordering.
+    compression : None, str or int
+        Filter to compress chunks with: `gzip` and `lzf` are always available,
+        `blosc`, `zstd` and `lz4` require `hdf5plugin` to be installed. Implies chunking.
+    compression_opts : optional
+        Parameters of the filter: for example, level of `gzip` compression.
+    shuffle : bool
+        Whether to apply byte shuffle before compression.
+    """
+    order = list(order)
+    parameters = {'shape': tuple(shape), 'dtype': dtype}
+
+    if isinstance(chunks, str) and chunks == 'auto':
+        chunks = make_chunks(shape, np.array(crop_shape)[order], dtype) if crop_shape is not None else True
+    elif chunks not in [None, True, False]:
+        chunks = tuple(int(item) for item in np.minimum(np.array(chunks)[order], shape))
+    if compression is not None and not chunks:
+        chunks = True
+    if chunks:
+        parameters['chunks'] = chunks
+
+    if compression in ['blosc', 'zstd', 'lz4']:
+        if hdf5plugin is None:
+            raise ImportError(f'`{compression}` compression requires `hdf5plugin` to be installed!')
+        if compression == 'blosc':
+            compression_opts = compression_opts or {}
+            parameters.update(hdf5plugin.Blosc(**compression_opts))
+        elif compression == 'zstd':
+            parameters.update(hdf5plugin.Zstd(**({'clevel': compression_opts} if compression_opts else {})))
+        else:
+            parameters.update(hdf5plugin.LZ4())
+    elif compression is not None:
+        parameters['compression'] = compression
+        if compression_opts is not None:
+            parameters['compression_opts'] = compression_opts
+
+    if shuffle:
+        parameters['shuffle'] = True
+    return parameters
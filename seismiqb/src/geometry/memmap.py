@@ -0,0 +1,186 @@
+""" Memory-mapped geometry. """
+import os
+
+import numpy as np
+
+from .converted import SeismicGeometryConverted, run_parallel
+
+
+
+class MemmapFile:
+    """ Directory with projections of the cube, each of them stored as a raw `.npy` array.
+    Arrays are opened with `np.load(mmap_mode='r')`, so reading data is just copying it from the OS page cache:
+    there is no decoding at all, and all of the processes, that read the same cube, share the same cached pages.
+
+    Semantics and namings are the same, as in `h5py` to provide identical API:
+    this way, we can make storage-agnostic code. In the `a` mode, existing arrays are opened for reading,
+    and new ones can be added.
+    """
+    def __init__(self, path, mode='r'):
+        self.path = path
+        self.mode = mode
+        self.key_to_dataset = {}
+
+        if mode == 'w':
+            os.makedirs(path, exist_ok=True)
+        elif mode in ['r', 'a']:
+            for name in sorted(os.listdir(path)):
+                key, ext = os.path.splitext(name)
+                if ext == '.npy':
+                    # Plain `ndarray` views on the memory map: slices of them are not `np.memmap` instances
+                    dataset = np.load(os.path.join(path, name), mmap_mode='r')
+                    self.key_to_dataset[key] = dataset.view(np.ndarray)
+
+    def create_dataset(self, key, shape, dtype):
+        """ Create a raw `.npy` array of a given name, shape and dtype, and open it for writing. """
+        dataset = np.lib.format.open_memmap(os.path.join(self.path, f'{key}.npy'), mode='w+',
+                                            shape=tuple(shape), dtype=dtype)
+        self.key_to_dataset[key] = dataset
+        return dataset
+
+    def namelist(self):
+        """ Contents of the file. """
+        return list(self.key_to_dataset)
+
+    def __contains__(self, key):
+        """ Check if projections is available. """
+        return key in self.key_to_dataset
+
+    def __getitem__(self, key):
+        """ Get existing memory-mapped array by key. """
+        dataset = self.key_to_dataset.get(key)
+        if dataset is not None:
+            return dataset
+        raise KeyError(f'Dataset {key} does not exist!')
+
+    def __repr__(self):
+        return f'MemmapFile for {self.path}'
+
+    def close(self):
+        """ Flush written arrays to the disk. """
+        for dataset in self.key_to_dataset.values():
+            if isinstance(dataset, np.memmap):
+                dataset.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _, __, ___):
+        self.close()
+
+    def __getstate__(self):
+        """ Memory maps are re-opened in other processes instead of copying the data. """
+        return {'path': self.path, 'mode': self.mode}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+
+class SeismicGeometryMemmap(SeismicGeometryConverted):
+    """ Infer a directory with projections of the cube, stored as raw memory-mapped `.npy` arrays.
+    As reading from the page cache is already fast, slides are not cached in the instance:
+    crops are sliced directly from the fastest projection.
+    """
+    #pylint: disable=attribute-defined-outside-init
+    def process(self, **kwargs):
+        """ Detect available projections in the cube and store handlers to them in attributes. """
+        self.file = MemmapFile(self.path, mode='r')
+
+        # Check available projections
+        self.available_axis = [axis for axis, name in self.AXIS_TO_NAME.items()
+                               if name in self.file]
+        self.available_names = [self.AXIS_TO_NAME[axis] for axis in self.available_axis]
+
+        # Save cube handlers to instance
+        self.axis_to_cube = {}
+        for axis in self.available_axis:
+            name = self.AXIS_TO_NAME[axis]
+            cube = self.file[name]
+
+            self.axis_to_cube[axis] = cube
+            setattr(self, name, cube)
+
+        # Parse attributes from meta / set defaults
+        self.add_attributes(**kwargs)
+
+    def open_file(self, mode='r'):
+        """ Re-open the directory in a given mode: `a` is for adding new projections. """
+        self.file.close()
+        self.file = MemmapFile(self.path, mode=mode)
+        return self.file
+
+
+    # Methods to load actual data from underlying storage
+    def load_crop(self, locations, axis=None, out=None, normalize=None, **kwargs):
+        """ Load 3D crop from the cube: slice the fastest projection and copy the data once.
+        The crop is always a writable array, detached from the file: use :meth:`.load_slide` for views.
+
+        Parameters
+        ----------
+        locations : sequence of slices
+            Location to load: slices along the first index, the second, and depth.
+        axis : str or int
+            Identificator of the axis to use to load data.
+            Can be `iline`, `xline`, `height`, `depth`, `i`, `x`, `h`, 0, 1, 2.
+        out : ndarray, optional
+            Preallocated array to write the crop into. Its dtype is used for the output: for example, `float16`.
+        normalize : None, bool or str
+            If provided, then crop is normalized in the same pass over data as the cast to the output dtype and the
+            transposition: see :meth:`~.SeismicGeometry.normalize` for available modes.
+        """
+        _ = kwargs
+        locations, shape, _ = self.process_key(locations)
+
+        if axis is None:
+            axis = self.get_optimal_axis(shape)
+        else:
+            axis = self.parse_axis(axis)
+            if axis not in self.available_axis:
+                raise ValueError(f'Axis {axis} is not available in the {self.displayed_name}!')
+
+        cube = self.axis_to_cube[axis]
+        slc = tuple(locations[i] for i in self.AXIS_TO_ORDER[axis])
+        crop = cube[slc].transpose(self.AXIS_TO_TRANSPOSE[axis])
+
+        if out is not None or normalize:
+            return self.postprocess_crop(crop, out=out, normalize=normalize, locations=locations)
+        if self.dtype != np.float32:
+            return self.dequantize(crop, ilines=locations[0])
+        # Contiguous slices of the memory map are views: always copy, so that the crop is writable
+        return np.array(crop, order='C')
+
+    def load_crops(self, locations, out=None, normalize=None, dtype=np.float32, num_threads=None, **kwargs):
+        """ Load multiple crops at once: each of them is sliced directly from the memory map,
+        so there are no slides to decode once and share between crops. Reads from the page cache are thread-safe,
+        so crops are loaded by `num_threads` threads: default is the `num_threads` attribute of the instance.
+        """
+        locations = [self.process_key(location)[0] for location in locations]
+        out = self.make_crops_buffer(locations, out=out, dtype=dtype)
+
+        def load(i, location):
+            crop_out = out[i]
+            crop = self.load_crop(location, out=crop_out, normalize=normalize, **kwargs)
+            if crop is not crop_out:
+                crop_out[...] = crop
+        run_parallel(load, locations, num_threads=num_threads or self.num_threads)
+        return out
+
+    def load_slide(self, loc, axis='iline', **kwargs):
+        """ Load desired slide along desired axis.
+        If the `axis` projection is available, a read-only view of the memory-mapped array is returned for
+        not quantized cubes. Otherwise, the slide is sliced from the fastest of other projections.
+        """
+        _ = kwargs
+        axis = self.parse_axis(axis)
+
+        if axis in self.available_axis:
+            slide = self.axis_to_cube[axis][loc]
+            if axis == 1:
+                slide = slide.T
+        else:
+            locations = [slice(None) for _ in range(3)]
+            locations[axis] = slice(loc, loc + 1)
+            return self.load_crop(locations).squeeze(axis=axis)
+
+        return self.dequantize(slide, ilines=loc if axis == 0 else slice(None))
@@ -40,9 +40,15 @@ class SeismicGeometryNPZ(SeismicGeometry):
         self.value_max = np.max(data)
         self.q001, self.q01, self.q99, self.q999 = np.quantile(data, [0.001, 0.01, 0.99, 0.999])
 
+        # Stats of the first array, used by `normalize`
+        self.quantized = False
+        self.v_min, self.v_max = self.value_min, self.value_max
+        self.v_mean, self.v_std = np.mean(data), np.std(data)
+        self.v_q001, self.v_q01, self.v_q99, self.v_q999 = self.q001, self.q01, self.q99, self.q999
+
 
     # Methods to load actual data from NPZ
-    def load_crop(self, locations, names=None, **kwargs):
+    def load_crop(self, locations, names=None, out=None, normalize=None, **kwargs):
         """ Load 3D crop from the cube.
 
         Parameters
@@ -50,6 +56,11 @@ class SeismicGeometryNPZ(SeismicGeometry):
             Location to load: slices along the first index, the second, and depth.
         names : sequence
             Names of data attributes to load.
+        out : ndarray, optional
+            Preallocated array to write the crop into. Its dtype is used for the output: for example, `float16`.
+        normalize : None, bool or str
+            If provided, then crop is normalized with the stats of the first array:
+            see :meth:`~.SeismicGeometry.normalize` for available modes.
         """
         _ = kwargs
         names = names or self.names[:1]
@@ -58,6 +69,9 @@ class SeismicGeometryNPZ(SeismicGeometry):
 
         crops = [self.data[key][locations[0], locations[1], locations[2]] for key in names]
         crop = np.concatenate(crops, axis=axis)
+
+        if out is not None or normalize:
+            return self.postprocess_crop(crop, out=out, normalize=normalize, locations=locations)
         return crop
 
     def load_slide(self, loc, axis='iline', **kwargs):
@@ -1,19 +1,26 @@
 """ SEG-Y geometry. """
 import os
+import shutil
+import tempfile
+from warnings import warn
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-from itertools import product
 from tqdm.auto import tqdm
 
 import numpy as np
 import pandas as pd
-import h5pickle as h5py
+import h5py
 import segyio
 import cv2
+from numba import njit
 
-from ..utils import find_min_max
-from ..utility_classes import lru_cache, SafeIO
+from ..utility_classes import lru_cache, SafeIO, QuantileSketch
+from ..utils import prefetch
 
 from .base import SeismicGeometry
+from .blosc import compress_blocks
+from .hdf5 import make_dataset_parameters
 
 
 
@@ -31,26 +38,57 @@ class SeismicGeometrySEGY(SeismicGeometry):
     (with correctly filled `INLINE_3D` and `CROSSLINE_3D` headers),
     so that post-stack cube can be loaded by providing path only.
 
-    Each instance is basically built around `dataframe` attribute, which describes mapping from
+    Each instance is basically built around `header_columns` attribute, which contains values of loaded headers
+    for every trace in the file. For two-dimensional index, they are used to create `index_matrix`:
+    a dense `int64` array of `lens` shape, which maps spatial position to trace number (-1 for missing traces),
+    so that slide and crop indices are created by plain `NumPy` slicing.
+    `dataframe` attribute is a lazily created `pandas` view of the same headers, which describes mapping from
     indexing headers to trace numbers. It is used to, for example, get all trace indices from a desired `FieldRecord`.
     `set_index` method can be called to change indexing headers of the dataframe.
 
+    Loaded headers, along with `index_matrix` and a fingerprint of the file (its size, modification time and
+    number of traces), are stored in the `.meta` next to the cube along with collected stats or on request.
+    When the same SEG-Y is opened again, they are used instead of re-reading all the trace headers;
+    changes to the file invalidate the whole `.meta`, including the stats.
+
+    Data section of the file is mapped as a strided `np.memmap` (`memmap` attribute) with trace headers skipped through
+    the stride, so that contiguous runs of traces are read with a handful of `NumPy` calls. IBM floats are decoded
+    vectorized and in-place. If the sample format is not supported, `segyio` is used to read traces.
+
     One can add stats to the instance by calling `collect_stats` method, that makes a full pass through
     the cube in order to analyze distribution of amplitudes. It also collects a number of trace examples
     into `trace_container` attribute, that can be used for later evaluation of various statistics.
     """
     #pylint: disable=attribute-defined-outside-init, too-many-instance-attributes, redefined-builtin
+    # SEG-Y sample format code to dtype of stored values; IBM floats are stored as `uint32` and decoded after reading
+    FORMAT_TO_DTYPE = {1: 'u4', 2: 'i4', 3: 'i2', 5: 'f4', 8: 'i1'}
+
     def __init__(self, path, headers=None, index_headers=None, **kwargs):
         self.structured = False
         self.quantized = False
-        self.dataframe = None
+        self.header_columns = None
+        self.index_matrix = None
+        self._dataframe = None
         self.segyfile = None
+        self.memmap = None
+        self.memmap_spec = None
+        self.sample_format = None
 
         self.headers = headers or self.HEADERS_POST
         self.index_headers = index_headers or self.INDEX_POST
 
         super().__init__(path, **kwargs)
 
+    @property
+    def dataframe(self):
+        """ Pandas view of loaded headers, indexed by `index_headers`. Created at the time of the first access. """
+        if self._dataframe is None:
+            dataframe = pd.DataFrame(self.header_columns)
+            dataframe.reset_index(inplace=True)
+            dataframe.rename(columns={'index': 'trace_index'}, inplace=True)
+            self._dataframe = dataframe.set_index(self.index_headers)
+        return self._dataframe
+
     def set_index(self, index_headers, sortby=None):
         """ Change current index to a subset of loaded headers. """
         self.dataframe.reset_index(inplace=True)
@@ -62,44 +100,71 @@ class SeismicGeometrySEGY(SeismicGeometry):
 
 
     # Methods of inferring dataframe and amplitude stats
-    def process(self, collect_stats=False, recollect=False, **kwargs):
-        """ Create dataframe based on `segy` file headers. """
+    def process(self, collect_stats=False, recollect=False, reindex=False, store_index=False, dead_traces='index',
+                **kwargs):
+        """ Create dataframe based on `segy` file headers.
+
+        Parameters
+        ----------
+        collect_stats : bool
+            Whether to collect stats about values, if they are not already stored in the `.meta`.
+        recollect : bool
+            Whether to ignore stats, stored in the `.meta`.
+        reindex : bool
+            Whether to re-read trace headers from the file, even if a valid index is stored in the `.meta`.
+        store_index : bool
+            Whether to store the index in the `.meta`, if it was read from the file. Opening a cube never writes
+            to the disk otherwise: the index is also stored along with the stats by :meth:`.collect_stats`.
+        dead_traces : {'index', 'headers'}
+            How to detect dead traces, if they are not stored in the `.meta`. Amplitudes are never read for that:
+            exact `zero_traces` are computed during :meth:`.collect_stats` and :meth:`.convert`.
+            See :meth:`.compute_dead_traces` for details.
+        """
         # Note that all the `segyio` structure inference is disabled
         self.segyfile = SafeIO(self.path, opener=segyio.open, mode='r', strict=False, ignore_geometry=True)
         self.segyfile.mmap()
+        self.memmap = self.make_memmap()
 
         self.depth = len(self.segyfile.trace[0])
         self.delay = self.segyfile.header[0].get(segyio.TraceField.DelayRecordingTime)
         self.sample_rate = segyio.dt(self.segyfile) / 1000
 
-        # Load all the headers
-        dataframe = {}
-        for column in self.headers:
-            dataframe[column] = self.segyfile.attributes(getattr(segyio.TraceField, column))[slice(None)]
-
-        dataframe = pd.DataFrame(dataframe)
-        dataframe.reset_index(inplace=True)
-        dataframe.rename(columns={'index': 'trace_index'}, inplace=True)
-        self.dataframe = dataframe.set_index(self.index_headers)
-
-        self.add_attributes()
+        # Stats and dead traces, stored for a previous state of the file, must not be used
+        has_meta = os.path.exists(self.path_meta)
+        if has_meta and self.meta_is_stale():
+            has_meta = False
+            if not collect_stats:
+                warn(f'`.meta` of {self.displayed_name} does not match the current state of the file and is ignored. '
+                     'Use `collect_stats=True` to recollect it.')
+            for item in self.PRESERVED_LAZY:
+                setattr(self, item, None)
+
+        # Load all the headers: either from the stored index or from the file itself
+        index = self.load_index() if has_meta and not reindex else None
+
+        if index is None:
+            self.header_columns = {}
+            for column in self.headers:
+                self.header_columns[column] = self.segyfile.attributes(getattr(segyio.TraceField, column))[slice(None)]
+            self.add_attributes()
+
+            if store_index:
+                self.store_index()
+        else:
+            self.header_columns, uniques, index_matrix = index
+            self.add_attributes(uniques=uniques, index_matrix=index_matrix)
 
         # Collect stats, if needed and not collected previously
-        if os.path.exists(self.path_meta) and not recollect:
+        if has_meta and not recollect and self.meta_has_stats():
             self.load_meta()
             self.has_stats = True
         elif collect_stats:
             self.collect_stats(**kwargs)
 
-        # Create a matrix with ones at fully-zero traces
+        # Create a matrix with ones at dead traces: either stored in the `.meta` or inferred from headers only
         if self.index_headers == self.INDEX_POST and not hasattr(self, 'zero_traces'):
-            try:
-                size = self.depth // 10
-                slc = np.stack([self[:, :, i * size] for i in range(1, 10)], axis=0)
-                self.zero_traces = np.zeros(self.lens, dtype=np.int32)
-                self.zero_traces[np.std(slc, axis=0) == 0] = 1
-            except ValueError: # can't reshape
-                pass
+            zero_traces = self.load_meta_item('zero_traces') if has_meta else None
+            self.zero_traces = zero_traces if zero_traces is not None else self.compute_dead_traces(mode=dead_traces)
 
         # Store additional segy info
         self.segy_path = self.path
@@ -109,14 +174,17 @@ class SeismicGeometrySEGY(SeismicGeometry):
         self.rotation_matrix = self.compute_rotation_matrix()
         self.area = self.compute_area()
 
-    def add_attributes(self):
-        """ Infer info about curent index from `dataframe` attribute. """
+    def add_attributes(self, uniques=None, index_matrix=None):
+        """ Infer info about curent index from `header_columns` attribute.
+        Pre-computed `uniques` and `index_matrix` can be passed to avoid evaluating them.
+        """
         self.index_len = len(self.index_headers)
         self._zero_trace = np.zeros(self.depth)
 
         # Unique values in each of the indexing column
-        self.unsorted_uniques = [np.unique(self.dataframe.index.get_level_values(i).values)
-                                 for i in range(self.index_len)]
+        if uniques is None:
+            uniques = [np.unique(self.header_columns[header]) for header in self.index_headers]
+        self.unsorted_uniques = uniques
         self.uniques = [np.sort(item) for item in self.unsorted_uniques]
         self.uniques_inversed = [{v: j for j, v in enumerate(self.uniques[i])}
                                  for i in range(self.index_len)]
@@ -127,25 +195,116 @@ class SeismicGeometrySEGY(SeismicGeometry):
         self.ranges = [(np.min(item), np.max(item)) for item in self.uniques]
 
         self.cube_shape = np.asarray([*self.lens, self.depth])
+        if index_matrix is None and self.index_len == 2:
+            index_matrix = self.make_index_matrix()
+        self.index_matrix = index_matrix
 
-    def _get_store_key(self, traceseqno):
-        """ get trace lateral coordinates from header """
-        header = self.segyfile.header[traceseqno]
-        # i -> id in a dataframe
-        keys = [header.get(field) for field in self.byte_no]
-        store_key = tuple(self.uniques_inversed[j][item] for j, item in enumerate(keys))
-        return store_key
-
-    def collect_stats(self, spatial=True, bins=25, num_keep=10000, pbar=True, **kwargs):
-        """ Pass through file data to collect stats:
-            - min/max values.
-            - a number of quantiles of values in the cube.
-            - certain amount of traces are stored in a `trace_container` attribute.
-
-        If `spatial` is True, makes an additional pass through the cube to obtain following:
+    def make_index_matrix(self):
+        """ Create a dense matrix of `lens` shape with trace numbers at each position; -1 for missing traces.
+        If multiple traces share the same position, the first one is used.
+        """
+        positions = [np.searchsorted(self.uniques[i], self.header_columns[header])
+                     for i, header in enumerate(self.index_headers)]
+        trace_indices = np.arange(len(positions[0]), dtype=np.int64)
+
+        index_matrix = np.full(self.lens, -1, dtype=np.int64)
+        index_matrix[positions[0][::-1], positions[1][::-1]] = trace_indices[::-1]
+        return index_matrix
+
+
+    # Persisting the index in the `.meta`
+    @property
+    def fingerprint(self):
+        """ Identifier of the current state of SEG-Y file: its size, modification time and number of traces. """
+        stat = os.stat(self.path)
+        return np.array([stat.st_size, stat.st_mtime_ns, len(self.segyfile.header)], dtype=np.int64)
+
+    def store_index(self, path=None):
+        """ Store loaded headers, uniques of the current index, `index_matrix` and file fingerprint in the `.meta`.
+        Uses either provided `path` or `path_meta` attribute. Previously stored index is overwritten.
+        """
+        path_meta = path or self.path_meta
+
+        with h5py.File(path_meta, 'a') as file_meta:
+            if 'index' in file_meta:
+                del file_meta['index']
+            group = file_meta.create_group('index')
+
+            group['fingerprint'] = self.fingerprint
+            group['index_headers'] = np.array(self.index_headers, dtype='S')
+            for header, values in self.header_columns.items():
+                group['headers/' + header] = values
+            for i, values in enumerate(self.unsorted_uniques):
+                group[f'uniques/{i}'] = values
+            if self.index_matrix is not None:
+                group['index_matrix'] = self.index_matrix
+
+    def meta_is_stale(self):
+        """ Check whether the `.meta` was created for a different state of the file: its stored fingerprint does not
+        match the current one. Such `.meta` is ignored as a whole, as its stats and `zero_traces` may be wrong.
+        `.meta` files without a stored index can't be checked and are assumed to be valid.
+        """
+        try:
+            with h5py.File(self.path_meta, 'r') as file_meta:
+                fingerprint = file_meta.get('index/fingerprint')
+                return fingerprint is not None and not np.array_equal(fingerprint[()], self.fingerprint)
+        except OSError:
+            # Unreadable `.meta`, for example, partially written by another process
+            return True
+
+    def load_index(self):
+        """ Load headers, uniques and `index_matrix` from the `.meta`.
+        Returns None, if the index is not stored, the fingerprint does not match the current state of the file,
+        or some of the required headers are missing.
+        """
+        if not os.path.exists(self.path_meta):
+            return None
+
+        with h5py.File(self.path_meta, 'r') as file_meta:
+            group = file_meta.get('index')
+            if group is None or not np.array_equal(group['fingerprint'][()], self.fingerprint):
+                return None
+            if not all(header in group['headers'] for header in self.headers):
+                return None
+
+            header_columns = {header: group['headers/' + header][()] for header in self.headers}
+
+            # Uniques and matrix depend on the index: use them only if it is the same
+            index_headers = [item.decode('ascii') for item in group['index_headers'][()]]
+            if index_headers != list(self.index_headers):
+                return header_columns, None, None
+
+            uniques = [group[f'uniques/{i}'][()] for i in range(len(index_headers))]
+            index_matrix = group['index_matrix'][()] if 'index_matrix' in group else None
+        return header_columns, uniques, index_matrix
+
+    def meta_has_stats(self):
+        """ Check whether the `.meta` contains stats, and not only the stored index. """
+        with h5py.File(self.path_meta, 'r') as file_meta:
+            return 'info' in file_meta
+
+    def store_meta(self, path=None, **kwargs):
+        """ Store collected stats on disk. If stored next to the SEG-Y, also stores the index. """
+        super().store_meta(path=path, **kwargs)
+
+        if path is None or os.path.abspath(path) == os.path.abspath(self.path_meta):
+            self.store_index(path=path)
+
+    def collect_stats(self, spatial=True, bins=25, num_keep=10000, keep_traces=True, num_workers=None,
+                      chunk_size=1024, relative_accuracy=0.005, pbar=True, **kwargs):
+        """ Pass through file data to collect stats. Traces are processed in blocks of `chunk_size`, and
+        ranges of traces are spread across a process pool, so that each trace is read exactly once per pass:
             - min/max/mean/std for every trace - `min_matrix`, `max_matrix` and so on.
+            - min/max/mean/std values.
+            - a number of quantiles of values in the cube, estimated with a mergeable streaming sketch of all
+            non-zero traces (`v_sketch` attribute); see :class:`~.QuantileSketch` for details.
+            - certain amount of traces are stored in a `trace_container` attribute, if `keep_traces` is True.
+
+        If `spatial` is True, the same pass also collects:
             - histogram of values for each trace: - `hist_matrix`.
             - bins for histogram creation: - `bins`.
+        Bins are uniform over the range of sampled traces, which is known before the pass. Values outside of it
+        are counted in the outermost bins, and their edges are then extended to the range of values in the cube.
 
         Parameters
         ----------
@@ -154,30 +313,53 @@ class SeismicGeometrySEGY(SeismicGeometry):
         bins : int or str
             Number of bins or name of automatic algorithm of defining number of bins.
         num_keep : int
-            Number of traces to store.
+            Number of traces to sample for bins creation and to store.
+        keep_traces : bool
+            Whether to store sampled traces in the `trace_container` attribute.
+        num_workers : int, optional
+            Number of processes to use. If not provided, uses the number of CPUs.
+            If 1 or the file can't be memory mapped, stats are collected in the current process.
+        chunk_size : int
+            Number of traces to process at once.
+        relative_accuracy : float
+            Relative accuracy of quantiles of values.
         """
-        #pylint: disable=not-an-iterable
         _ = kwargs
 
         num_traces = len(self.segyfile.header)
-        frequency = num_traces // num_keep
-
-        # Get min/max values, store some of the traces
-        trace_container = []
-        value_min, value_max = np.inf, -np.inf
+        frequency = max(1, num_traces // num_keep)
+
+        # Load a sample of traces
+        trace_container = self.load_traces(np.arange(0, num_traces, frequency))
+        trace_container = trace_container[trace_container.min(axis=1) != trace_container.max(axis=1)]
+        trace_container = trace_container.ravel()
+        bins = np.histogram_bin_edges(trace_container, bins).astype(np.float64) if spatial else None
+
+        # Split traces into ranges and collect stats for each of them
+        ranges = [(start, min(start + chunk_size * 16, num_traces))
+                  for start in range(0, num_traces, chunk_size * 16)]
+        results = self._collect_ranges_stats(ranges, bins=bins, num_workers=num_workers, chunk_size=chunk_size,
+                                             relative_accuracy=relative_accuracy,
+                                             desc=f'Collecting stats for {self.displayed_name}', pbar=pbar)
+
+        # Scatter stats of each trace into spatial matrices
+        positions = tuple(np.searchsorted(self.uniques[i], self.header_columns[header])
+                          for i, header in enumerate(self.index_headers))
         min_matrix, max_matrix = np.full(self.lens, np.nan), np.full(self.lens, np.nan)
+        mean_matrix, std_matrix = np.full(self.lens, np.nan), np.full(self.lens, np.nan)
+        hist_matrix = np.full((*self.lens, len(bins) - 1), np.nan) if spatial else None
+        sketch = QuantileSketch(relative_accuracy=relative_accuracy)
 
-        for i in tqdm(range(num_traces), desc='Finding min/max', ncols=800, disable=(not pbar)):
-            trace = self.segyfile.trace[i]
-            store_key = self._get_store_key(i)
+        for start, stop, trace_min, trace_max, trace_mean, trace_std, trace_hist, range_sketch in results:
+            sketch.merge(range_sketch)
+            store_key = tuple(item[start:stop] for item in positions)
+            min_matrix[store_key], max_matrix[store_key] = trace_min, trace_max
+            mean_matrix[store_key], std_matrix[store_key] = trace_mean, trace_std
 
-            trace_min, trace_max = find_min_max(trace)
-            min_matrix[store_key] = trace_min
-            max_matrix[store_key] = trace_max
-
-            if i % frequency == 0 and trace_min != trace_max:
-                trace_container.extend(trace.tolist())
-                #TODO: add dtype for storing
+            if spatial:
+                trace_hist = trace_hist.astype(np.float64)
+                trace_hist[trace_min == trace_max] = np.nan
+                hist_matrix[store_key] = trace_hist
 
         # Store everything into instance
         self.min_matrix, self.max_matrix = min_matrix, max_matrix
@@ -187,57 +369,82 @@ class SeismicGeometrySEGY(SeismicGeometry):
         value_min = np.nanmin(min_matrix)
         value_max = np.nanmax(max_matrix)
 
-        # Collect more spatial stats: min, max, mean, std, histograms matrices
+        is_zero = self.zero_traces == 1
+        mean_matrix[is_zero], std_matrix[is_zero] = np.nan, np.nan
+        self.mean_matrix, self.std_matrix = mean_matrix, std_matrix
+
+        # Outermost bins hold all of the values outside of the sampled range
         if spatial:
-            # Make bins
-            bins = np.histogram_bin_edges(None, bins, range=(value_min, value_max)).astype(np.float)
+            bins[0], bins[-1] = min(bins[0], value_min), max(bins[-1], value_max)
             self.bins = bins
-
-            # Create containers
-            hist_matrix = np.full((*self.lens, len(bins)-1), np.nan)
-
-            # Iterate over traces
-            description = f'Collecting stats for {self.displayed_name}'
-            for i in tqdm(range(num_traces), desc=description, ncols=800, disable=(not pbar)):
-                trace = self.segyfile.trace[i]
-                store_key = self._get_store_key(i)
-
-                # For each trace, we store an entire histogram of amplitudes
-                val_min, val_max = find_min_max(trace)
-                if val_min != val_max:
-                    histogram = np.histogram(trace, bins=bins)[0]
-                    hist_matrix[store_key] = histogram
-
-            # Restore stats from histogram
-            midpoints = (bins[1:] + bins[:-1]) / 2
-            probs = hist_matrix / np.sum(hist_matrix, axis=-1, keepdims=True)
-
-            mean_matrix = np.sum(probs * midpoints, axis=-1)
-            std_matrix = np.sqrt(np.sum((np.broadcast_to(midpoints, (*mean_matrix.shape, len(midpoints))) - \
-                                         mean_matrix.reshape(*mean_matrix.shape, 1))**2 * probs,
-                                        axis=-1))
-
-            # Store everything into instance
-            self.mean_matrix, self.std_matrix = mean_matrix, std_matrix
             self.hist_matrix = hist_matrix
 
-        self.trace_container = np.array(trace_container)
+        self.trace_container = trace_container if keep_traces else None
+        self.v_sketch = sketch.to_array()
         self.v_uniques = len(np.unique(trace_container))
         self.v_min, self.v_max = value_min, value_max
-        self.v_mean, self.v_std = np.mean(trace_container), np.std(trace_container)
-        self.v_q001, self.v_q01, self.v_q05 = np.quantile(trace_container, [0.001, 0.01, 0.05])
-        self.v_q999, self.v_q99, self.v_q95 = np.quantile(trace_container, [0.999, 0.99, 0.95])
+        self.v_mean, self.v_std = sketch.mean, sketch.std
+        self.v_q001, self.v_q01, self.v_q05 = sketch.quantile([0.001, 0.01, 0.05])
+        self.v_q999, self.v_q99, self.v_q95 = sketch.quantile([0.999, 0.99, 0.95])
         self.has_stats = True
         self.store_meta()
 
+    def _collect_ranges_stats(self, ranges, bins, num_workers, chunk_size, relative_accuracy, desc, pbar):
+        """ Collect stats for each of the ranges of traces, spreading them across a process pool.
+        Returns a list of `(start, stop, *stats)` tuples in the order of completion.
+        """
+        num_workers = num_workers or os.cpu_count()
+        num_traces = ranges[-1][1] if ranges else 0
+        results = []
+
+        with tqdm(total=num_traces, desc=desc, ncols=800, disable=(not pbar)) as progress_bar:
+            if num_workers > 1 and self.memmap is not None and len(ranges) > 1:
+                with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                    futures = [executor.submit(collect_range_stats, self.memmap_spec, self.sample_format,
+                                               start, stop, bins, chunk_size, relative_accuracy)
+                               for start, stop in ranges]
+                    for future in as_completed(futures):
+                        results.append(future.result())
+                        progress_bar.update(results[-1][1] - results[-1][0])
+            else:
+                for start, stop in ranges:
+                    blocks = (self.load_traces(np.arange(start_, min(start_ + chunk_size, stop)))
+                              for start_ in range(start, stop, chunk_size))
+                    results.append((start, stop, *reduce_blocks(blocks, bins, relative_accuracy)))
+                    progress_bar.update(stop - start)
+        return results
+
     # Compute stats from CDP/LINES correspondence
+    def compute_dead_traces(self, mode='index'):
+        """ Create a matrix with ones at dead traces without reading any amplitudes.
+
+        Parameters
+        ----------
+        mode : {'index', 'headers'}
+            If `index`, then only traces, missing from the file, are marked as dead.
+            If `headers`, then also traces with `TraceIdentificationCode` of dead (2) or dummy (3) trace
+            or with zero `TRACE_SAMPLE_COUNT` are marked. Requires reading these headers for every trace.
+        """
+        if self.index_matrix is None:
+            return None
+
+        mask = self.index_matrix >= 0
+        zero_traces = (~mask).astype(np.int32)
+
+        if mode == 'headers':
+            codes = self.segyfile.attributes(segyio.TraceField.TraceIdentificationCode)[:]
+            sample_counts = self.segyfile.attributes(segyio.TraceField.TRACE_SAMPLE_COUNT)[:]
+            is_dead = np.isin(codes, [2, 3]) | (sample_counts == 0)
+            zero_traces[mask] = is_dead[self.index_matrix[mask]]
+        return zero_traces
+
     def compute_rotation_matrix(self):
         """ Compute transform from INLINE/CROSSLINE coordinates to CDP system. """
         ix_points = []
         cdp_points = []
 
         for _ in range(3):
-            idx = np.random.randint(len(self.dataframe))
+            idx = np.random.randint(len(self.segyfile.header))
             trace = self.segyfile.header[idx]
 
             # INLINE_3D -> CDP_X, CROSSLINE_3D -> CDP_Y
@@ -256,32 +463,43 @@ class SeismicGeometrySEGY(SeismicGeometry):
         ----------
         correct : bool
             Whether to correct computed area for zero traces.
+        shift : int
+            Distance in lines between the central trace and the ones, used to compute spacing of traces.
+            Reduced to fit into the cube; if the cube is only one line wide, the area is NaN.
+            Raises ValueError, if any of these traces is missing from the file.
         """
-        i = self.ilines[self.ilines_len // 2]
-        x = self.xlines[self.xlines_len // 2]
+        i = self.ilines_len // 2
+        x = self.xlines_len // 2
+
+        shift = min(shift, self.ilines_len - 1 - i, self.xlines_len - 1 - x)
+        if shift < 1:
+            return np.nan
+
+        def get_header(i, x):
+            # Missing traces are stored as -1 in the index: reading them would silently give the last trace
+            idx = self.index_matrix[i, x]
+            if idx < 0:
+                raise ValueError(f'Trace at ({self.ilines[i]}, {self.xlines[x]}) is missing in {self.displayed_name}: '
+                                 'use a different `shift` to compute the area.')
+            return self.segyfile.header[idx]
 
         # Central trace coordinates
-        idx = self.dataframe['trace_index'][(i, x)]
-        trace = self.segyfile.header[idx]
+        trace = get_header(i, x)
         cdp_x, cdp_y = (trace[segyio.TraceField.CDP_X], trace[segyio.TraceField.CDP_Y])
 
         # Two shifted traces
-        idx_dx = self.dataframe['trace_index'][(i, x + shift)]
-        trace_dx = self.segyfile.header[idx_dx]
+        trace_dx = get_header(i, x + shift)
         cdp_x_delta = abs(trace_dx[segyio.TraceField.CDP_X] - cdp_x)
 
-        idx_dy = self.dataframe['trace_index'][(i + shift, x)]
-        trace_dy = self.segyfile.header[idx_dy]
+        trace_dy = get_header(i + shift, x)
         cdp_y_delta = abs(trace_dy[segyio.TraceField.CDP_Y] - cdp_y)
 
         # Traces if CDP_X/CDP_Y coordinate system is rotated on 90 degrees with respect to ILINES/CROSSLINES
         if cdp_x_delta == 0 and cdp_y_delta == 0:
-            idx_dx = self.dataframe['trace_index'][(i + shift, x)]
-            trace_dx = self.segyfile.header[idx_dx]
+            trace_dx = get_header(i + shift, x)
             cdp_x_delta = abs(trace_dx[segyio.TraceField.CDP_X] - cdp_x)
 
-            idx_dy = self.dataframe['trace_index'][(i, x + shift)]
-            trace_dy = self.segyfile.header[idx_dy]
+            trace_dy = get_header(i, x + shift)
             cdp_y_delta = abs(trace_dy[segyio.TraceField.CDP_Y] - cdp_y)
 
         cdp_x_delta /= shift
@@ -300,20 +518,75 @@ class SeismicGeometrySEGY(SeismicGeometry):
     # 1D
     def load_trace(self, index):
         """ Load individual trace from segyfile.
-        If passed `np.nan`, returns trace of zeros.
+        If passed `np.nan` or negative index, returns trace of zeros.
         """
         # TODO: can be improved by creating buffer and writing directly to it
-        if not np.isnan(index):
+        if index >= 0:
             return self.segyfile.trace.raw[int(index)]
         return self._zero_trace
 
-    def load_traces(self, trace_indices):
-        """ Stack multiple traces together. """
-        # TODO: can be improved by preallocating memory and passing it as a buffer to `load_trace`
-        return np.stack([self.load_trace(idx) for idx in trace_indices])
+    def load_traces(self, trace_indices, heights=None, buffer=None):
+        """ Load multiple traces into a (possibly, supplied) `float32` buffer.
+        Negative (or `np.nan`) indices correspond to missing traces, which are filled with zeros.
+
+        Parameters
+        ----------
+        trace_indices : sequence of ints
+            Ordinal numbers of traces in the file.
+        heights : slice, optional
+            Range of samples to load from each trace. If not provided, traces are loaded entirely.
+        buffer : ndarray, optional
+            Array of (len(trace_indices), number of samples) shape to put loaded traces in.
+        """
+        heights = slice(*(heights or slice(None)).indices(self.depth))
+        n_samples = len(range(heights.start, heights.stop, heights.step))
+        if buffer is None:
+            buffer = np.empty((len(trace_indices), n_samples), dtype=np.float32)
+        if len(trace_indices) == 0:
+            return buffer
+
+        if self.memmap is None:
+            for i, idx in enumerate(trace_indices):
+                buffer[i] = self.load_trace(idx)[heights]
+            return buffer
+
+        # Split indices into runs of contiguous traces: each run is a strided view of the `memmap`
+        trace_indices = np.nan_to_num(np.asarray(trace_indices, dtype=np.float64), nan=-1).astype(np.int64)
+        breaks = np.nonzero((np.diff(trace_indices) != 1) | (trace_indices[:-1] < 0))[0] + 1
+        starts = np.concatenate([[0], breaks])
+        stops = np.concatenate([breaks, [len(trace_indices)]])
+
+        for start, stop in zip(starts, stops):
+            first = trace_indices[start]
+            if first < 0:
+                buffer[start:stop] = 0
+                continue
+
+            read_traces(self.memmap, self.sample_format, first, first + (stop - start),
+                        heights=heights, buffer=buffer[start:stop])
+        return buffer
+
+    def make_memmap(self):
+        """ Map the data section of the file as a strided `np.memmap`: each row is a trace without its header.
+        Returns None, if the sample format is not supported or traces have varying lengths.
+        """
+        metrics = self.segyfile.xfd.metrics()
+        self.sample_format = metrics['format']
+        if self.sample_format not in self.FORMAT_TO_DTYPE:
+            return None
+
+        byteorder = '>' if self.segyfile.endian == 'big' else '<'
+        dtype = np.dtype(byteorder + self.FORMAT_TO_DTYPE[self.sample_format])
+        n_samples = metrics['samplecount']
+        if metrics['trace_bsize'] != n_samples * dtype.itemsize:
+            return None
+
+        trace_dtype = np.dtype([('header', np.void, 240), ('data', dtype, (n_samples,))])
+        self.memmap_spec = (self.path, trace_dtype, metrics['trace0'], metrics['tracecount'])
+        return open_memmap(*self.memmap_spec)
 
     # 2D
-    @lru_cache(128, attributes='index_headers')
+    @lru_cache(128, attributes='index_headers', budget=True, shared=True)
     def load_slide(self, loc=None, axis=0, start=None, end=None, step=1, stable=True):
         """ Create indices and load actual traces for one slide.
 
@@ -335,16 +608,67 @@ class SeismicGeometrySEGY(SeismicGeometry):
             indices = self.make_slide_indices(loc=loc, start=start, end=end, step=step, axis=axis, stable=stable)
             slide = self.load_traces(indices)
         elif axis == 2:
-            slide = self.segyfile.depth_slice[loc]
-
-            if slide.shape[0] == np.prod(self.lens):
-                slide = slide.reshape(self.lens)
+            if self.index_matrix is None:
+                slide = self.segyfile.depth_slice[loc].reshape(self.lens)
             else:
-                buffer = np.zeros_like(self.zero_traces, dtype=np.float32)
-                buffer[self.zero_traces == 0] = slide
-                slide = buffer
+                slide = self.load_depth_slab(loc, loc + 1)[..., 0]
+        else:
+            raise ValueError(f'Axis must be 0, 1 or 2, got {axis} instead.')
         return slide
 
+    def load_depth_slab(self, h_start, h_stop, locations=None, chunk_size=4096, max_gap=64):
+        """ Load a range of depths for all of the traces in a spatial window, reading each of them once.
+        Requested traces are sorted in file order and split into runs, where consecutive traces are no more than
+        `max_gap` traces apart. Each run is read sequentially by chunks of `chunk_size`, so the amount of read
+        traces is bounded by the requested ones, even if the window is narrow along the fastest axis of the file.
+
+        Parameters
+        ----------
+        h_start, h_stop : ints
+            Range of samples to load.
+        locations : sequence of two slices, optional
+            Spatial window to load, along the first and the second index. Default is the whole cube.
+        chunk_size : int
+            Number of consecutive traces to read at once.
+        max_gap : int
+            Maximum number of unrequested traces between two requested ones to read them in the same run.
+
+        Returns
+        -------
+        Array of (ilines, xlines, h_stop - h_start) shape. Missing traces are filled with zeros.
+        """
+        locations = locations or (slice(None), slice(None))
+        index_matrix = self.index_matrix[locations[0], locations[1]]
+        heights = slice(h_start, h_stop)
+
+        slab = np.zeros((*index_matrix.shape, h_stop - h_start), dtype=np.float32)
+        flat_slab = slab.reshape(-1, h_stop - h_start)
+
+        # Requested traces in file order along with their positions in the slab
+        indices = index_matrix.ravel()
+        positions = np.flatnonzero(indices >= 0)
+        if len(positions) == 0:
+            return slab
+        order = np.argsort(indices[positions], kind='stable')
+        trace_indices, positions = indices[positions][order], positions[order]
+
+        breaks = np.flatnonzero(np.diff(trace_indices) > max_gap + 1) + 1
+        starts = np.concatenate([[0], breaks])
+        stops = np.concatenate([breaks, [len(trace_indices)]])
+
+        buffer = np.empty((chunk_size, h_stop - h_start), dtype=np.float32)
+        for run_start, run_stop in zip(starts, stops):
+            first, last = trace_indices[run_start], trace_indices[run_stop - 1] + 1
+
+            for chunk_start in range(first, last, chunk_size):
+                chunk_stop = min(chunk_start + chunk_size, last)
+                lo, hi = run_start + np.searchsorted(trace_indices[run_start:run_stop], [chunk_start, chunk_stop])
+
+                traces = self.load_traces(np.arange(chunk_start, chunk_stop), heights=heights,
+                                          buffer=buffer[:chunk_stop - chunk_start])
+                flat_slab[positions[lo:hi]] = traces[trace_indices[lo:hi] - chunk_start]
+        return slab
+
     def make_slide_indices(self, loc=None, axis=0, start=None, end=None, step=1, stable=True, return_iterator=False):
         """ Choose appropriate version of index creation, depending on length of the current index.
 
@@ -390,24 +714,23 @@ class SeismicGeometrySEGY(SeismicGeometry):
         return indices
 
     def make_slide_indices_2d(self, loc, axis=0, stable=True, return_iterator=False):
-        """ 2D version of index creation. """
+        """ 2D version of index creation: slice of `index_matrix`.
+        If `stable`, then only existing traces are kept in the order of the segyfile.
+        Otherwise, missing traces are marked with -1.
+        """
         other_axis = 1 - axis
-        location = self.uniques[axis][loc]
-
-        if stable:
-            others = self.dataframe[self.dataframe.index.get_level_values(axis) == location]
-            others = others.index.get_level_values(other_axis).values
-        else:
-            others = self.uniques[other_axis]
-
-        iterator = list(zip([location] * len(others), others) if axis == 0 else zip(others, [location] * len(others)))
-        indices = self.dataframe['trace_index'].reindex(iterator, fill_value=np.nan).values
+        indices = self.index_matrix[loc, :] if axis == 0 else self.index_matrix[:, loc]
+        others = self.uniques[other_axis]
 
-        #TODO: keep only uniques, when needed, with `nan` filtering
         if stable:
-            indices = np.unique(indices)
+            positions = np.nonzero(indices >= 0)[0]
+            positions = positions[np.argsort(indices[positions], kind='stable')]
+            indices, others = indices[positions], others[positions]
 
         if return_iterator:
+            location = self.uniques[axis][loc]
+            iterator = list(zip([location] * len(others), others) if axis == 0
+                            else zip(others, [location] * len(others)))
             return indices, iterator
         return indices
 
@@ -428,18 +751,14 @@ class SeismicGeometrySEGY(SeismicGeometry):
         """
         shape = np.array([((slc.stop or stop) - (slc.start or 0)) for slc, stop in zip(locations, self.cube_shape)])
         indices = self.make_crop_indices(locations)
-        crop = self.load_traces(indices)[..., locations[-1]].reshape(shape)
+        crop = self.load_traces(indices, heights=locations[-1]).reshape(shape)
         return crop
 
     def make_crop_indices(self, locations):
-        """ Create indices for 3D crop loading. """
-        iterator = list(product(*[[self.uniques[idx][i] for i in range(locations[idx].start, locations[idx].stop)]
-                                  for idx in range(2)]))
-        indices = self.dataframe['trace_index'].reindex(iterator, fill_value=np.nan).values
-        _, unique_ind = np.unique(indices, return_index=True)
-        return indices[np.sort(unique_ind, kind='stable')]
+        """ Create indices for 3D crop loading: flattened slice of `index_matrix`, -1 for missing traces. """
+        return self.index_matrix[locations[0], locations[1]].ravel()
 
-    def load_crop(self, locations, threshold=15, mode='adaptive', **kwargs):
+    def load_crop(self, locations, threshold=15, mode='adaptive', out=None, normalize=None, **kwargs):
         """ Smart choice between using :meth:`._load_crop` and stacking multiple slides created by :meth:`.load_slide`.
 
         Parameters
@@ -447,8 +766,14 @@ class SeismicGeometrySEGY(SeismicGeometry):
         mode : str
             If `adaptive`, then function to load is chosen automatically.
             If `slide` or `crop`, then uses that function to load data.
+            If `slab`, then uses :meth:`.load_depth_slab` to read every trace in the spatial window once.
         threshold : int
             Upper bound for amount of slides to load. Used only in `adaptive` mode.
+        out : ndarray, optional
+            Preallocated array to write the crop into. Its dtype is used for the output: for example, `float16`.
+        normalize : None, bool or str
+            If provided, then crop is normalized in the same pass over data as the cast to the output dtype and the
+            transposition: see :meth:`~.SeismicGeometry.normalize` for available modes.
         """
         _ = kwargs
         shape = np.array([((slc.stop or stop) - (slc.start or 0)) for slc, stop in zip(locations, self.cube_shape)])
@@ -458,25 +783,34 @@ class SeismicGeometrySEGY(SeismicGeometry):
                 mode = 'slide' if min(shape) < threshold else 'crop'
             else:
                 flag = np.prod(shape[:2]) / np.prod(self.cube_shape[:2])
-                mode = 'slide' if flag > 0.1 else 'crop'
+                mode = 'slab' if flag > 0.1 else 'crop'
 
-        if mode == 'slide':
+        if mode == 'slab':
+            slc = locations[2]
+            crop = self.load_depth_slab(slc.start or 0, slc.stop or self.depth, locations=locations[:2])
+        elif mode == 'slide':
             slc = locations[axis]
             if axis == 0:
-                return np.stack([self.load_slide(loc, axis=axis)[locations[1], locations[2]]
+                crop = np.stack([self.load_slide(loc, axis=axis, stable=False)[locations[1], locations[2]]
                                  for loc in range(slc.start, slc.stop)], axis=axis)
-            if axis == 1:
-                return np.stack([self.load_slide(loc, axis=axis)[locations[0], locations[2]]
+            elif axis == 1:
+                crop = np.stack([self.load_slide(loc, axis=axis, stable=False)[locations[0], locations[2]]
                                  for loc in range(slc.start, slc.stop)], axis=axis)
-            if axis == 2:
-                return np.stack([self.load_slide(loc, axis=axis)[locations[0], locations[1]]
+            else:
+                crop = np.stack([self.load_slide(loc, axis=axis, stable=False)[locations[0], locations[1]]
                                  for loc in range(slc.start, slc.stop)], axis=axis)
-        return self._load_crop(locations)
+        else:
+            crop = self._load_crop(locations)
+        return self.postprocess_crop(crop, out=out, normalize=normalize)
 
 
     # Quantization
-    def compute_quantization_parameters(self, ranges='q99', clip=True, center=False):
-        """ Make bins for int8 quantization and convert value-stats.
+    QUANTIZATION_DTYPES = {'int8': np.int8, 'int16': np.int16, 'float16': np.float16, 'bounded': np.int16}
+
+    def compute_quantization_parameters(self, ranges='q99', clip=True, center=False, mode='int8', max_error=0.01):
+        """ Make bins for int8 quantization and convert value-stats, or prepare other modes of lossy storage.
+        Parameters are returned as a dictionary with the same keys, as in the meta of converted cubes:
+        the instance itself is not changed, so that they don't leak into the following conversions.
 
         Parameters
         ----------
@@ -488,12 +822,49 @@ class SeismicGeometrySEGY(SeismicGeometry):
             Whether to clip data to selected ranges.
         center : bool
             Whether to make data have 0-mean before quantization.
+        mode : {'int8', 'int16', 'float16', 'bounded'}
+            Mode of quantization:
+                - `int8` to uniformly binarize data in `ranges`. Loaded data is in the units of bins.
+                - `int16` to store data as `int16` with a separate scale for each iline, computed from its maximum
+                  absolute value. No clipping is done, and the error is no more than half of the scale.
+                - `float16` to store data as half-precision floats.
+                - `bounded` to store data as `int16` multiples of a step, so that the absolute error is guaranteed
+                  to be no bigger than `max_error`. No clipping is done.
+            `ranges`, `clip` and `center` are used only in the `int8` mode.
+            For all modes, but the `int8`, loaded data is restored to the original amplitudes.
+        max_error : number
+            Maximum absolute error in the `bounded` mode, in the units of the standard deviation of amplitudes.
         """
+        if mode not in self.QUANTIZATION_DTYPES:
+            raise ValueError(f'Unknown quantization mode `{mode}`, use one of {list(self.QUANTIZATION_DTYPES)}.')
+        qnt = {'qnt_mode': mode,
+               'qnt_error_stats': np.zeros(4)} # sum of absolute errors, sum of squares, number of values, max error
+        max_value = max(abs(self.v_min), abs(self.v_max))
+
+        if mode == 'int16':
+            qnt['qnt_scales'] = np.ones(self.cube_shape[0], dtype=np.float32)
+            return qnt
+        if mode == 'float16':
+            if max_value > np.finfo(np.float16).max:
+                raise ValueError(f'Values up to {max_value} can not be stored as `float16`!')
+            return qnt
+        if mode == 'bounded':
+            # Data is restored as `float32(value * step)`: leave a margin for the rounding of that product,
+            # and make the step itself exactly representable in `float32`, so that the bound holds after loading
+            step = 2 * (max_error * self.v_std - max_value * 2 ** -23)
+            step_float32 = np.float32(step)
+            if step_float32 > step:
+                step_float32 = np.nextafter(step_float32, np.float32(0))
+            qnt['qnt_step'] = float(step_float32)
+            if qnt['qnt_step'] <= 0 or max_value / qnt['qnt_step'] > np.iinfo(np.int16).max:
+                raise ValueError(f'Error bound {max_error} is too small for values up to {max_value}!')
+            return qnt
+
         ranges_dict = {
             'q95': min(abs(self.v_q05), abs(self.v_q95)),
             'q99': min(abs(self.v_q01), abs(self.v_q99)),
             'q999': min(abs(self.v_q001), abs(self.v_q999)),
-            'same': max(abs(self.v_min), abs(self.v_max)),
+            'same': max_value,
         }
         if ranges in ranges_dict:
             ranges = ranges_dict[ranges]
@@ -502,42 +873,96 @@ class SeismicGeometrySEGY(SeismicGeometry):
         if center:
             ranges = tuple(item - self.v_mean for item in ranges)
 
-        self.qnt_ranges = ranges
-        self.qnt_bins = np.histogram_bin_edges(None, bins=254, range=ranges).astype(np.float)
-        self.qnt_clip = clip
-        self.qnt_center = center
+        qnt['qnt_ranges'] = ranges
+        qnt['qnt_bins'] = np.histogram_bin_edges(None, bins=254, range=ranges).astype(np.float)
+        qnt['qnt_clip'] = clip
+        qnt['qnt_center'] = center
 
         # Compute quantized statistics
-        quantized_tc = self.quantize(self.trace_container)
-        self.qnt_min, self.qnt_max = self.quantize(self.v_min), self.quantize(self.v_max)
-        self.qnt_mean, self.qnt_std = np.mean(quantized_tc), np.std(quantized_tc)
-        self.qnt_q001, self.qnt_q01, self.qnt_q05 = np.quantile(quantized_tc, [0.001, 0.01, 0.05])
-        self.qnt_q999, self.qnt_q99, self.qnt_q95 = np.quantile(quantized_tc, [0.999, 0.99, 0.95])
+        values = self.value_sample
+        quantized_tc = self.quantize(np.copy(values), qnt)
+        qnt['qnt_min'], qnt['qnt_max'] = self.quantize(self.v_min, qnt), self.quantize(self.v_max, qnt)
+        qnt['qnt_mean'], qnt['qnt_std'] = np.mean(quantized_tc), np.std(quantized_tc)
+        qnt['qnt_q001'], qnt['qnt_q01'], qnt['qnt_q05'] = np.quantile(quantized_tc, [0.001, 0.01, 0.05])
+        qnt['qnt_q999'], qnt['qnt_q99'], qnt['qnt_q95'] = np.quantile(quantized_tc, [0.999, 0.99, 0.95])
 
         # Estimate difference after quantization
         quantized_tc += 127
-        restored_tc = self.qnt_bins[quantized_tc]
-        self.qnt_error = np.mean(np.abs(restored_tc - self.trace_container)) / self.v_std
-
-    def quantize(self, array):
-        """ Convert array of floats to int8 values. """
-        if self.qnt_center:
+        restored_tc = qnt['qnt_bins'][quantized_tc]
+        qnt['qnt_error'] = np.mean(np.abs(restored_tc - values)) / self.v_std
+        return qnt
+
+    def quantize(self, array, qnt, start=0):
+        """ Convert array of floats to values of the quantization mode, described by `qnt` parameters:
+        see :meth:`.compute_quantization_parameters`.
+        `start` is the index of the first iline of `array`: used to store per-iline scales in the `int16` mode.
+        """
+        mode = qnt['qnt_mode']
+
+        if mode == 'float16':
+            return array.astype(np.float16)
+        if mode == 'bounded':
+            return np.round(np.divide(array, qnt['qnt_step'], dtype=np.float64)).astype(np.int16)
+        if mode == 'int16':
+            scales = np.abs(array).max(axis=tuple(range(1, array.ndim))) / np.iinfo(np.int16).max
+            scales[scales == 0] = 1
+            qnt['qnt_scales'][start:start + len(array)] = scales
+            return np.round(array / scales.reshape(-1, *[1] * (array.ndim - 1))).astype(np.int16)
+
+        if qnt['qnt_center']:
             array -= self.v_mean
-        if self.qnt_clip:
-            array = np.clip(array, *self.qnt_ranges)
-        array = np.digitize(array, self.qnt_bins) - 128
+        if qnt['qnt_clip']:
+            array = np.clip(array, *qnt['qnt_ranges'])
+        array = np.digitize(array, qnt['qnt_bins']) - 128
         return array.astype(np.int8)
 
+    def quantize_and_measure(self, array, qnt, start=0):
+        """ Quantize a slab of ilines and update exact stats of the quantization error with it. """
+        values = array.copy() if qnt.get('qnt_center', False) else array
+        quantized = self.quantize(array, qnt, start=start)
+
+        mode = qnt['qnt_mode']
+        if mode == 'int8':
+            restored = qnt['qnt_bins'][quantized.astype(np.int16) + 127]
+            if qnt['qnt_center']:
+                restored += self.v_mean
+        elif mode == 'int16':
+            scales = qnt['qnt_scales'][start:start + len(quantized)]
+            restored = quantized * scales.reshape(-1, *[1] * (quantized.ndim - 1))
+        elif mode == 'bounded':
+            restored = quantized * np.float32(qnt['qnt_step'])
+        else:
+            restored = quantized.astype(np.float32)
+
+        error = np.abs(np.subtract(restored, values, dtype=np.float64))
+        qnt['qnt_error_stats'][:3] += error.sum(), (error ** 2).sum(), error.size
+        qnt['qnt_error_stats'][3] = max(qnt['qnt_error_stats'][3], error.max())
+        return quantized
+
+    def finalize_quantization_error(self, qnt):
+        """ Store exact error stats, accumulated by :meth:`.quantize_and_measure`, in units of `v_std`:
+        mean absolute error in `qnt_error`, root mean squared one in `qnt_rmse` and maximum in `qnt_max_error`.
+        """
+        error_sum, squared_sum, size, max_error = qnt.pop('qnt_error_stats')
+        if size:
+            qnt['qnt_error'] = error_sum / size / self.v_std
+            qnt['qnt_rmse'] = np.sqrt(squared_sum / size) / self.v_std
+            qnt['qnt_max_error'] = max_error / self.v_std
+        return qnt
+
 
     # Convert SEG-Y
     def convert(self, format='blosc', path=None, postfix='', projections='ixh',
-                quantize=True, ranges='q99', clip=True, center=False, store_meta=True, pbar=True, **kwargs):
+                quantize=True, ranges='q99', clip=True, center=False, max_error=0.01, store_meta=True, pbar=True,
+                ram_budget=1.0, tmp_dir=None, workers=1, queue_size=None, **kwargs):
         """ Convert SEG-Y file to a more effective storage.
 
         Parameters
         ----------
-        format : {'hdf5', 'qhdf5', 'blosc', 'qblosc}
+        format : {'hdf5', 'qhdf5', 'blosc', 'qblosc', 'brick', 'qbrick', 'memmap', 'qmemmap'}
             Format of storage to convert to: `blosc` takes less space, but a touch slower, than `hdf5`.
+            `brick` stores only one copy of data, split into 3D bricks, and `projections` are ignored.
+            `memmap` is a directory with uncompressed `.npy` projections: the biggest one, but the fastest to read.
             Prefix `q` sets the `quantize` parameter to True.
         path : str
             If provided, then path to save file to.
@@ -546,10 +971,13 @@ class SeismicGeometrySEGY(SeismicGeometry):
             Optional string to add before extension. Used only if the `path` is not provided.
         projections : str
             Which projections of data to store: `i` for iline one, `x` for the crossline, `h` for depth.
-        quantize : bool
+        quantize : bool or str
             Whether to binarize data to `int8` dtype. `ranges`, `clip` and `center` define parameters of quantization.
             Binarization is done uniformly over selected `ranges` of values.
             If True, then `q` is appended to extension.
+            Can also be one of `int8`, `int16`, `float16` or `bounded` to choose the mode of lossy storage:
+            see :meth:`.compute_quantization_parameters` for details. For modes other than `int8`, `postfix` defaults
+            to the name of the mode. In all modes, exact error stats over the whole cube are stored in the meta.
         ranges : str
             Ranges to quantize data to. Available options are:
                 - `q95`, `q99`, `q999` to clip data to respective quantiles.
@@ -558,39 +986,85 @@ class SeismicGeometrySEGY(SeismicGeometry):
             Whether to clip data to selected ranges.
         center : bool
             Whether to make data have 0-mean before quantization.
+        max_error : number
+            Maximum absolute error of the `bounded` quantization, in the units of the standard deviation of amplitudes.
         store_meta : bool
             Whether to store meta near the save file.
         pbar : bool
             Whether to show progress bar during conversion.
+        ram_budget : number
+            Amount of memory (in GB) to use for one slab of ilines, read from the SEG-Y at once.
+        tmp_dir : str, optional
+            Directory for temporary buffers of `x` and `h` projections. Default is the directory of the saved file.
+        workers : int
+            If bigger than 1, then conversion is pipelined: reading, transformation (quantization) and
+            compression are done in parallel stages, connected by bounded queues, and slides are written in order.
+            For `blosc` format, compression is done by a pool of `workers` processes.
+            The produced file is the same, as with sequential conversion.
+        queue_size : int, optional
+            Maximum number of slides in each of the queues between stages. Default is `2 * workers`.
         kwargs : dict
             Other parameters, passed directly to the file constructor of chosen format.
             If format is `blosc`:
                 - `cname` for algorithm of compression. Default is `lz4hc`.
                 - `clevel` for level of compression. Default is 6.
                 - `shuffle` for bitshuffle during compression. Default is False.
+                - `block_shape` for the shape of independently compressed blocks of each slide, so that
+                  narrow crops decompress only the overlapping ones. Default is the whole slide.
+            If format is `hdf5`:
+                - `chunks` for the chunk shape of each projection, in the (iline, crossline, depth) ordering.
+                  If 'auto', then chunks are aligned to `crop_shape`. Default is contiguous storage.
+                - `crop_shape` for the typical shape of crops, used by the `auto` chunking.
+                - `compression`, `compression_opts` and `shuffle` for the filter to apply to chunks:
+                  `gzip`, `lzf`, or, if `hdf5plugin` is installed, `blosc`, `zstd` and `lz4`.
+                - `rdcc_nbytes`, `rdcc_nslots` and `rdcc_w0` for the chunk cache of the file.
+                  The same parameters can be passed when opening the converted geometry.
+            If format is `brick`, the same parameters of compression, as well as:
+                - `brick_shape` for the shape of bricks. Default is (64, 64, 64).
         """
-        #pylint: disable=import-outside-toplevel
+        #pylint: disable=import-outside-toplevel, too-many-branches, too-many-statements
         # Select format
         if format.startswith('q'):
             quantize = True
             format = format[1:]
 
         from .converted import SeismicGeometryConverted
+        dataset_kwargs = {}
         if format == 'blosc':
             from .blosc import BloscFile
             constructor, mode = BloscFile, 'w'
         elif format == 'hdf5':
             constructor, mode = h5py.File, 'w-'
-
-        # Quantization
+            dataset_kwargs = {key: kwargs.pop(key) for key in ['chunks', 'crop_shape', 'compression',
+                                                               'compression_opts', 'shuffle'] if key in kwargs}
+        elif format == 'memmap':
+            from .memmap import MemmapFile
+            constructor, mode = MemmapFile, 'w'
+        elif format == 'brick':
+            projections = 'ixh'
+
+        # Quantization: parameters are kept in a local dictionary and stored only in the meta of the new cube
         if quantize:
-            self.compute_quantization_parameters(ranges=ranges, clip=clip, center=center)
-            dtype, transform = np.int8, self.quantize
+            qnt_mode = 'int8' if quantize is True else quantize
+            qnt = self.compute_quantization_parameters(ranges=ranges, clip=clip, center=center, mode=qnt_mode,
+                                                       max_error=max_error)
+            dtype = self.QUANTIZATION_DTYPES[qnt_mode]
         else:
-            dtype, transform = np.float32, lambda array: array
+            qnt_mode, qnt = None, {}
+            dtype = np.float32
+
+        def transform(array, start=0):
+            """ Quantize slab of traces, starting at the `start` iline, and accumulate the error. """
+            if qnt_mode is None:
+                return array
+            return self.quantize_and_measure(array, qnt, start=start)
 
         if path is None:
-            fmt_prefix = 'q' if quantize else ''
+            fmt_prefix = 'q' if qnt_mode == 'int8' else ''
+
+            # Other modes have their own `.meta` files, as parameters of restoring the data are stored there
+            if postfix == '' and qnt_mode not in [None, 'int8']:
+                postfix = '_' + qnt_mode
 
             if postfix == '' and len(projections) < 3:
                 postfix = '_' + projections
@@ -598,53 +1072,332 @@ class SeismicGeometrySEGY(SeismicGeometry):
             path = os.path.join(os.path.dirname(self.path), f'{self.short_name}{postfix}.{fmt_prefix}{format}')
 
         # Remove file, if exists
-        if os.path.exists(path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
             os.remove(path)
 
-        # Create file and datasets inside
-        with constructor(path, mode=mode, **kwargs) as file:
-            total = (('i' in projections) * self.cube_shape[0] +
-                     ('x' in projections) * self.cube_shape[1] +
-                     ('h' in projections) * self.cube_shape[2])
-            progress_bar = tqdm(total=total, ncols=800, disable=(not pbar))
-            name = os.path.basename(path)
-
-            for p in projections:
-                axis = self.parse_axis(p)
-                cube_name = SeismicGeometryConverted.AXIS_TO_NAME[axis]
-                order = SeismicGeometryConverted.AXIS_TO_ORDER[axis]
-                cube = file.create_dataset(cube_name, shape=self.cube_shape[order], dtype=dtype)
-
-                progress_bar.set_description(f'Creating {name}; {p}-projection')
-                for idx in range(self.cube_shape[axis]):
-                    slide = self.load_slide(idx, axis=axis, stable=False)
-                    slide = slide.T if axis == 1 else slide
-                    slide = transform(slide)
-                    cube[idx, :, :] = slide
-                    progress_bar.update()
-            progress_bar.close()
+        if format == 'brick':
+            self.convert_to_bricks(path=path, dtype=dtype, transform=transform, pbar=pbar, workers=workers, **kwargs)
+        else:
+            # Create file and datasets inside
+            with constructor(path, mode=mode, **kwargs) as file:
+                cubes = {}
+                for p in projections:
+                    axis = self.parse_axis(p)
+                    cube_name = SeismicGeometryConverted.AXIS_TO_NAME[axis]
+                    order = SeismicGeometryConverted.AXIS_TO_ORDER[axis]
+                    if format == 'hdf5':
+                        parameters = make_dataset_parameters(shape=self.cube_shape[order], dtype=dtype, order=order,
+                                                             **dataset_kwargs)
+                        cubes[axis] = file.create_dataset(cube_name, **parameters)
+                    else:
+                        cubes[axis] = file.create_dataset(cube_name, shape=self.cube_shape[order], dtype=dtype)
+
+                total = sum(self.cube_shape[axis] for axis in cubes)
+                progress_bar = tqdm(total=total, ncols=800, disable=(not pbar))
+                progress_bar.set_description(f'Creating {os.path.basename(path)}')
+
+                tmp_dir = tmp_dir or os.path.dirname(os.path.abspath(path))
+                pipelined = workers > 1
+                queue_size = queue_size or 2 * workers
+
+                if pipelined and format == 'blosc':
+                    # Start worker processes before any of the pipeline threads
+                    executor = ProcessPoolExecutor(max_workers=workers)
+                    executor.submit(int).result()
+                else:
+                    executor = None
+
+                slides = self.iterate_projections(axes=list(cubes), transform=transform, dtype=dtype,
+                                                  ram_budget=ram_budget, tmp_dir=tmp_dir, pipelined=pipelined)
+                if pipelined:
+                    slides = prefetch(slides, size=queue_size)
+
+                if executor is None:
+                    for axis, idx, slide in slides:
+                        cubes[axis][idx, :, :] = slide
+                        progress_bar.update()
+                else:
+                    with executor:
+                        # Bounded number of slides in compression; results are written in the order of submission
+                        compressing = deque()
+                        for axis, idx, slide in slides:
+                            future = executor.submit(compress_blocks, slide, cubes[axis].block_shape,
+                                                     **file.compression_parameters)
+                            compressing.append((axis, idx, future))
+
+                            if len(compressing) >= queue_size:
+                                axis_, idx_, future = compressing.popleft()
+                                cubes[axis_].write_compressed(idx_, future.result())
+                                progress_bar.update()
+
+                        for axis, idx, future in compressing:
+                            cubes[axis].write_compressed(idx, future.result())
+                            progress_bar.update()
+                progress_bar.close()
+
+        if quantize:
+            self.finalize_quantization_error(qnt)
 
         if store_meta:
             if not self.has_stats:
                 self.collect_stats(pbar=pbar)
 
+            # Parameters of quantization, possibly loaded from the meta of the SEG-Y, are replaced by the new ones
+            qnt = {**{key: None for key in self.PRESERVED if key.startswith('qnt_')}, **qnt}
             path_meta = os.path.splitext(path)[0] + '.meta'
-            self.store_meta(path_meta)
+            self.store_meta(path_meta, **qnt)
 
         return SeismicGeometry(path)
 
-    def convert_to_hdf5(self, path=None, postfix='', projections='ixh',
-                        quantize=True, ranges='q99', clip=True, center=False, store_meta=True, pbar=True, **kwargs):
+    def convert_to_bricks(self, path, dtype=np.float32, transform=None, pbar=True, workers=1, **kwargs):
+        """ Stream the cube in slabs of ilines, aligned to bricks, and write them into `BrickFile`.
+        As every trace is read, `zero_traces` attribute is updated with exact dead traces along the way.
+
+        Parameters
+        ----------
+        path : str
+            Path to save file to.
+        dtype : np.dtype
+            Dtype of stored data.
+        transform : callable, optional
+            Applied to each slab of data and the index of its first iline before storing, for example, `quantize`.
+        pbar : bool
+            Whether to show progress bar during conversion.
+        workers : int
+            If bigger than 1, then the next slab is read while the current one is compressed.
+        kwargs : dict
+            Other parameters, passed directly to the `BrickFile` constructor.
+        """
+        from .bricked import BrickFile #pylint: disable=import-outside-toplevel
+        transform = transform or (lambda array, start=0: array)
+        zero_traces = np.zeros(self.lens, dtype=np.int32)
+
+        with BrickFile(path, mode='w', shape=self.cube_shape, dtype=dtype, **kwargs) as file:
+            slabs = self.iterate_slabs(file.brick_shape[0])
+            slabs = prefetch(slabs, size=1) if workers > 1 else slabs
+
+            with tqdm(total=self.cube_shape[0], ncols=800, disable=(not pbar)) as progress_bar:
+                progress_bar.set_description(f'Creating {os.path.basename(path)}')
+                for start, stop, slab in slabs:
+                    zero_traces[start:stop] = slab.min(axis=-1) == slab.max(axis=-1)
+                    file.write_slab(transform(slab, start), start)
+                    progress_bar.update(stop - start)
+
+        if self.index_matrix is not None:
+            self.zero_traces = zero_traces
+
+    def iterate_projections(self, axes=(0, 1, 2), transform=None, dtype=np.float32, ram_budget=1.0, tmp_dir=None,
+                            pipelined=False):
+        """ Read the SEG-Y once and yield every slide of requested projections as `(axis, index, slide)` tuples.
+        Slides are oriented the same way, as they are stored in converted cubes.
+
+        The file is streamed in slabs of consecutive ilines, each of them taking no more than `ram_budget` GB.
+        As every trace is read, `zero_traces` attribute is updated with exact dead traces along the way.
+        Iline slides are yielded right away; for other projections, slabs are transposed into
+        temporary uncompressed memory-mapped buffers, which are yielded slide by slide after the pass over the file.
+        That requires (on-disk) space of roughly `x` and `h` projections of the cube in `dtype`.
+
+        Parameters
+        ----------
+        axes : sequence of ints
+            Projections to produce.
+        transform : callable, optional
+            Applied to each slab of data and the index of its first iline before casting it to `dtype`,
+            for example, `quantize`.
+        dtype : np.dtype
+            Dtype of produced slides.
+        ram_budget : number
+            Amount of memory (in GB) to use for one slab of ilines.
+        tmp_dir : str, optional
+            Directory to create temporary buffers in.
+        pipelined : bool
+            Whether to read the next slab in a separate thread while the current one is transformed.
+            The slab size is reduced accordingly to keep the memory within `ram_budget`.
+        """
+        #pylint: disable=import-outside-toplevel
+        from .converted import SeismicGeometryConverted
+        transform = transform or (lambda array, start=0: array)
+        n_ilines, n_xlines, depth = self.cube_shape
+
+        # Both `float32` slab and its transformed version are in memory at the same time
+        slab_nbytes = n_xlines * depth * (4 + np.dtype(dtype).itemsize)
+        slab_size = int(np.clip(ram_budget * 1024**3 // (slab_nbytes * (3 if pipelined else 1)), 1, n_ilines))
+
+        slabs = self.iterate_slabs(slab_size)
+        slabs = prefetch(slabs, size=1) if pipelined else slabs
+        zero_traces = np.zeros((n_ilines, n_xlines), dtype=np.int32)
+
+        with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+            buffers = {}
+            for axis in sorted(set(axes) - {0}):
+                shape = tuple(self.cube_shape[SeismicGeometryConverted.AXIS_TO_ORDER[axis]])
+                buffers[axis] = np.memmap(os.path.join(tmp, f'projection_{axis}'), dtype=dtype, mode='w+', shape=shape)
+
+            for start, stop, slab in slabs:
+                zero_traces[start:stop] = slab.min(axis=-1) == slab.max(axis=-1)
+                slab = transform(slab, start).astype(dtype, copy=False)
+
+                if 0 in axes:
+                    for i, slide in enumerate(slab):
+                        yield 0, start + i, slide
+                if 1 in buffers:
+                    buffers[1][:, :, start:stop] = slab.transpose(1, 2, 0)
+                if 2 in buffers:
+                    buffers[2][:, start:stop, :] = slab.transpose(2, 0, 1)
+
+            # Every trace is seen during the pass, so dead traces are known exactly
+            if self.index_matrix is not None:
+                self.zero_traces = zero_traces
+
+            for axis, buffer in buffers.items():
+                buffer.flush()
+                for idx, slide in enumerate(buffer):
+                    yield axis, idx, np.array(slide)
+
+            # Release memory maps before the directory is removed
+            for buffer in buffers.values():
+                buffer._mmap.close() #pylint: disable=protected-access
+            buffers.clear()
+
+    def iterate_slabs(self, slab_size):
+        """ Yield `(start, stop, slab)` for consecutive slabs of `slab_size` ilines, covering the whole cube. """
+        n_ilines, n_xlines, depth = self.cube_shape
+        for start in range(0, n_ilines, slab_size):
+            stop = min(start + slab_size, n_ilines)
+            yield start, stop, self._load_crop([slice(start, stop), slice(0, n_xlines), slice(0, depth)])
+
+    def convert_to_hdf5(self, path=None, postfix='', projections='ixh', quantize=True, ranges='q99', clip=True,
+                        center=False, max_error=0.01, store_meta=True, pbar=True, **kwargs):
         """ Convenient alias for HDF5 conversion. """
         kwargs_ = locals()
         kwargs_.pop('self')
         kwargs_.pop('kwargs')
         return self.convert(format='hdf5', **kwargs_, **kwargs)
 
-    def convert_to_blosc(self, path=None, postfix='', projections='ixh',
-                         quantize=True, ranges='q99', clip=True, center=False, store_meta=True, pbar=True, **kwargs):
+    def convert_to_blosc(self, path=None, postfix='', projections='ixh', quantize=True, ranges='q99', clip=True,
+                         center=False, max_error=0.01, store_meta=True, pbar=True, **kwargs):
         """ Convenient alias for BLOSC conversion. """
         kwargs_ = locals()
         kwargs_.pop('self')
         kwargs_.pop('kwargs')
         return self.convert(format='blosc', **kwargs_, **kwargs)
+
+
+def open_memmap(path, dtype, offset, shape):
+    """ Open strided `np.memmap` with data of traces; `dtype` is a structured one with `header` and `data` fields. """
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(shape,))['data']
+
+def read_traces(memmap, sample_format, start, stop, heights=slice(None), buffer=None):
+    """ Read a contiguous run of traces from `memmap` into `float32` buffer, decoding IBM floats in-place. """
+    data = memmap[start:stop, heights]
+    if buffer is None:
+        buffer = np.empty(data.shape, dtype=np.float32)
+
+    if sample_format == 1:
+        view = buffer.view(np.uint32)
+        view[:] = data
+        ibm_to_ieee(view.reshape(-1), buffer.reshape(-1))
+    else:
+        buffer[:] = data
+    return buffer
+
+def encode_traces(traces, sample_format):
+    """ Encode `float32` traces to values of SEG-Y `sample_format`, ready to be assigned to the data of a memmap.
+    IBM floats are returned as native `uint32`; integer formats are cast the same way, as `segyio` does it.
+    """
+    if sample_format == 1:
+        traces = np.ascontiguousarray(traces, dtype=np.float32)
+        out = np.empty(traces.shape, dtype=np.uint32)
+        ieee_to_ibm(traces.reshape(-1).view(np.uint32), out.reshape(-1))
+        return out
+    return traces.astype(SeismicGeometrySEGY.FORMAT_TO_DTYPE[sample_format], copy=False)
+
+def block_stats(traces, bins=None, sketch=None):
+    """ Compute min, max, mean, std and (optionally) histogram for each trace in a block.
+    `bins` must be uniform: values are assigned to them the same way, as `np.histogram` does it.
+    If `sketch` is provided, it is updated with values of non-constant traces.
+    """
+    trace_min, trace_max = traces.min(axis=1), traces.max(axis=1)
+    trace_mean = traces.mean(axis=1, dtype=np.float64)
+    trace_std = traces.std(axis=1, dtype=np.float64)
+
+    if sketch is not None:
+        sketch.update(traces[trace_min != trace_max])
+
+    if bins is None:
+        return trace_min, trace_max, trace_mean, trace_std, None
+
+    # Bin of each value, with the same corrections of rounding errors at the edges, as in `np.histogram`
+    n_traces, n_bins = len(traces), len(bins) - 1
+    values = traces.astype(np.float64)
+    indices = np.floor((values - bins[0]) * (n_bins / (bins[-1] - bins[0]))).astype(np.int64)
+    np.clip(indices, 0, n_bins - 1, out=indices)
+    indices[values < bins[indices]] -= 1
+    indices[(values >= bins[indices + 1]) & (indices != n_bins - 1)] += 1
+    np.clip(indices, 0, n_bins - 1, out=indices)
+    indices += np.arange(n_traces).reshape(-1, 1) * n_bins
+    trace_hist = np.bincount(indices.ravel(), minlength=n_traces * n_bins).reshape(n_traces, n_bins)
+    return trace_min, trace_max, trace_mean, trace_std, trace_hist
+
+def reduce_blocks(blocks, bins, relative_accuracy):
+    """ Compute stats for each trace in a sequence of blocks and concatenate them.
+    Also returns a sketch of values in all of the blocks, if `relative_accuracy` is provided.
+    """
+    sketch = QuantileSketch(relative_accuracy=relative_accuracy) if relative_accuracy is not None else None
+    stats = [block_stats(traces, bins, sketch) for traces in blocks]
+    return (*[np.concatenate(item) if item[0] is not None else None for item in zip(*stats)], sketch)
+
+def collect_range_stats(memmap_spec, sample_format, start, stop, bins, chunk_size, relative_accuracy):
+    """ Collect stats for traces in [start, stop) range by blocks of `chunk_size`. Used in worker processes. """
+    memmap = open_memmap(*memmap_spec)
+    buffer = np.empty((chunk_size, memmap.shape[1]), dtype=np.float32)
+
+    blocks = (read_traces(memmap, sample_format, start_, min(start_ + chunk_size, stop),
+                          buffer=buffer[:min(start_ + chunk_size, stop) - start_])
+              for start_ in range(start, stop, chunk_size))
+    return (start, stop, *reduce_blocks(blocks, bins, relative_accuracy))
+
+
+@njit(nogil=True)
+def ibm_to_ieee(array, out):
+    """ Convert IBM floats, stored as native `uint32`, to IEEE floats. `out` can share memory with `array`.
+    Releases GIL; not parallelized itself, so that it can be safely used in forked worker processes.
+    """
+    for i in range(array.size):
+        value = array[i]
+        sign = 1.0 - 2.0 * ((value >> 31) & 1)
+        exponent = np.int64((value >> 24) & 0x7f) - 64
+        mantissa = np.float64(value & 0x00ffffff) / 16777216.0
+        out[i] = sign * mantissa * 16.0 ** exponent
+    return out
+
+@njit(nogil=True)
+def ieee_to_ibm(array, out):
+    """ Convert IEEE floats, viewed as native `uint32`, to IBM floats, stored as native `uint32`.
+    Mantissa is truncated; values out of IBM range are clipped to the largest representable one, denormals become zero.
+    """
+    for i in range(array.size):
+        value = array[i]
+        sign = value & 0x80000000
+        exponent = np.int64((value >> 23) & 0xff)
+        if exponent == 0:
+            out[i] = 0
+            continue
+
+        # value = (mantissa / 2**24) * 2**exponent with mantissa in [2**23, 2**24)
+        mantissa = np.int64((value & 0x7fffff) | 0x800000)
+        exponent -= 126
+
+        exponent_16 = (exponent + 3) // 4
+        mantissa >>= 4 * exponent_16 - exponent
+        exponent_16 += 64
+
+        if exponent_16 > 127 or exponent == 129:
+            out[i] = sign | 0x7fffffff
+        elif exponent_16 < 0:
+            out[i] = 0
+        else:
+            out[i] = sign | (exponent_16 << 24) | mantissa
+    return out
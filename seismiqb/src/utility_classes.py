@@ -1,8 +1,14 @@
 """ Helper classes. """
 import os
+import sys
+import heapq
+import tempfile
+import weakref
 from time import perf_counter
-from collections import OrderedDict, defaultdict
-from threading import RLock
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from contextlib import contextmanager
+from threading import RLock, Lock
 from functools import wraps
 from hashlib import blake2b
 from copy import copy
@@ -15,6 +21,14 @@ except ImportError:
     cp = np
     CUPY_AVAILABLE = False
 
+try:
+    # `shared_memory` is added in Python 3.8, `fcntl` is not available on Windows
+    import fcntl
+    from multiprocessing import shared_memory
+    SHARED_MEMORY_AVAILABLE = True
+except ImportError:
+    SHARED_MEMORY_AVAILABLE = False
+
 import h5py
 
 from .utils import to_list
@@ -226,6 +240,136 @@ class Accumulator:
 
 
 
+class QuantileSketch:
+    """ Mergeable streaming sketch of a distribution of values with relative-error quantiles.
+    Allows to estimate quantiles of a huge amount of values without storing them:
+    the sketch is updated with chunks of data, and sketches from different workers can be merged together.
+
+    Values are counted in logarithmically spaced buckets: value `x` goes to the bucket `ceil(log(|x|, gamma))`,
+    where `gamma = (1 + relative_accuracy) / (1 - relative_accuracy)`, separately for positive and negative values.
+    Values with absolute value less than `min_value` are counted as zeros.
+    As a result, each quantile is estimated with relative error, not exceeding `relative_accuracy`.
+    Exact count, min, max, mean and std of values are also tracked.
+
+    The sketch can be converted to (and created from) a plain array, so that it can be stored in HDF5 files.
+
+    Parameters
+    ----------
+    relative_accuracy : float
+        Guaranteed relative accuracy of quantile estimates.
+    min_value, max_value : float
+        Range of absolute values, which are bucketed. Values outside of the range are counted in the closest bucket.
+    """
+    def __init__(self, relative_accuracy=0.005, min_value=1e-9, max_value=1e12):
+        self.relative_accuracy = relative_accuracy
+        self.min_value, self.max_value = min_value, max_value
+
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.key_offset = int(np.ceil(np.log(min_value) / self.log_gamma))
+        num_keys = int(np.ceil(np.log(max_value) / self.log_gamma)) - self.key_offset + 1
+
+        self.positive = np.zeros(num_keys, dtype=np.int64)
+        self.negative = np.zeros(num_keys, dtype=np.int64)
+        self.zero = 0
+
+        self.count = 0
+        self.sum, self.squared_sum = 0.0, 0.0
+        self.min, self.max = np.inf, -np.inf
+
+    def _keys(self, array):
+        """ Bucket numbers for absolute values in `array`. """
+        keys = np.ceil(np.log(array) / self.log_gamma).astype(np.int64) - self.key_offset
+        return np.clip(keys, 0, len(self.positive) - 1, out=keys)
+
+    def update(self, array):
+        """ Add values from `array` to the sketch. """
+        array = np.asarray(array, dtype=np.float64).ravel()
+        if array.size == 0:
+            return self
+
+        self.count += array.size
+        self.sum += array.sum()
+        self.squared_sum += (array ** 2).sum()
+        self.min, self.max = min(self.min, array.min()), max(self.max, array.max())
+
+        for values, counts in [(array[array >= self.min_value], self.positive),
+                               (-array[array <= -self.min_value], self.negative)]:
+            counts += np.bincount(self._keys(values), minlength=len(counts))
+        self.zero += int(np.sum(np.abs(array) < self.min_value))
+        return self
+
+    def merge(self, other):
+        """ Add counts from `other` sketch with the same parameters. """
+        if (other.relative_accuracy, other.min_value, other.max_value) != \
+           (self.relative_accuracy, self.min_value, self.max_value):
+            raise ValueError('Only sketches with the same parameters can be merged!')
+
+        self.positive += other.positive
+        self.negative += other.negative
+        self.zero += other.zero
+
+        self.count += other.count
+        self.sum += other.sum
+        self.squared_sum += other.squared_sum
+        self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+        return self
+
+    def quantile(self, q):
+        """ Estimate quantile(s) of values. `q` must be in [0, 1] range. """
+        q = np.asarray(q, dtype=np.float64)
+        if self.count == 0:
+            return np.full_like(q, np.nan)
+
+        # Buckets in the ascending order of values: negative ones, zeros, positive ones
+        counts = np.concatenate([self.negative[::-1], [self.zero], self.positive])
+        keys = np.arange(len(self.positive)) + self.key_offset
+        bucket_values = 2 * self.gamma ** keys / (self.gamma + 1)
+        values = np.concatenate([-bucket_values[::-1], [0.0], bucket_values])
+
+        ranks = q * (self.count - 1)
+        indices = np.searchsorted(np.cumsum(counts), ranks, side='right')
+        quantiles = values[np.minimum(indices, len(values) - 1)]
+        return np.clip(quantiles, self.min, self.max)
+
+    def sample(self, size=10000):
+        """ Values at uniformly spaced quantiles: can be used as a proxy for the whole distribution. """
+        return self.quantile((np.arange(size) + 0.5) / size)
+
+    @property
+    def mean(self):
+        """ Exact mean of values. """
+        return self.sum / self.count
+
+    @property
+    def std(self):
+        """ Exact standard deviation of values. """
+        return np.sqrt(max(self.squared_sum / self.count - self.mean ** 2, 0.0))
+
+    # Conversion to and from an array
+    def to_array(self):
+        """ Convert sketch to a 1D array of floats. """
+        header = [self.relative_accuracy, self.min_value, self.max_value,
+                  self.count, self.sum, self.squared_sum, self.min, self.max, self.zero]
+        return np.concatenate([header, self.negative, self.positive]).astype(np.float64)
+
+    @classmethod
+    def from_array(cls, array):
+        """ Create sketch from an array, made by :meth:`to_array`. """
+        instance = cls(*array[:3])
+        instance.count, instance.sum, instance.squared_sum = int(array[3]), array[4], array[5]
+        instance.min, instance.max, instance.zero = array[6], array[7], int(array[8])
+
+        num_keys = len(instance.positive)
+        instance.negative = array[9 : 9 + num_keys].astype(np.int64)
+        instance.positive = array[9 + num_keys:].astype(np.int64)
+        return instance
+
+    def __repr__(self):
+        return f'<QuantileSketch with {self.count} values, relative accuracy {self.relative_accuracy}>'
+
+
+
 class Accumulator3D:
     """ Base class to aggregate predicted sub-volumes into a larger 3D cube.
     Can accumulate data in memory (Numpy arrays) or on disk (HDF5 datasets).
@@ -573,10 +717,396 @@ class IndexedDict(OrderedDict):
         return (x for x in self.flat)
 
 
+class CacheBudget:
+    """ Byte budget, shared by all of the :class:`.lru_cache` instances, created with `budget=True`.
+    While the budget is active, the amount of items in each of the caches is not limited:
+    instead, the total size of stored items across all of the caches and all of the instances is kept under `maxbytes`.
+
+    The global budget is `CACHE_BUDGET`: it is configured by `SEISMIQB_CACHE_BYTES` and `SEISMIQB_CACHE_POLICY`
+    environment variables on import, and by the :meth:`.configure` method at runtime.
+
+    Parameters
+    ----------
+    maxbytes : None, int or str
+        Maximum total size of cached items. Strings with `K`, `M`, `G` suffixes are also accepted, e.g. `'8G'`.
+        If None or 0, then the budget is not active and caches fall back to their own `maxsize`.
+    policy : {'lru', 'size'}
+        Eviction policy. `'lru'` evicts the least recently used item.
+        `'size'` uses the GreedyDual-Size scheme: among rarely used items, the biggest ones are evicted first,
+        so that one huge slide does not push out dozens of small ones.
+    """
+    POLICIES = ['lru', 'size']
+    SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+    def __init__(self, maxbytes=None, policy='lru'):
+        self.lock = RLock()
+        self.configure(maxbytes=maxbytes, policy=policy)
+
+    @classmethod
+    def from_environ(cls, maxbytes_name='SEISMIQB_CACHE_BYTES', policy_name='SEISMIQB_CACHE_POLICY'):
+        """ Create budget from environment variables. """
+        return cls(maxbytes=os.environ.get(maxbytes_name), policy=os.environ.get(policy_name, 'lru'))
+
+    def configure(self, maxbytes=None, policy='lru'):
+        """ Change the size and the eviction policy of the budget. Evicts all of the currently tracked items. """
+        if policy not in self.POLICIES:
+            raise ValueError(f'Unknown eviction policy {policy}: expected one of {self.POLICIES}!')
+
+        if isinstance(maxbytes, str):
+            maxbytes = maxbytes.strip().upper().rstrip('B')
+            multiplier = self.SUFFIXES.get(maxbytes[-1:], 1)
+            maxbytes = int(float(maxbytes.rstrip(''.join(self.SUFFIXES))) * multiplier)
+
+        with self.lock:
+            entries = list(getattr(self, 'entries', {}))
+            self.maxbytes = maxbytes or None
+            self.policy = policy
+            self.nbytes = 0
+            self.entries = OrderedDict()  # (cache, weak reference to instance, key) -> nbytes
+            self.finalized = deque()      # (cache, weak reference) pairs of garbage collected instances
+
+            # GreedyDual-Size: priorities of items, heap of them with lazy deletion and the inflation value
+            self.priorities = {}
+            self.heap = []
+            self.inflation = 0.0
+            self.counter = 0
+
+            for cache, ref, key in entries:
+                cache.evict(ref, key)
+
+    @property
+    def active(self):
+        """ Whether the budget limits the caches. """
+        return self.maxbytes is not None
+
+    def __repr__(self):
+        return f'CacheBudget: {self.nbytes} / {self.maxbytes} bytes, {len(self.entries)} items, policy `{self.policy}`'
+
+
+    # Bookkeeping: must be called without holding the lock of any cache.
+    # Instances are referenced weakly, so that the budget does not prevent them from being garbage collected
+    def add(self, cache, ref, key, nbytes):
+        """ Track a new item and evict other items to stay under the budget. """
+        with self.lock:
+            self.collect()
+            entry = (cache, ref, key)
+            if entry in self.entries:
+                return
+            self.entries[entry] = nbytes
+            self.nbytes += nbytes
+            if self.policy == 'size':
+                self._prioritize(entry, nbytes)
+
+            while self.nbytes > self.maxbytes and self.entries:
+                evicted = self._pop()
+                self.discard(*evicted)
+                evicted[0].evict(*evicted[1:])
+
+    def touch(self, cache, ref, key):
+        """ Mark item as recently used. """
+        with self.lock:
+            entry = (cache, ref, key)
+            if entry in self.entries:
+                if self.policy == 'lru':
+                    self.entries.move_to_end(entry)
+                else:
+                    self._prioritize(entry, self.entries[entry])
+
+    def discard(self, cache, ref, key):
+        """ Stop tracking an item, if it is tracked. """
+        with self.lock:
+            entry = (cache, ref, key)
+            nbytes = self.entries.pop(entry, None)
+            if nbytes is not None:
+                self.nbytes -= nbytes
+                self.priorities.pop(entry, None)
+
+    def discard_instance(self, cache, ref=None):
+        """ Stop tracking all items of a cache, optionally only for one instance. """
+        with self.lock:
+            for entry in list(self.entries):
+                if entry[0] is cache and (ref is None or entry[1] is ref):
+                    self.discard(*entry)
+
+    def finalize(self, cache, ref):
+        """ Schedule removal of items of a garbage collected instance.
+        Called by the garbage collector at an arbitrary moment, so no locks are taken here.
+        """
+        self.finalized.append((cache, ref))
+
+    def collect(self):
+        """ Stop tracking items of garbage collected instances. """
+        while self.finalized:
+            self.discard_instance(*self.finalized.popleft())
+
+    def _prioritize(self, entry, nbytes):
+        """ Update GreedyDual-Size priority of an item: the bigger the item, the sooner it is evicted. """
+        priority = self.inflation + 1 / max(nbytes, 1)
+        self.counter += 1
+        self.priorities[entry] = (priority, self.counter)
+        heapq.heappush(self.heap, (priority, self.counter, entry))
+
+        # Drop outdated priorities from the heap, if there are too many of them
+        if len(self.heap) > 4 * len(self.priorities) + 64:
+            self.heap = [(*value, key) for key, value in self.priorities.items()]
+            heapq.heapify(self.heap)
+
+    def _pop(self):
+        """ Select an item to evict according to the policy. """
+        if self.policy == 'lru':
+            return next(iter(self.entries))
+
+        while True:
+            priority, counter, entry = heapq.heappop(self.heap)
+            if self.priorities.get(entry) == (priority, counter):
+                self.inflation = priority
+                return entry
+
+CACHE_BUDGET = CacheBudget.from_environ()
+
+
+class SharedMemoryCache:
+    """ Cache of arrays in a `multiprocessing.shared_memory` segment, which is visible to all of the processes
+    that attach to it: slides, decoded by one worker, are reused by others instead of being decoded again.
+    The same instance can be shared by multiple geometries: keys contain the path of each geometry.
+
+    The segment is a fixed amount of equally-sized slots for data, along with the shared index of them.
+    Each record of the index stores the digests of the key and its namespace (for example, path of the geometry),
+    the state of the slot, the shape and dtype of the stored array, the time of the last access
+    and the amount of readers, which are currently copying the data out of it.
+    Only slots without readers are evicted, the least recently used one first.
+    Access to the index is guarded by a file lock, so that any process with the name of the segment can attach to it.
+
+    Instances can be pickled: the unpickled one attaches to the same segment.
+    Segment is removed by the :meth:`.unlink` method, which should be called by the process that created it;
+    other processes are expected to be its children, so that they share the resource tracker of `multiprocessing`.
+
+    Requires Python 3.8+ and a POSIX system: check `SHARED_MEMORY_AVAILABLE` flag before creating an instance.
+
+    Parameters
+    ----------
+    nbytes : int
+        Total size of the data slots.
+    slot_nbytes : int
+        Size of one slot. Arrays that are bigger than that are not cached.
+    name : str, optional
+        Name of an existing segment to attach to. If not provided, a new segment is created.
+    """
+    EMPTY, WRITING, READY = 0, 1, 2
+    RECORD_DTYPE = np.dtype([('digest', '<u8', (2,)), ('namespace', '<u8'), ('state', '<i4'), ('refcount', '<i4'),
+                             ('last_used', '<i8'), ('dtype', 'S8'), ('ndim', '<i4'), ('shape', '<i8', (4,)),
+                             ('nbytes', '<i8')])
+    HEADER_DTYPE = np.dtype([('n_slots', '<i8'), ('slot_nbytes', '<i8'), ('clock', '<i8'),
+                             ('hit', '<i8'), ('miss', '<i8'), ('evicted', '<i8'), ('skipped', '<i8')])
+
+    def __init__(self, nbytes=None, slot_nbytes=None, name=None):
+        if not SHARED_MEMORY_AVAILABLE:
+            raise ImportError('SharedMemoryCache requires Python 3.8+ and a POSIX system!')
+
+        if name is None:
+            n_slots = max(int(nbytes // slot_nbytes), 1)
+            size = self.HEADER_DTYPE.itemsize + n_slots * (self.RECORD_DTYPE.itemsize + slot_nbytes)
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+
+        self.name = self.shm.name
+        self.header = np.ndarray(1, dtype=self.HEADER_DTYPE, buffer=self.shm.buf)
+        if self.owner:
+            self.header[0] = (n_slots, slot_nbytes, 0, 0, 0, 0, 0)
+        self.n_slots, self.slot_nbytes = int(self.header['n_slots'][0]), int(self.header['slot_nbytes'][0])
+
+        offset = self.HEADER_DTYPE.itemsize
+        self.index = np.ndarray(self.n_slots, dtype=self.RECORD_DTYPE, buffer=self.shm.buf, offset=offset)
+        offset += self.n_slots * self.RECORD_DTYPE.itemsize
+        self.data = np.ndarray(self.n_slots * self.slot_nbytes, dtype=np.uint8, buffer=self.shm.buf, offset=offset)
+
+        # File lock guards the index between processes, thread lock -- between threads of one process
+        self.lock_path = os.path.join(tempfile.gettempdir(), f'{self.name.strip("/")}.lock')
+        self.pid, self.lock_fd = None, None
+        self.open_lock()
+
+    def open_lock(self):
+        """ Open the lock file. Forked processes must re-open it, as `flock` is shared by duplicated descriptors. """
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)
+        self.thread_lock = Lock()
+        self.lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT)
+        self.pid = os.getpid()
+
+    @contextmanager
+    def lock(self):
+        """ Exclusive access to the index. """
+        if self.pid != os.getpid():
+            self.open_lock()
+
+        with self.thread_lock:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    @classmethod
+    def normalize_key(cls, key):
+        """ Convert key to plain Python values with stable representation: `numpy` scalars and arrays
+        are converted to numbers and tuples, so that equal keys have the same digest in every process.
+        """
+        if isinstance(key, (tuple, list)):
+            return tuple(cls.normalize_key(item) for item in key)
+        if isinstance(key, dict):
+            return tuple(sorted((str(name), cls.normalize_key(value)) for name, value in key.items()))
+        if isinstance(key, slice):
+            return ('slice', *(cls.normalize_key(item) for item in (key.start, key.stop, key.step)))
+        if isinstance(key, np.ndarray):
+            return ('array', key.dtype.str, key.shape, cls.normalize_key(key.tolist()))
+        if isinstance(key, np.generic):
+            return key.item()
+        return key
+
+    @classmethod
+    def make_digest(cls, key, digest_size=16):
+        """ Process-independent digest of a key as an array of `uint64`. """
+        key = repr(cls.normalize_key(key)).encode('utf-8')
+        return np.frombuffer(blake2b(key, digest_size=digest_size).digest(), dtype='<u8')
+
+    def _find(self, digest):
+        """ Position of a ready slot with a given digest or None. """
+        mask = (self.index['state'] == self.READY) & (self.index['digest'] == digest).all(axis=1)
+        positions = np.flatnonzero(mask)
+        return positions[0] if len(positions) else None
+
+    def _tick(self):
+        self.header['clock'] += 1
+        return self.header['clock'][0]
+
+    def slot(self, position, dtype, shape):
+        """ Array view of the data in a slot. """
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        start = position * self.slot_nbytes
+        return self.data[start : start + nbytes].view(dtype).reshape(shape)
+
+
+    # Public API
+    def get(self, key, namespace=None):
+        """ Copy of the cached array or None, if the key is not in the cache. """
+        digest = self.make_digest((namespace, key))
+        with self.lock():
+            position = self._find(digest)
+            if position is None:
+                self.header['miss'] += 1
+                return None
+            record = self.index[position]
+            record['refcount'] += 1
+            record['last_used'] = self._tick()
+            self.header['hit'] += 1
+            dtype, shape = record['dtype'].decode('ascii'), tuple(record['shape'][:record['ndim']])
+
+        # Data is copied without holding the lock: the slot is not evicted while it has readers
+        try:
+            result = self.slot(position, dtype, shape).copy()
+        finally:
+            with self.lock():
+                self.index[position]['refcount'] -= 1
+        return result
+
+    def put(self, key, array, namespace=None):
+        """ Store an array in the cache, evicting the least recently used slot without readers, if needed. """
+        array = np.asarray(array)
+        if array.nbytes > self.slot_nbytes or array.ndim > 4:
+            with self.lock():
+                self.header['skipped'] += 1
+            return False
+
+        digest = self.make_digest((namespace, key))
+        with self.lock():
+            if self._find(digest) is not None:
+                return True
+
+            free = np.flatnonzero(self.index['state'] == self.EMPTY)
+            if len(free):
+                position = free[0]
+            else:
+                candidates = np.flatnonzero((self.index['state'] == self.READY) & (self.index['refcount'] == 0))
+                if len(candidates) == 0:
+                    self.header['skipped'] += 1
+                    return False
+                position = candidates[np.argmin(self.index['last_used'][candidates])]
+                self.header['evicted'] += 1
+
+            record = self.index[position]
+            record['state'], record['refcount'] = self.WRITING, 0
+            record['digest'], record['namespace'] = digest, self.make_digest(namespace, digest_size=8)[0]
+            record['dtype'], record['ndim'], record['nbytes'] = array.dtype.str, array.ndim, array.nbytes
+            record['shape'][:array.ndim] = array.shape
+
+        self.slot(position, array.dtype, array.shape)[...] = array
+
+        with self.lock():
+            record = self.index[position]
+            record['state'], record['last_used'] = self.READY, self._tick()
+        return True
+
+    def clear(self, namespace=None):
+        """ Remove all items or only items of one namespace. Slots with readers are left intact. """
+        with self.lock():
+            mask = (self.index['state'] == self.READY) & (self.index['refcount'] == 0)
+            if namespace is not None:
+                mask &= self.index['namespace'] == self.make_digest(namespace, digest_size=8)[0]
+            self.index['state'][mask] = self.EMPTY
+
+    def stats(self, namespace=None):
+        """ Counters of all of the processes, attached to the segment, and the current occupancy.
+        If `namespace` is provided, then the occupancy is computed only for its items.
+        """
+        with self.lock():
+            mask = self.index['state'] == self.READY
+            if namespace is not None:
+                mask &= self.index['namespace'] == self.make_digest(namespace, digest_size=8)[0]
+            stats = {name: int(self.header[name][0]) for name in ['hit', 'miss', 'evicted', 'skipped']}
+            stats['length'] = int(mask.sum())
+            stats['bytes'] = int(self.index['nbytes'][mask].sum())
+        return stats
+
+    def __repr__(self):
+        return f'SharedMemoryCache `{self.name}`: {self.n_slots} slots of {self.slot_nbytes} bytes'
+
+
+    # Instance manager
+    def close(self):
+        """ Detach from the segment. """
+        if getattr(self, 'lock_fd', None) is not None:
+            self.header = self.index = self.data = None
+            self.shm.close()
+            os.close(self.lock_fd)
+            self.lock_fd = None
+
+    def unlink(self):
+        """ Detach from the segment and remove it. """
+        self.close()
+        if self.owner:
+            self.shm.unlink()
+            if os.path.exists(self.lock_path):
+                os.remove(self.lock_path)
+
+    def __getstate__(self):
+        return {'name': self.name}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __del__(self):
+        self.close()
+
+
 class lru_cache:
     """ Thread-safe least recent used cache. Must be applied to class methods.
     Adds the `use_cache` argument to the decorated method to control whether the caching logic is applied.
     Stored values are individual for each instance of the class.
+    Instances are referenced weakly: the cache does not prevent them from being garbage collected,
+    and their stored values and stats are released along with them.
 
     Parameters
     ----------
@@ -588,6 +1118,13 @@ class lru_cache:
         Whether the cache logic is on by default.
     copy_on_return : bool
         Whether to copy the object on retrieving from cache.
+    budget : bool or CacheBudget
+        If True, then the global `CACHE_BUDGET` is used. While the budget is active,
+        `maxsize` is ignored and the total size of items across all budgeted caches is limited instead.
+    shared : bool
+        Whether to use the :class:`.SharedMemoryCache` from the `shared_cache` attribute of the instance, if it is set.
+        Results are stored in the shared segment instead of the instance storage and keyed by the `path` attribute
+        of the instance, the name of the method and its arguments, so that other processes can reuse them.
 
     Examples
     --------
@@ -602,50 +1139,138 @@ class lru_cache:
     All arguments to the decorated method must be hashable.
     """
     #pylint: disable=invalid-name, attribute-defined-outside-init
-    def __init__(self, maxsize=None, attributes=None, apply_by_default=True, copy_on_return=False):
+    def __init__(self, maxsize=None, attributes=None, apply_by_default=True, copy_on_return=False, budget=False,
+                 shared=False):
         self.maxsize = maxsize
+        self.shared = shared
         self.apply_by_default = apply_by_default
         self.copy_on_return = copy_on_return
+        self.budget = CACHE_BUDGET if budget is True else (budget or None)
 
         # Parse `attributes`
         if isinstance(attributes, str):
-            self.attributes = [attributes]
+            self.attributes = (attributes,)
         elif isinstance(attributes, (tuple, list)):
-            self.attributes = attributes
+            self.attributes = tuple(attributes)
         else:
             self.attributes = False
 
         self.default = Singleton
         self.lock = RLock()
+        self.hooks = []
+
+        # Weak references to instances outlive resets, so that a finalizer is registered only once per instance
+        self.refs = weakref.WeakKeyDictionary()
         self.reset()
 
     def reset(self, instance=None):
         """ Clear cache and stats. """
-        if instance is None:
-            self.cache = defaultdict(OrderedDict)
-            self.is_full = defaultdict(lambda: False)
-            self.stats = defaultdict(lambda: {'hit': 0, 'miss': 0})
-        else:
-            self.cache[instance] = OrderedDict()
-            self.is_full[instance] = False
-            self.stats[instance] = {'hit': 0, 'miss': 0}
+        with self.lock:
+            if instance is None:
+                self.records = WeakKeyDefaultDict(CacheRecord)
+                ref = None
+            else:
+                self.records[instance] = CacheRecord()
+                ref = self.refs.get(instance)
+
+        if self.budget is not None and (instance is None or ref is not None):
+            self.budget.discard_instance(self, ref)
+
+    @property
+    def cache(self):
+        """ Mapping from instances to their stored values. """
+        return RecordsView(self.records, 'values')
+
+    @property
+    def stats(self):
+        """ Mapping from instances to their counters: hits, misses, evictions and total size of stored items. """
+        return RecordsView(self.records, 'stats')
+
+    def get_ref(self, instance, record):
+        """ Weak reference to an instance: the same object for every call, so that it can be used in keys. """
+        if record.ref is None:
+            with self.lock:
+                ref = self.refs.get(instance)
+                if ref is None:
+                    ref = weakref.ref(instance)
+                    self.refs[instance] = ref
+                    if self.budget is not None:
+                        weakref.finalize(instance, self.budget.finalize, self, ref)
+                record.ref = ref
+        return record.ref
+
+    def evict(self, ref, key):
+        """ Remove one item from the cache. Used by the budget to enforce its limit. """
+        instance = ref()
+        record = self.records.get(instance) if instance is not None else None
+        if record is None:
+            return
+
+        with record.lock:
+            result = record.values.pop(key, self.default)
+            if result is not self.default:
+                record.is_full = False
+                record.stats['evicted'] += 1
+                record.stats['bytes'] -= self.sizeof(result)
+
+    @staticmethod
+    def sizeof(result):
+        """ Size of a cached item in bytes. """
+        return getattr(result, 'nbytes', None) or sys.getsizeof(result)
+
+    @property
+    def budgeted(self):
+        """ Whether the size of the cache is controlled by an active byte budget. """
+        return self.budget is not None and self.budget.active
 
     def make_key(self, instance, args, kwargs):
-        """ Create a key from a combination of instance reference, method args, and instance attributes. """
-        key = [instance] + list(args)
+        """ Create a key from a combination of method args and instance attributes.
+        The instance itself is not a part of the key, as values are already stored separately for each instance.
+        Values of attributes are used as is, without hashing them: that is both faster and exact.
+        Unhashable arguments, like lists, are flattened into tuples.
+        """
+        key = args
         if kwargs:
-            for k, v in sorted(kwargs.items()):
-                key.append((k, v))
-
+            key = key + tuple(sorted(kwargs.items()))
         if self.attributes:
             for attr in self.attributes:
-                attr_hash = stable_hash(getattr(instance, attr))
-                key.append(attr_hash)
-        return flatten_nested(key)
+                value = getattr(instance, attr)
+                key += (tuple(value) if isinstance(value, list) else value,)
+
+        try:
+            hash(key)
+        except TypeError:
+            key = flatten_nested(key)
+        return key
+
+
+    # Instrumentation
+    def add_hook(self, hook):
+        """ Add a callable to report each call of the cached method to.
+        It is called as `hook(instance, name, event, latency, nbytes)`, where `event` is either `'hit'` or `'miss'`,
+        `latency` is the duration of the whole call in seconds and `nbytes` is the size of the result.
+        Timings are measured only if there is at least one hook, so there is no overhead otherwise.
+        """
+        self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        """ Stop reporting calls to a hook. """
+        self.hooks.remove(hook)
+
+    def report(self, instance, name, event, start, result):
+        """ Pass the information about the call to hooks. """
+        latency = perf_counter() - start
+        nbytes = self.sizeof(result)
+        for hook in self.hooks:
+            hook(instance, name, event, latency, nbytes)
 
 
     def __call__(self, func):
         """ Add the cache to the function. """
+        #pylint: disable=too-many-statements
+        name = func.__name__
+
         @wraps(func)
         def wrapper(instance, *args, **kwargs):
             # Parse the `use_cache`
@@ -659,53 +1284,132 @@ class lru_cache:
                 result = func(instance, *args, **kwargs)
                 return result
 
+            start = perf_counter() if self.hooks else None
             key = self.make_key(instance, args, kwargs)
+            record = self.records[instance]
+
+            # Use the cache, shared between processes, instead of the instance storage
+            shared_cache = getattr(instance, 'shared_cache', None) if self.shared else None
+            if shared_cache is not None:
+                namespace = getattr(instance, 'path', None)
+                shared_key = (name, *key)
+
+                result = shared_cache.get(shared_key, namespace=namespace)
+                event = 'miss' if result is None else 'hit'
+                with record.lock:
+                    record.stats[event] += 1
+                if result is None:
+                    result = func(instance, *args, **kwargs)
+                    shared_cache.put(shared_key, result, namespace=namespace)
+                if start is not None:
+                    self.report(instance, name, event, start, result)
+                return result
 
             # If result is already in cache, just retrieve it and update its timings
-            with self.lock:
-                result = self.cache[instance].get(key, self.default)
+            budgeted = self.budgeted
+            with record.lock:
+                result = record.values.get(key, self.default)
                 if result is not self.default:
-                    del self.cache[instance][key]
-                    self.cache[instance][key] = result
-                    self.stats[instance]['hit'] += 1
-                    return copy(result) if self.copy_on_return else result
+                    record.values.move_to_end(key)
+                    record.stats['hit'] += 1
+            if result is not self.default:
+                if budgeted:
+                    self.budget.touch(self, self.get_ref(instance, record), key)
+                if start is not None:
+                    self.report(instance, name, 'hit', start, result)
+                return copy(result) if self.copy_on_return else result
 
             # The result was not found in cache: evaluate function
             result = func(instance, *args, **kwargs)
+            nbytes = self.sizeof(result)
 
             # Add the result to cache
-            with self.lock:
-                self.stats[instance]['miss'] += 1
-                if key in self.cache[instance]:
+            added = False
+            with record.lock:
+                record.stats['miss'] += 1
+                if key in record.values:
                     pass
-                elif self.is_full[instance]:
-                    self.cache[instance].popitem(last=False)
-                    self.cache[instance][key] = result
+                elif record.is_full and not budgeted:
+                    _, evicted = record.values.popitem(last=False)
+                    record.values[key] = result
+                    record.stats['evicted'] += 1
+                    record.stats['bytes'] += nbytes - self.sizeof(evicted)
                 else:
-                    self.cache[instance][key] = result
-                    self.is_full[instance] = (len(self.cache[instance]) >= self.maxsize)
+                    record.values[key] = result
+                    record.stats['bytes'] += nbytes
+                    record.is_full = (len(record.values) >= self.maxsize)
+                    added = True
+
+            # Budget may evict items from any of the caches, so it is updated without holding the lock
+            if added and budgeted:
+                self.budget.add(self, self.get_ref(instance, record), key, nbytes)
+            if start is not None:
+                self.report(instance, name, 'miss', start, result)
             return copy(result) if self.copy_on_return else result
 
-        wrapper.__name__ = func.__name__
+        wrapper.__name__ = name
         wrapper.cache = lambda: self.cache
         wrapper.stats = lambda: self.stats
         wrapper.reset = self.reset
         wrapper.reset_instance = lambda instance: self.reset(instance=instance)
+        wrapper.add_hook = self.add_hook
+        wrapper.remove_hook = self.remove_hook
         return wrapper
 
 
+class CacheRecord:
+    """ Stored values, stats and the lock of one instance in :class:`.lru_cache`.
+    Each instance has its own lock, so that threads, working with different instances, do not wait for each other.
+    """
+    __slots__ = ('values', 'stats', 'is_full', 'lock', 'ref')
+
+    def __init__(self):
+        self.values = OrderedDict()
+        self.stats = {'hit': 0, 'miss': 0, 'evicted': 0, 'bytes': 0}
+        self.is_full = False
+        self.lock = Lock()
+        self.ref = None
+
+class RecordsView(Mapping):
+    """ Mapping from instances to one of the attributes of their :class:`.CacheRecord`. """
+    def __init__(self, records, attribute):
+        self.records = records
+        self.attribute = attribute
+
+    def __getitem__(self, instance):
+        return getattr(self.records[instance], self.attribute)
+
+    def __iter__(self):
+        return iter(list(self.records.keys()))
+
+    def __len__(self):
+        return len(self.records)
+
+class WeakKeyDefaultDict(weakref.WeakKeyDictionary):
+    """ `WeakKeyDictionary` with a factory of default values, similar to `defaultdict`.
+    Items are removed, when their keys are garbage collected.
+    Default values are created under a lock, so that concurrent first accesses to a key get the same value.
+    """
+    def __init__(self, default_factory):
+        super().__init__()
+        self.default_factory = default_factory
+        self.creation_lock = Lock()
+
+    def __getitem__(self, key):
+        try:
+            return super().__getitem__(key)
+        except KeyError:
+            with self.creation_lock:
+                value = self.get(key, Singleton)
+                if value is Singleton:
+                    value = self.default_factory()
+                    self[key] = value
+            return value
+
 class SingletonClass:
     """ There must be only one! """
 Singleton = SingletonClass()
 
-def stable_hash(key):
-    """ Hash that stays the same between different runs of Python interpreter. """
-    if not isinstance(key, (str, bytes)):
-        key = ''.join(sorted(str(key)))
-    if not isinstance(key, bytes):
-        key = key.encode('ascii')
-    return str(blake2b(key).hexdigest())
-
 def flatten_nested(iterable):
     """ Recursively flatten nested structure of tuples, list and dicts. """
     result = []
@@ -721,6 +1425,46 @@ def flatten_nested(iterable):
 
 
 
+class CacheTimer:
+    """ Hook for :meth:`.lru_cache.add_hook`: aggregates latencies and sizes of results of cached calls
+    for each method and each type of event (`'hit'` or `'miss'`).
+
+    Examples
+    --------
+    Measure latency of slide loads from the cache of a converted geometry::
+
+    cache_timer = CacheTimer()
+    type(geometry)._cached_load.add_hook(cache_timer)
+    ...
+    cache_timer.summary()
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """ Clear aggregated values. """
+        self.records = {}
+
+    def __call__(self, instance, name, event, latency, nbytes):
+        _ = instance
+        with self.lock:
+            record = self.records.setdefault((name, event), {'count': 0, 'time': 0.0, 'max_time': 0.0, 'bytes': 0})
+            record['count'] += 1
+            record['time'] += latency
+            record['max_time'] = max(record['max_time'], latency)
+            record['bytes'] += nbytes
+
+    def summary(self):
+        """ Amount of calls, mean and max latencies in microseconds and total size of results in bytes. """
+        with self.lock:
+            return {key: {'count': record['count'],
+                          'mean_latency': 1e6 * record['time'] / record['count'],
+                          'max_latency': 1e6 * record['max_time'],
+                          'bytes': record['bytes']}
+                    for key, record in self.records.items()}
+
+
 class timer:
     """ Context manager for timing the code. """
     def __init__(self, string=''):
@@ -767,3 +1511,40 @@ class SafeIO:
 
         if self.log_file:
             self._info(self.log_file, f'Closed {self.path}')
+
+
+class PositionalReader:
+    """ Read-only file handler, that reads bytes at given offsets and can be used from multiple threads at once.
+    Uses `os.pread` on a file descriptor, so that neither seeks nor locks are needed.
+    On systems without `os.pread` (for example, Windows), falls back to `seek` and `read` under a lock.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fd, self.file, self.lock = None, None, None
+
+        if hasattr(os, 'pread'):
+            self.fd = os.open(path, os.O_RDONLY)
+        else:
+            self.file = open(path, 'rb') #pylint: disable=consider-using-with
+            self.lock = Lock()
+
+    def read(self, length, offset):
+        """ Read `length` bytes, starting from `offset`. """
+        if self.fd is not None:
+            return os.pread(self.fd, length, offset)
+
+        with self.lock:
+            self.file.seek(offset)
+            return self.file.read(length)
+
+    def close(self):
+        """ Close the underlying descriptor or file. """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __del__(self):
+        self.close()
@@ -2,6 +2,8 @@
 import os
 import inspect
 from math import atan
+from queue import Queue, Full
+from threading import Thread, Event
 
 import numpy as np
 import torch
@@ -243,6 +245,20 @@ def find_min_max(array):
         max_val = max(array[i], max_val)
     return min_val, max_val
 
+@njit(nogil=True)
+def fused_normalize(array, out, shift, divisor, clip_min, clip_max, clip):
+    """ Compute `(clip(array) - shift) / divisor` for 3D `array` of any dtype and strides, writing it into `out`.
+    Done in one pass over data, so transposed views and quantized arrays need no intermediate copies.
+    """
+    for i in range(out.shape[0]):
+        for j in range(out.shape[1]):
+            for k in range(out.shape[2]):
+                value = np.float32(array[i, j, k])
+                if clip:
+                    value = min(max(value, clip_min), clip_max)
+                out[i, j, k] = (value - shift) / divisor
+    return out
+
 
 @njit
 def filter_simplices(simplices, points, matrix, threshold=5.):
@@ -399,3 +415,43 @@ def to_list(obj):
 def get_class_methods(cls):
     """ Get a list of non-private class methods. """
     return [func for func in dir(cls) if not func.startswith("__") and callable(getattr(cls, func))]
+
+def prefetch(iterable, size=1):
+    """ Iterate over `iterable` in a separate thread, keeping at most `size` produced items ahead of the consumer.
+    Exceptions, raised while producing items, are re-raised in the consuming thread.
+    """
+    items = Queue(maxsize=size)
+    stop = Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def producer():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+        except Exception as e: #pylint: disable=broad-except
+            put((False, e))
+            return
+        put((False, None))
+
+    thread = Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            is_item, item = items.get()
+            if not is_item:
+                if item is not None:
+                    raise item
+                break
+            yield item
+    finally:
+        stop.set()
+        thread.join()